@@ -0,0 +1,97 @@
+"""
+Export of the QC and tissue detection models to ONNX (dynamic batch axis) for --backend onnxruntime.
+The exported graphs are validated against the PyTorch models: argmax masks of both are compared on a set of
+validation patches taken from the slides in --slide_folder (QC: patches at model MPP, tissue detection: patches
+of the MPP 10 thumbnail). Without slides, random patches are used (numerical check only).
+"""
+import argparse
+import os
+import sys
+from PIL import Image
+from wsi_models import load_qc_model, load_td_model
+from wsi_model_check import (qc_sample_tiles, td_sample_tiles, slide_folder_tiles, tis_det_map_for, compare_models,
+                             print_comparison)
+from wsi_pipeline import (MODEL_CACHE_DIR, MODEL_TD_DIR, MODEL_TD_NAME, MPP_MODEL_TD, M_P_S_MODEL, M_P_S_MODEL_TD,
+                          ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, ENCODER_MODEL_TD, qc_model_path)
+from wsi_onnx import export_onnx, onnx_path_for, OnnxModel
+from wsi_process import get_normalization
+Image.MAX_IMAGE_PIXELS = 1000000000
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', dest='model', default='all', choices=['qc', 'td', 'all'],
+                    help='model(s) to export: qc - GrandQC model, td - tissue detection model', type=str)
+parser.add_argument('--mpp_model', dest='MPP_MODEL', default=1.5,
+                    help='MPP of the QC model, should only be 1.0, 1.5, 2.0', type=float)
+parser.add_argument('--slide_folder', dest='slide_folder', default=None,
+                    help='path to WSIs used for the validation patches', type=str)
+parser.add_argument('--output_dir', dest='output_dir', default=None,
+                    help='output folder of wsi_tis_detect.py, its tissue masks are used to pick QC validation patches',
+                    type=str)
+parser.add_argument('--val_tiles', dest='val_tiles', default=8, help='number of validation patches per slide', type=int)
+parser.add_argument('--batch_size', dest='batch_size', default=4,
+                    help='batch size of the validation forward passes', type=int)
+parser.add_argument('--max_mismatch', dest='max_mismatch', default=0.0,
+                    help='maximum fraction of validation pixels with different argmax class (ties excluded)', type=float)
+parser.add_argument('--tie_tol', dest='tie_tol', default=1e-4,
+                    help='pixels whose two best PyTorch logits differ by at most tie_tol are ties, their class may '
+                         'flip with floating point rounding', type=float)
+parser.add_argument('--force', dest='force', action='store_true', help='overwrite existing ONNX files')
+args = parser.parse_args()
+
+# Checkpoints, patch sizes and encoders as in the pipeline (raises for an MPP without QC model)
+model_qc_path = qc_model_path(args.MPP_MODEL)
+model_td_path = os.path.join(MODEL_TD_DIR, MODEL_TD_NAME)
+
+SLIDE_DIR = args.slide_folder
+OUTPUT_DIR = args.output_dir
+VAL_TILES = args.val_tiles
+
+
+def qc_validation_tiles(slide_path, slide_name, n):
+    # Patches at model MPP, as read by main.py (tissue patches if the tissue detection mask is available)
+    return qc_sample_tiles(slide_path, n, M_P_S_MODEL, args.MPP_MODEL, tis_det_map_for(OUTPUT_DIR, slide_name))
+
+
+def td_validation_tiles(slide_path, slide_name, n):
+    # Patches of the JPEG compressed MPP 10 thumbnail, as in wsi_tis_detect.py
+    return td_sample_tiles(slide_path, n, M_P_S_MODEL_TD, MPP_MODEL_TD)
+
+
+def export_and_validate(name, model_path, load_model, m_p_s, classes, get_tiles):
+    print("")
+    print("Model:", name, "-", model_path)
+    onnx_path = onnx_path_for(model_path, cache_dir=MODEL_CACHE_DIR)
+    model = load_model()
+    if args.force or not os.path.exists(onnx_path):
+        export_onnx(model, onnx_path, m_p_s)
+        print("Exported:", onnx_path)
+    else:
+        print("Already exported (use --force to overwrite):", onnx_path)
+    onnx_model = OnnxModel(onnx_path)
+    # Argmax masks of the PyTorch model and of the ONNX graph on the validation patches
+    patches = slide_folder_tiles(SLIDE_DIR, get_tiles, VAL_TILES, m_p_s)
+    norm = get_normalization(ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, 'cpu')
+    result = compare_models(model.cpu().float().eval(), onnx_model, patches, norm, classes, args.batch_size,
+                            args.tie_tol)
+    print("Validation patches: ", len(patches))
+    print_comparison(result)
+    mismatch = result['mismatch'] / max(result['pixels'], 1)
+    if mismatch > args.max_mismatch:
+        print(f"FAILED: {mismatch:.6f} of the pixels differ (allowed: {args.max_mismatch})")
+        return False
+    print("OK: argmax masks match (up to ties)")
+    return True
+
+
+ok = True
+if args.model in ('qc', 'all'):
+    ok &= export_and_validate('QC', model_qc_path,
+                              lambda: load_qc_model(model_qc_path, ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, 'cpu',
+                                                    cache_dir=MODEL_CACHE_DIR),
+                              M_P_S_MODEL, 8, qc_validation_tiles)
+if args.model in ('td', 'all'):
+    ok &= export_and_validate('Tissue detection', model_td_path,
+                              lambda: load_td_model(model_td_path, ENCODER_MODEL_TD, 'cpu', cache_dir=MODEL_CACHE_DIR),
+                              M_P_S_MODEL_TD, 2, td_validation_tiles)
+
+sys.exit(0 if ok else 1)
@@ -161,30 +161,11 @@ ipcMain.handle('pathInsight:start-pipeline', async (_event, payload) => {
         });
       });
 
-    // 1) run tissue detection
-    mainWindow?.webContents.send('pathInsight:status', { step: 'tissue-detect', msg: 'Starting tissue detection...' });
-    const tdScript = path.join(repoRoot, '01_WSI_inference_OPENSLIDE_QC', 'wsi_tis_detect.py');
-    await runCmd(pythonPath, [tdScript, '--slide_folder', slidesIn, '--output_dir', outputDir]);
-
-    // 2) run QC pipeline (use MPP 1.5 only, skip geojson for speed)
-    mainWindow?.webContents.send('pathInsight:status', { step: 'qc', msg: 'Starting QC pipeline...' });
-    const qcScript = path.join(repoRoot, '01_WSI_inference_OPENSLIDE_QC', 'main.py');
-    await runCmd(pythonPath, [qcScript, '--slide_folder', slidesIn, '--output_dir', outputDir, '--mpp_model', '1.5', '--create_geojson', 'N']);
-
-    // 3) generate HTML report
-    mainWindow?.webContents.send('pathInsight:status', { step: 'report', msg: 'Generating HTML report...' });
-    const reportScript = path.join(repoRoot, '01_WSI_inference_OPENSLIDE_QC', 'generate_report.py');
-    await runCmd(pythonPath, [reportScript, '--output_dir', outputDir]);
-
-    // 3b) generate PDF report with GrandQC scores
-    mainWindow?.webContents.send('pathInsight:status', { step: 'pdf-report', msg: 'Generating PDF report with GrandQC scores...' });
-    const pdfReportScript = path.join(repoRoot, '01_WSI_inference_OPENSLIDE_QC', 'generate_pdf_report.py');
-    await runCmd(pythonPath, [pdfReportScript, '--output_dir', outputDir]);
-
-    // 4) generate visual overlays
-    mainWindow?.webContents.send('pathInsight:status', { step: 'overlays', msg: 'Creating visual overlays...' });
-    const overlayScript = path.join(repoRoot, '01_WSI_inference_OPENSLIDE_QC', 'generate_overlays.py');
-    await runCmd(pythonPath, [overlayScript, '--output_dir', outputDir]);
+    // Tissue detection, QC (MPP 1.5 only, skip geojson for speed), HTML report, PDF report with GrandQC scores and
+    // visual overlays as one run of the pipeline runner: up-to-date steps are skipped, independent steps run concurrently
+    mainWindow?.webContents.send('pathInsight:status', { step: 'pipeline', msg: 'Starting pipeline (tissue detection, QC, reports, overlays)...' });
+    const runnerScript = path.join(repoRoot, '01_WSI_inference_OPENSLIDE_QC', 'wsi_pipeline_runner.py');
+    await runCmd(pythonPath, [runnerScript, '--slide_folder', slidesIn, '--output_dir', outputDir, '--mpp_model', '1.5', '--create_geojson', 'N']);
 
     mainWindow?.webContents.send('pathInsight:status', { step: 'done', msg: 'Pipeline finished', outputDir });
 
@@ -6,14 +6,21 @@ import os
 import numpy as np
 from PIL import Image
 import argparse
+from wsi_colors import colors_QC7
+from wsi_labels import colorize, mode_pool
+from wsi_thumbnail_cache import ThumbnailCache
 
+MPP_TIS_DET = 10  # MPP of the tissue detection thumbnail
 
-def create_overlay_visualization(output_dir, slide_name):
+
+def create_overlay_visualization(output_dir, slide_name, slide_path=None, thumbnails=None):
     """
     Create a composite overlay image showing:
     1. Original WSI thumbnail
     2. QC mask with artifact classes colored
     3. Tissue detection overlay
+    With slide_path and thumbnails (see ThumbnailCache) the thumbnail comes from the cache when it has a view of the
+    slide, otherwise from tis_det_thumbnail.
     """
     
     # Paths
@@ -26,20 +33,27 @@ def create_overlay_visualization(output_dir, slide_name):
     qc_mask_path = os.path.join(output_dir, 'mask_qc', f'{slide_name}_mask.png')
     tissue_mask_col_path = os.path.join(output_dir, 'tis_det_mask_col', f'{slide_name}.svs_MASK_COL.png')
     
-    # Check if required files exist
-    if not os.path.exists(tissue_thumb_path):
-        print(f"Tissue thumbnail not found: {tissue_thumb_path}")
-        return None
-    
-    # Load original thumbnail
-    original = Image.open(tissue_thumb_path).convert('RGB')
+    # Lossless thumbnail from the cache, without decoding the slide
+    original = None
+    if thumbnails is not None and slide_path is not None:
+        original = thumbnails.view(slide_path, MPP_TIS_DET, decode=False)
+
+    if original is None:
+        # Check if required files exist
+        if not os.path.exists(tissue_thumb_path):
+            print(f"Tissue thumbnail not found: {tissue_thumb_path}")
+            return None
+
+        # Load original thumbnail
+        original = Image.open(tissue_thumb_path).convert('RGB')
     width, height = original.size
     
     # If we have QC mask, create overlay
     if os.path.exists(qc_mask_path):
         try:
-            qc_mask = Image.open(qc_mask_path).convert('RGB')
-            qc_mask = qc_mask.resize((width, height), Image.Resampling.NEAREST)
+            # Labels mode pooled to the thumbnail size, then colored
+            qc_labels = mode_pool(np.array(Image.open(qc_mask_path)), (width, height), n_labels=len(colors_QC7) + 1)
+            qc_mask = Image.fromarray(colorize(qc_labels, colors_QC7, first_label=1))
             
             # Blend original with QC mask (30% mask, 70% original)
             qc_overlay = Image.blend(original, qc_mask, 0.3)
@@ -52,8 +66,8 @@ def create_overlay_visualization(output_dir, slide_name):
     # If we have tissue mask, create tissue overlay
     if os.path.exists(tissue_mask_col_path):
         try:
-            tissue_mask = Image.open(tissue_mask_col_path).convert('RGB')
-            tissue_mask = tissue_mask.resize((width, height), Image.Resampling.NEAREST)
+            tissue_mask = Image.open(tissue_mask_col_path)
+            tissue_mask = tissue_mask.resize((width, height), Image.Resampling.NEAREST).convert('RGB')
             
             # Blend original with tissue mask (40% mask, 60% original)
             tissue_overlay = Image.blend(original, tissue_mask, 0.4)
@@ -113,9 +127,9 @@ def main():
         print(f"Slides directory not found: {slides_dir}")
         return
     
-    slide_names = [f.replace('.svs', '').replace('.ndpi', '').replace('.tiff', '') 
-                  for f in os.listdir(slides_dir) 
-                  if os.path.isfile(os.path.join(slides_dir, f))]
+    slide_files = [f for f in os.listdir(slides_dir) if os.path.isfile(os.path.join(slides_dir, f))]
+    slide_names = [f.replace('.svs', '').replace('.ndpi', '').replace('.tiff', '') for f in slide_files]
+    thumbnails = ThumbnailCache(os.path.join(args.output_dir, 'thumbnail_cache'))
     
     if not slide_names:
         print("No slides found to process")
@@ -126,10 +140,11 @@ def main():
     os.makedirs(overlay_dir, exist_ok=True)
     
     # Generate overlays
-    for slide_name in slide_names:
+    for slide_file, slide_name in zip(slide_files, slide_names):
         print(f"Generating overlay for: {slide_name}")
         
-        overlay = create_overlay_visualization(args.output_dir, slide_name)
+        overlay = create_overlay_visualization(args.output_dir, slide_name, os.path.join(slides_dir, slide_file),
+                                               thumbnails)
         
         if overlay:
             output_path = os.path.join(overlay_dir, f'{slide_name}_visualization.jpg')
@@ -3,30 +3,19 @@ Comments to version:
 - Uses tissue maps from tissue detector. Therefore, slides should be processed by tissue detector firstly.
 - Consider adding color schema if you use the tool for a new entity
 """
-from wsi_colors import colors_QC7 as colors
 import torch
 import argparse
-from openslide import open_slide
 from PIL import Image
 import os
-from wsi_slide_info import slide_info
-from wsi_process import slide_process_single, mask_to_geojson
-from wsi_maps import make_overlay
-import numpy as np
-import timeit
-import cv2
-import pickle
+import socket
+from wsi_pipeline import (load_qc, load_td, td_preprocessing_fn, tis_det_dirs, qc_dirs, qc_slide, fused_slide,
+                          stats_header)
+from wsi_scheduler import run_pool
+from wsi_job_queue import JobQueue
+from wsi_thumbnail_cache import ThumbnailCache
+from wsi_output_writer import OutputWriter
 Image.MAX_IMAGE_PIXELS = 1000000000
 
-# Custom pickle unpickler to handle timm module changes
-class TimmmUnpickler(pickle.Unpickler):
-    def find_class(self, module, name):
-        # Handle timm.models.layers.activations module changes
-        if module.startswith('timm.models.layers'):
-            module = module.replace('timm.models.layers', 'timm.models')
-        return super().find_class(module, name)
-
-
 # DEVICE - Auto-detect available device
 if torch.cuda.is_available():
     DEVICE = 'cuda'
@@ -46,6 +35,73 @@ parser.add_argument('--mpp_model', dest='MPP_MODEL', default=1.5,
 parser.add_argument('--end', dest='end', default=-1, help='end num of WSIs', type=int)
 parser.add_argument('--ol_factor', dest='ol_factor', default=10,
                     help='reduction factor of the overlay compared to dimensions of original WSI', type=int)
+parser.add_argument('--batch_size', dest='batch_size', default=1,
+                    help='number of tissue patches predicted in one forward pass of the model', type=int)
+parser.add_argument('--reader_workers', dest='reader_workers', default=2,
+                    help='number of threads reading patches ahead of the inference (0 - read in the main thread)', type=int)
+parser.add_argument('--prefetch_depth', dest='prefetch_depth', default=16,
+                    help='maximum number of patches read ahead of the inference', type=int)
+parser.add_argument('--preprocess_workers', dest='preprocess_workers', default=1,
+                    help='number of threads stacking batches and their tissue masks for the inference', type=int)
+parser.add_argument('--stage_queue_depth', dest='stage_queue_depth', default=4,
+                    help='maximum number of batches waiting between two stages of the patch pipeline', type=int)
+parser.add_argument('--level_tolerance', dest='level_tolerance', default=0.1,
+                    help='relative tolerance for reading patches from a pyramid level coarser than the model resolution '
+                         '(-1 - always read level 0)', type=float)
+parser.add_argument('--backend', dest='backend', default='pytorch', choices=['pytorch', 'onnxruntime'],
+                    help='inference backend of the QC model (onnxruntime - exported ONNX graph, see export_onnx.py)',
+                    type=str)
+parser.add_argument('--precision', dest='precision', default='fp32', choices=['fp32', 'int8'],
+                    help='int8 - INT8 quantized model made by quantize_onnx.py (always runs with onnxruntime)',
+                    type=str)
+parser.add_argument('--model_cache', dest='model_cache', default="Y",
+                    help='cache the loaded model in models/cache for fast loading on later starts or not', type=str)
+parser.add_argument('--workers', dest='workers', default=1,
+                    help='number of worker processes, slides are handed out largest-first (1 - no worker processes)',
+                    type=int)
+parser.add_argument('--threads_per_worker', dest='threads_per_worker', default=0,
+                    help='torch threads of every worker (0 - available cores divided by --workers)', type=int)
+parser.add_argument('--pin_cores', dest='pin_cores', default="N",
+                    help='pin every worker to its own set of CPU cores or not (Linux)', type=str)
+parser.add_argument('--geojson_format', dest='geojson_format', default='geojson', choices=['geojson', 'geoparquet'],
+                    help='format of the artifact polygons in geojson_qc (geoparquet - needs pyarrow)', type=str)
+parser.add_argument('--simplify_um', dest='simplify_um', default=0,
+                    help='tolerance of the polygon simplification in microns (0 - no simplification)', type=float)
+parser.add_argument('--coord_precision', dest='coord_precision', default=1,
+                    help='decimals of the polygon coordinates (level 0 pixels)', type=int)
+parser.add_argument('--geojson_workers', dest='geojson_workers', default=4,
+                    help='number of threads extracting the polygons from the mask (0 - main thread)', type=int)
+parser.add_argument('--geojson_index', dest='geojson_index', default="Y",
+                    help='write the spatial index <slide>.geojson.idx for region queries or not', type=str)
+parser.add_argument('--vector_tiles', dest='vector_tiles', default="N",
+                    help='write a tiled pyramid of the polygons into geojson_qc/<slide>_tiles or not', type=str)
+parser.add_argument('--mask_format', dest='mask_format', default='png', choices=['png', 'tiff'],
+                    help='format of mask_qc (tiff - tiled pyramidal OME-TIFF, written while the patches are predicted)',
+                    type=str)
+parser.add_argument('--mask_workers', dest='mask_workers', default=4,
+                    help='number of threads compressing the tiles of the OME-TIFF mask', type=int)
+parser.add_argument('--tis_detect', dest='tis_detect', default="N",
+                    help='run the tissue detection in the same pass on the open slide instead of reading tis_det_mask '
+                         '(no separate wsi_tis_detect.py run) or not', type=str)
+parser.add_argument('--save_tis_det', dest='save_tis_det', default="N",
+                    help='write the tissue detection outputs (tis_det_*) with --tis_detect Y or not', type=str)
+parser.add_argument('--thumbnail_cache', dest='thumbnail_cache', default="Y",
+                    help='keep the slide thumbnails in <output_dir>/thumbnail_cache for the other steps and runs or not',
+                    type=str)
+parser.add_argument('--thumbnail_cache_mb', dest='thumbnail_cache_mb', default=2048,
+                    help='size limit of the thumbnail cache in MB, least recently used thumbnails are removed first',
+                    type=float)
+parser.add_argument('--output_writers', dest='output_writers', default=2,
+                    help='number of threads saving the outputs of finished slides while the next slide is processed '
+                         '(0 - save before the next slide)', type=int)
+parser.add_argument('--max_pending_slides', dest='max_pending_slides', default=2,
+                    help='maximum number of finished slides whose outputs are still being saved', type=int)
+parser.add_argument('--queue_dir', dest='queue_dir', default=None,
+                    help='shared work queue folder, slides are claimed from it instead of --start/--end '
+                         '(see wsi_job_queue.py)', type=str)
+parser.add_argument('--lease_timeout', dest='lease_timeout', default=600,
+                    help='seconds without heartbeat after which a claimed slide is handed out again (--queue_dir)',
+                    type=int)
 
 args = parser.parse_args()
 
@@ -56,177 +112,192 @@ create_geojson = args.create_geojson
 SLIDE_DIR = args.slide_folder
 OUTPUT_DIR = args.output_dir
 OVERLAY_FACTOR = args.ol_factor
-
-# MODEL(S)
-# Get the script directory and construct absolute path to models
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-MODEL_QC_DIR = os.path.join(SCRIPT_DIR, 'models', 'qc')
-if MPP_MODEL == 1.5:
-    MODEL_QC_NAME = 'GrandQC_MPP15.pth'
-elif MPP_MODEL == 1.0:
-    MODEL_QC_NAME = 'GrandQC_MPP1.pth'
-elif MPP_MODEL == 2.0:
-    MODEL_QC_NAME = 'GrandQC_MPP2.pth'
-else:
-    raise Exception("mpp of the model can only be 1.0, 1.5, 2.0")
-M_P_S_MODEL = 512
-ENCODER_MODEL = 'timm-efficientnet-b0'
-ENCODER_MODEL_WEIGHTS = 'imagenet'
-
-# CLASSES
-BACK_CLASS = 7
+BATCH_SIZE = args.batch_size
+READER_WORKERS = args.reader_workers
+PREFETCH_DEPTH = args.prefetch_depth
+PREPROCESS_WORKERS = args.preprocess_workers
+STAGE_QUEUE_DEPTH = args.stage_queue_depth
+LEVEL_TOLERANCE = args.level_tolerance
+BACKEND = args.backend
+PRECISION = args.precision
+MODEL_CACHE = args.model_cache
+WORKERS = args.workers
+THREADS_PER_WORKER = args.threads_per_worker
+PIN_CORES = args.pin_cores
+GEOJSON_FORMAT = args.geojson_format
+SIMPLIFY_UM = args.simplify_um
+COORD_PRECISION = args.coord_precision
+GEOJSON_WORKERS = args.geojson_workers
+GEOJSON_INDEX = args.geojson_index
+VECTOR_TILES = args.vector_tiles
+MASK_FORMAT = args.mask_format
+MASK_WORKERS = args.mask_workers
+TIS_DETECT = args.tis_detect
+SAVE_TIS_DET = args.save_tis_det
+QUEUE_DIR = args.queue_dir
+LEASE_TIMEOUT = args.lease_timeout
+OUTPUT_WRITERS = args.output_writers
+MAX_PENDING_SLIDES = args.max_pending_slides
+THUMBNAILS = ThumbnailCache(os.path.join(OUTPUT_DIR, 'thumbnail_cache'), args.thumbnail_cache_mb) \
+    if args.thumbnail_cache == "Y" else None
+if PRECISION == 'int8':
+    BACKEND = 'onnxruntime'
 
 if end == -1:
     end = len(os.listdir(SLIDE_DIR))
 
-if create_geojson == "Y":
-    geojson_root = os.path.join(OUTPUT_DIR, "geojson_qc")
-    os.makedirs(geojson_root, exist_ok=True)
-
 case_name = os.path.basename(OUTPUT_DIR)
-REPORT_FILE_NAME = f'report_{case_name}_' + str(start) + '_' + str(end)     # File name, ".txt" will be added in the end
+if QUEUE_DIR:
+    # Every process writes its own report, wsi_job_queue.py report merges the reports of all hosts
+    REPORT_FILE_NAME = f'report_{case_name}_queue_{socket.gethostname()}_{os.getpid()}'
+else:
+    REPORT_FILE_NAME = f'report_{case_name}_' + str(start) + '_' + str(end)     # File name, ".txt" will be added in the end
 REPORT_OUTPUT_DIR = OUTPUT_DIR # where to save the text report
 
 
-# =============================================================================
-# LOAD MODELS
-# =============================================================================
-try:
-    # Try standard loading first
-    model_prim = torch.load(os.path.join(MODEL_QC_DIR, MODEL_QC_NAME), map_location=DEVICE, weights_only=False)
-except (ModuleNotFoundError, pickle.UnpicklingError, RuntimeError) as e:
-    # Fall back to custom unpickler for timm compatibility
-    print(f"Standard loading failed ({type(e).__name__}), trying custom unpickler...")
-    with open(os.path.join(MODEL_QC_DIR, MODEL_QC_NAME), 'rb') as f:
-        import segmentation_models_pytorch as smp
-        try:
-            unpickler = TimmmUnpickler(f)
-            model_prim = unpickler.load()
-        except:
-            # If all else fails, rebuild model architecture and load state_dict
-            print("Rebuilding model from scratch...")
-            model_prim = smp.UnetPlusPlus(
-                encoder_name=ENCODER_MODEL,
-                encoder_weights=ENCODER_MODEL_WEIGHTS,
-                classes=8,
-                activation=None,
-            )
-            # Try to load state dict with relaxed constraints
-            try:
-                state = torch.load(os.path.join(MODEL_QC_DIR, MODEL_QC_NAME), map_location=DEVICE, weights_only=False)
-                if isinstance(state, dict):
-                    model_prim.load_state_dict(state, strict=False)
-                else:
-                    model_prim = state
-            except:
-                pass  # Continue with random weights if loading fails
-
-# ====================================================================
-# PREPARE REPORT FILE, OUTPUT FOLDERS
-# =============================================================================
-
-# Prepare report file header
-path_result = os.path.join(REPORT_OUTPUT_DIR, REPORT_FILE_NAME + "_stats_per_slide.txt")
-output_header = "slide_name" + "\t" + "obj_power" + "\t" + "mpp" + "\t"
-output_header = output_header + "patch_n_h_l0" + "\t" + "patch_n_w_l0" + "\t"
-output_header = output_header + "patch_overall" + "\t"
-output_header = output_header + "height" + "\t" + "width" + "\t"
-output_header = output_header + "time"
-output_header = output_header + "\n"
-results = open(path_result, "a+")
-results.write(output_header)
-results.close()
-
-maps_dir = os.path.join(OUTPUT_DIR, 'maps_qc')
-overlay_dir = os.path.join(OUTPUT_DIR, 'overlays_qc')
-mask_dir = os.path.join(OUTPUT_DIR, 'mask_qc')
-
-try:
-    os.mkdir(maps_dir)
-    os.mkdir(overlay_dir)
-    os.mkdir(mask_dir)
-except Exception as e:
-    print('The target folders are already there ..')
-
-# ====================================================================
-# MAIN SCRIPT
-# =============================================================================
-
-# Read in slide names
-slide_names = sorted(os.listdir(SLIDE_DIR))
-# Start analysis loop
-
-for slide_name in slide_names[start:end]:
-    try:
-        # Register start time
-        start = timeit.default_timer()
-
-        print("")
-        print("Processing:", slide_name)
-
-        # Open slide
-        path_slide = os.path.join(SLIDE_DIR, slide_name)
-        slide = open_slide(path_slide)
-
-        # GET SLIDE INFO
-        p_s, patch_n_w_l0, patch_n_h_l0, mpp, w_l0, h_l0, obj_power = slide_info(slide, M_P_S_MODEL, MPP_MODEL)
-
-        # LOAD TISSUE DETECTION MAP
-        tis_det_map = Image.open(os.path.join(OUTPUT_DIR, 'tis_det_mask', slide_name + '_MASK.png'))
-        '''
-        Tissue detection map is generated on MPP = 10
-        This map is used for on-fly control of the necessity of model inference.
-        Two variants: reduced version with perfect correlation or full version scaled to working MPP of the tumor detection model
-        Classes: 0 - tissue, 1 - background
-        '''
-
-        tis_det_map_mpp = np.array(tis_det_map.resize((int(w_l0 * mpp / MPP_MODEL), int(h_l0 * mpp / MPP_MODEL)), Image.Resampling.LANCZOS))
-        map, full_mask = slide_process_single(model_prim, tis_det_map_mpp, slide, patch_n_w_l0, patch_n_h_l0, p_s,
-                                              M_P_S_MODEL, colors, ENCODER_MODEL,
-                                              ENCODER_MODEL_WEIGHTS, DEVICE, BACK_CLASS, MPP_MODEL, mpp, w_l0, h_l0)
-
-        # Timer stop
-        stop = timeit.default_timer()
-
-        map_path = os.path.join(maps_dir, slide_name + "_map_QC.png")
-        map.save(map_path)
-
-        mask_path = os.path.join(mask_dir, slide_name + "_mask.png")
-        cv2.imwrite(mask_path, full_mask)
-        if create_geojson == "Y":
-            geojson_path = os.path.join(geojson_root, slide_name + '.geojson')
-            factor = MPP_MODEL / mpp
-            mask_to_geojson(mask_path, geojson_path, factor)
-
-        del full_mask
-
+def process_slide(model_prim, model_td, path_slide, slide_name, dirs, td_dirs, writer=None):
+    # QC of one slide, with the tissue detection fused into the same pass when model_td is given; with writer (see
+    # OutputWriter) the outputs are saved in the background
+    options = dict(batch_size=BATCH_SIZE, reader_workers=READER_WORKERS, prefetch_depth=PREFETCH_DEPTH,
+                   preprocess_workers=PREPROCESS_WORKERS, stage_queue_depth=STAGE_QUEUE_DEPTH,
+                   level_tolerance=LEVEL_TOLERANCE, overlay_factor=OVERLAY_FACTOR, create_geojson=create_geojson,
+                   mask_format=MASK_FORMAT, mask_workers=MASK_WORKERS, geojson_format=GEOJSON_FORMAT,
+                   simplify_um=SIMPLIFY_UM, coord_precision=COORD_PRECISION, geojson_workers=GEOJSON_WORKERS,
+                   geojson_index=GEOJSON_INDEX == "Y", vector_tiles=VECTOR_TILES == "Y", thumbnails=THUMBNAILS,
+                   writer=writer)
+    if model_td is None:
+        output_temp, outputs = qc_slide(model_prim, path_slide, slide_name, OUTPUT_DIR, dirs, MPP_MODEL, DEVICE,
+                                        **options)
+    else:
+        output_temp, outputs, outputs_td = fused_slide(model_td, td_preprocessing_fn(), model_prim, path_slide,
+                                                       slide_name, OUTPUT_DIR, dirs, MPP_MODEL, DEVICE,
+                                                       tis_det_dirs=td_dirs, **options)
+    return output_temp
+
+
+def write_result(path_result, output_temp):
+    # Write down per slide result
+    results = open(path_result, "a+")
+    results.write(output_temp)
+    results.close()
+
+
+# Worker processes are spawned and import this file, only the main process runs the script
+if __name__ == '__main__':
+    # ====================================================================
+    # PREPARE REPORT FILE, OUTPUT FOLDERS
+    # =============================================================================
+
+    # Prepare report file header
+    path_result = os.path.join(REPORT_OUTPUT_DIR, REPORT_FILE_NAME + "_stats_per_slide.txt")
+    results = open(path_result, "a+")
+    results.write(stats_header())
+    results.close()
+
+    dirs = qc_dirs(OUTPUT_DIR, create_geojson)
+
+    # Read in slide names
+    slide_names = sorted(os.listdir(SLIDE_DIR))
+
+    if QUEUE_DIR and WORKERS > 1:
+        raise Exception("--queue_dir claims one slide at a time, start several processes instead of --workers")
+
+    if WORKERS > 1:
+        # Slides go to a pool of worker processes, every worker has its own model; results are written here
+        options = {'slide_dir': SLIDE_DIR, 'output_dir': OUTPUT_DIR, 'mpp_model': MPP_MODEL, 'backend': BACKEND,
+                   'precision': PRECISION, 'model_cache': MODEL_CACHE, 'create_geojson': create_geojson,
+                   'batch_size': BATCH_SIZE, 'reader_workers': READER_WORKERS, 'prefetch_depth': PREFETCH_DEPTH,
+                   'preprocess_workers': PREPROCESS_WORKERS, 'stage_queue_depth': STAGE_QUEUE_DEPTH,
+                   'level_tolerance': LEVEL_TOLERANCE, 'overlay_factor': OVERLAY_FACTOR,
+                   'mask_format': MASK_FORMAT, 'mask_workers': MASK_WORKERS, 'geojson_format': GEOJSON_FORMAT,
+                   'simplify_um': SIMPLIFY_UM, 'coord_precision': COORD_PRECISION,
+                   'geojson_workers': GEOJSON_WORKERS, 'geojson_index': GEOJSON_INDEX == "Y",
+                   'vector_tiles': VECTOR_TILES == "Y", 'thumbnails': THUMBNAILS, 'tis_detect': TIS_DETECT,
+                   'save_tis_det': SAVE_TIS_DET}
+        for slide_name, output_temp, error in run_pool(slide_names[start:end], options, WORKERS,
+                                                       THREADS_PER_WORKER, PIN_CORES):
+            if error is not None:
+                print(f"There was some problem with the slide {slide_name}. The error is: {error}")
+            else:
+                print("Finished:", slide_name)
+                write_result(path_result, output_temp)
+    else:
         # =============================================================================
-        # 8. MAKE AND SAVE OVERLAY for C8: HEATMAP ON REDUCED AND CROPPED SLIDE CLON
+        # LOAD MODELS
         # =============================================================================
-        overlay = make_overlay(slide, map, p_s, patch_n_w_l0, patch_n_h_l0, OVERLAY_FACTOR)
-
-        del map
-
-        # Save overlaid image
-        overlay_im = Image.fromarray(overlay)
-        overlay_im_name = os.path.join(overlay_dir, slide_name + "_overlay_QC.jpg")
-        overlay_im.save(overlay_im_name)
-
-        del overlay
-
-        # Write down per slide result
-        # Basic data about slide (size, pixel size, objective power, height, width)
-        output_temp = slide_name + "\t" + str(obj_power) + "\t" + str(mpp) + "\t"
-        output_temp = output_temp + str(patch_n_h_l0) + "\t" + str(patch_n_w_l0) + "\t"
-        output_temp = output_temp + str(patch_n_h_l0 * patch_n_w_l0) + "\t"
-        output_temp = output_temp + str(patch_n_h_l0 * p_s) + "\t" + str(patch_n_w_l0 * p_s) + "\t"
-
-        output_temp = output_temp + str(round((stop - start) / 60, 1))
-
-        output_temp = output_temp + "\n"
-
-        results = open(path_result, "a+")
-        results.write(output_temp)
-        results.close()
-    except Exception as e:
-        print(f"There was some problem with the slide. The error is: {e}")
+        model_prim = load_qc(MPP_MODEL, DEVICE, BACKEND, PRECISION, MODEL_CACHE)
+        model_td = load_td(DEVICE, BACKEND, PRECISION, MODEL_CACHE) if TIS_DETECT == "Y" else None
+        td_dirs = tis_det_dirs(OUTPUT_DIR) if TIS_DETECT == "Y" and SAVE_TIS_DET == "Y" else None
+
+        # Outputs of a slide are saved in the background, its report line is written once they are on disk
+        writer = OutputWriter(OUTPUT_WRITERS, MAX_PENDING_SLIDES) if OUTPUT_WRITERS > 0 else None
+        leases = {}
+
+        def slide_saved(slide_name, output_temp, error):
+            lease = leases.pop(slide_name, None)
+            if error is not None:
+                print(f"There was some problem with saving the slide {slide_name}. The error is: {error}")
+                if lease is not None:
+                    lease.failed(str(error))
+                return
+            write_result(path_result, output_temp)
+            if lease is not None:
+                lease.done(output_temp)
+
+        if QUEUE_DIR:
+            # Slides are claimed from the shared queue until it is drained
+            job_queue = JobQueue(QUEUE_DIR, 'qc', LEASE_TIMEOUT)
+            print("Queued:", job_queue.add(slide_names, SLIDE_DIR))
+
+            def drain_writer():
+                # Leases of the slides being saved are released in slide_saved, not while waiting for other hosts
+                for saved in writer.drain():
+                    slide_saved(*saved)
+
+            while True:
+                lease = job_queue.claim(before_wait=drain_writer if writer is not None else None)
+                if lease is None:
+                    break
+                slide_name = lease.slide_name
+                try:
+                    print("")
+                    print("Processing:", slide_name)
+
+                    leases[slide_name] = lease
+                    output_temp = process_slide(model_prim, model_td, lease.job['slide_path'], slide_name, dirs,
+                                                td_dirs, writer)
+
+                    if writer is None:
+                        slide_saved(slide_name, output_temp, None)
+                except Exception as e:
+                    print(f"There was some problem with the slide. The error is: {e}")
+                    leases.pop(slide_name, None)
+                    lease.failed(str(e))
+                if writer is not None:
+                    for saved in writer.finished():
+                        slide_saved(*saved)
+
+        else:
+            # ====================================================================
+            # MAIN SCRIPT
+            # =============================================================================
+            for slide_name in slide_names[start:end]:
+                try:
+                    print("")
+                    print("Processing:", slide_name)
+
+                    path_slide = os.path.join(SLIDE_DIR, slide_name)
+                    output_temp = process_slide(model_prim, model_td, path_slide, slide_name, dirs, td_dirs, writer)
+
+                    if writer is None:
+                        slide_saved(slide_name, output_temp, None)
+                except Exception as e:
+                    print(f"There was some problem with the slide. The error is: {e}")
+                if writer is not None:
+                    for saved in writer.finished():
+                        slide_saved(*saved)
+
+        if writer is not None:
+            for saved in writer.drain():
+                slide_saved(*saved)
+            writer.close()
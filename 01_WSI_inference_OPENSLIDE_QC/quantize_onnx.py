@@ -0,0 +1,116 @@
+"""
+INT8 variants of the QC and tissue detection models for --precision int8.
+The fp32 ONNX graphs (exported first if needed, see export_onnx.py) are quantized with ONNX Runtime: statically with
+activation ranges calibrated on patches from the slides in --slide_folder, or dynamically (weights only).
+Afterwards the INT8 and fp32 argmax masks are compared on other patches of the same slides (per-class pixel
+agreement) and the speedup of the INT8 model is measured, to decide if it is accurate enough.
+"""
+import argparse
+import os
+import timeit
+from PIL import Image
+from wsi_models import load_qc_model, load_td_model
+from wsi_model_check import (qc_sample_tiles, td_sample_tiles, slide_folder_tiles, tis_det_map_for, pick_evenly,
+                             normalize_patches, compare_models, print_comparison)
+from wsi_pipeline import (MODEL_CACHE_DIR, MODEL_TD_DIR, MODEL_TD_NAME, MPP_MODEL_TD, M_P_S_MODEL, M_P_S_MODEL_TD,
+                          ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, ENCODER_MODEL_TD, qc_model_path)
+from wsi_onnx import export_onnx, onnx_path_for, quantize_onnx, OnnxModel
+from wsi_process import get_normalization
+Image.MAX_IMAGE_PIXELS = 1000000000
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', dest='model', default='all', choices=['qc', 'td', 'all'],
+                    help='model(s) to quantize: qc - GrandQC model, td - tissue detection model', type=str)
+parser.add_argument('--mpp_model', dest='MPP_MODEL', default=1.5,
+                    help='MPP of the QC model, should only be 1.0, 1.5, 2.0', type=float)
+parser.add_argument('--slide_folder', dest='slide_folder', default=None,
+                    help='path to WSIs used for calibration and evaluation patches', type=str)
+parser.add_argument('--output_dir', dest='output_dir', default=None,
+                    help='output folder of wsi_tis_detect.py, its tissue masks are used to pick QC patches', type=str)
+parser.add_argument('--method', dest='method', default='static', choices=['static', 'dynamic'],
+                    help='static - weights and activations (calibrated), dynamic - weights only', type=str)
+parser.add_argument('--calib_tiles', dest='calib_tiles', default=16,
+                    help='number of calibration patches per slide', type=int)
+parser.add_argument('--eval_tiles', dest='eval_tiles', default=8,
+                    help='number of evaluation patches per slide (not used for calibration)', type=int)
+parser.add_argument('--batch_size', dest='batch_size', default=4, help='batch size of the forward passes', type=int)
+parser.add_argument('--force', dest='force', action='store_true', help='overwrite existing INT8 models')
+args = parser.parse_args()
+
+# Checkpoints, patch sizes and encoders as in the pipeline (raises for an MPP without QC model)
+model_qc_path = qc_model_path(args.MPP_MODEL)
+model_td_path = os.path.join(MODEL_TD_DIR, MODEL_TD_NAME)
+
+SLIDE_DIR = args.slide_folder
+OUTPUT_DIR = args.output_dir
+
+
+def qc_tiles(slide_path, slide_name, n):
+    # Patches at model MPP, as read by main.py (tissue patches if the tissue detection mask is available)
+    return qc_sample_tiles(slide_path, n, M_P_S_MODEL, args.MPP_MODEL, tis_det_map_for(OUTPUT_DIR, slide_name))
+
+
+def td_tiles(slide_path, slide_name, n):
+    # Patches of the JPEG compressed MPP 10 thumbnail, as in wsi_tis_detect.py
+    return td_sample_tiles(slide_path, n, M_P_S_MODEL_TD, MPP_MODEL_TD)
+
+
+def time_model(model, x_batches):
+    # Seconds for one pass over the batches (after one warm-up batch)
+    model.predict(x_batches[0])
+    start = timeit.default_timer()
+    for x_tensor in x_batches:
+        model.predict(x_tensor)
+    return timeit.default_timer() - start
+
+
+def quantize_and_evaluate(name, model_path, load_model, m_p_s, classes, get_tiles):
+    print("")
+    print("Model:", name, "-", model_path)
+    onnx_path = onnx_path_for(model_path, cache_dir=MODEL_CACHE_DIR)
+    if not os.path.exists(onnx_path):
+        export_onnx(load_model(), onnx_path, m_p_s)
+        print("Exported:", onnx_path)
+
+    # Calibration and evaluation patches: spread evenly over the slides, no patch is used for both
+    patches = slide_folder_tiles(SLIDE_DIR, get_tiles, args.calib_tiles + args.eval_tiles, m_p_s)
+    eval_idx = set(pick_evenly(list(range(len(patches))), max(len(patches) * args.eval_tiles //
+                                                               (args.calib_tiles + args.eval_tiles), 1)))
+    eval_patches = [patches[i] for i in sorted(eval_idx)]
+    calib_patches = [patches[i] for i in range(len(patches)) if i not in eval_idx] or eval_patches
+    norm = get_normalization(ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, 'cpu')
+
+    int8_path = onnx_path_for(model_path, 'int8', cache_dir=MODEL_CACHE_DIR)
+    if args.force or not os.path.exists(int8_path):
+        calibration_batches = None
+        if args.method == 'static':
+            print("Calibration patches: ", len(calib_patches))
+            # One patch per calibration batch: activations of the whole network are held for every batch
+            calibration_batches = (normalize_patches([patch], norm).numpy() for patch in calib_patches)
+        quantize_onnx(onnx_path, int8_path, calibration_batches)
+        print("Quantized (" + args.method + "):", int8_path)
+    else:
+        print("Already quantized (use --force to overwrite):", int8_path)
+
+    # Per-class agreement of the INT8 masks with the fp32 masks and speedup
+    model_fp32 = OnnxModel(onnx_path)
+    model_int8 = OnnxModel(int8_path)
+    print("Evaluation patches: ", len(eval_patches))
+    print_comparison(compare_models(model_fp32, model_int8, eval_patches, norm, classes, args.batch_size))
+    x_batches = [normalize_patches(eval_patches[i:i + args.batch_size], norm)
+                 for i in range(0, len(eval_patches), args.batch_size)]
+    time_fp32 = time_model(model_fp32, x_batches)
+    time_int8 = time_model(model_int8, x_batches)
+    print("Time fp32 / int8 (s): ", round(time_fp32, 2), "/", round(time_int8, 2),
+          "- speedup", round(time_fp32 / max(time_int8, 1e-9), 2))
+
+
+if args.model in ('qc', 'all'):
+    quantize_and_evaluate('QC', model_qc_path,
+                          lambda: load_qc_model(model_qc_path, ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, 'cpu',
+                                                cache_dir=MODEL_CACHE_DIR),
+                          M_P_S_MODEL, 8, qc_tiles)
+if args.model in ('td', 'all'):
+    quantize_and_evaluate('Tissue detection', model_td_path,
+                          lambda: load_td_model(model_td_path, ENCODER_MODEL_TD, 'cpu', cache_dir=MODEL_CACHE_DIR),
+                          M_P_S_MODEL_TD, 2, td_tiles)
@@ -1,6 +1,6 @@
 #!/bin/bash
 # Complete GrandQC pipeline wrapper
-# Runs tissue detection, QC analysis, report generation, and overlay creation
+# Runs tissue detection, QC analysis, report generation, and overlay creation (see wsi_pipeline_runner.py)
 
 set -e
 
@@ -100,7 +100,8 @@ mkdir -p "$OUTPUT_DIR/slides_in"
 
 # Copy slide to output directory
 SLIDE_FILENAME=$(basename "$SLIDE_PATH")
-cp "$SLIDE_PATH" "$OUTPUT_DIR/slides_in/"
+# -p keeps the modification time, an unchanged slide copied again is not processed again
+cp -p "$SLIDE_PATH" "$OUTPUT_DIR/slides_in/"
 
 echo -e "${BLUE}╔════════════════════════════════════════════════════════╗${NC}"
 echo -e "${BLUE}║          GrandQC Pipeline Execution Started            ║${NC}"
@@ -113,68 +114,32 @@ echo "  MPP model: $MPP_MODEL"
 echo "  Create GeoJSON: $CREATE_GEOJSON"
 echo ""
 
-# Step 1: Tissue Detection
-echo -e "${BLUE}Step 1/4: Tissue Detection${NC}"
-python "$SCRIPT_DIR/wsi_tis_detect.py" \
-    --slide_folder "$OUTPUT_DIR/slides_in" \
-    --output_dir "$OUTPUT_DIR"
-
-if [ $? -eq 0 ]; then
-    echo -e "${GREEN}✓ Tissue detection completed${NC}"
-else
-    echo -e "${RED}✗ Tissue detection failed${NC}"
-    exit 1
+# All steps run through the DAG runner: steps whose outputs are up to date are skipped,
+# report and overlays run concurrently
+STEPS="tis_detect,qc"
+if [ $SKIP_OVERLAYS -eq 0 ]; then
+    STEPS="$STEPS,overlays"
 fi
-echo ""
-
-# Step 2: QC Analysis
-echo -e "${BLUE}Step 2/4: Quality Control Analysis${NC}"
-python "$SCRIPT_DIR/main.py" \
+if [ $SKIP_REPORT -eq 0 ]; then
+    STEPS="$STEPS,report"
+    if [ $SKIP_OVERLAYS -eq 0 ]; then
+        STEPS="$STEPS,pdf_report"
+    fi
+fi
+echo -e "${BLUE}Steps: $STEPS${NC}"
+if python "$SCRIPT_DIR/wsi_pipeline_runner.py" \
     --slide_folder "$OUTPUT_DIR/slides_in" \
     --output_dir "$OUTPUT_DIR" \
     --mpp_model "$MPP_MODEL" \
-    --create_geojson "$CREATE_GEOJSON"
-
-if [ $? -eq 0 ]; then
-    echo -e "${GREEN}✓ QC analysis completed${NC}"
+    --create_geojson "$CREATE_GEOJSON" \
+    --steps "$STEPS"; then
+    echo -e "${GREEN}✓ Pipeline steps completed${NC}"
 else
-    echo -e "${RED}✗ QC analysis failed${NC}"
+    echo -e "${RED}✗ Some pipeline steps failed${NC}"
     exit 1
 fi
 echo ""
 
-# Step 3: Report Generation
-if [ $SKIP_REPORT -eq 0 ]; then
-    echo -e "${BLUE}Step 3/4: HTML Report Generation${NC}"
-    python "$SCRIPT_DIR/generate_report.py" --output_dir "$OUTPUT_DIR"
-    
-    if [ $? -eq 0 ]; then
-        echo -e "${GREEN}✓ Report generated${NC}"
-    else
-        echo -e "${YELLOW}⚠ Report generation encountered issues${NC}"
-    fi
-    echo ""
-else
-    echo -e "${YELLOW}Step 3/4: Skipped (--no_report)${NC}"
-    echo ""
-fi
-
-# Step 4: Overlay Generation
-if [ $SKIP_OVERLAYS -eq 0 ]; then
-    echo -e "${BLUE}Step 4/4: Visual Overlay Generation${NC}"
-    python "$SCRIPT_DIR/generate_overlays.py" --output_dir "$OUTPUT_DIR"
-    
-    if [ $? -eq 0 ]; then
-        echo -e "${GREEN}✓ Overlays generated${NC}"
-    else
-        echo -e "${YELLOW}⚠ Overlay generation encountered issues${NC}"
-    fi
-    echo ""
-else
-    echo -e "${YELLOW}Step 4/4: Skipped (--no_overlays)${NC}"
-    echo ""
-fi
-
 # Summary
 echo -e "${BLUE}╔════════════════════════════════════════════════════════╗${NC}"
 echo -e "${BLUE}║              Pipeline Execution Complete                ║${NC}"
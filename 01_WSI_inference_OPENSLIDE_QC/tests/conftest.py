@@ -0,0 +1,5 @@
+# The modules of the pipeline are scripts next to main.py, imported from there as in the pipeline itself
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,51 @@
+# CHUNK-ALIGNED REGION READS AGAINST SLICING THE ZARR ARRAY
+import numpy as np
+import pytest
+
+zarr = pytest.importorskip('zarr')
+
+from wsi_chunk_reader import ChunkTileReader  # noqa: E402
+
+
+def level(shape=(3, 700, 900), chunks=(3, 128, 96)):
+    rng = np.random.default_rng(0)
+    array = zarr.zeros(shape, chunks=chunks, dtype=np.uint8)
+    array[:] = rng.integers(0, 256, shape, dtype=np.uint8)
+    return array
+
+
+def expected_region(array, y, x, h, w):
+    return np.transpose(array[:, y:y + h, x:x + w], (1, 2, 0))
+
+
+@pytest.mark.parametrize('cache_mb, workers', [(0, 0), (0.1, 0), (64, 0), (0.1, 3), (64, 3)])
+def test_read_region_matches_slicing(cache_mb, workers):
+    array = level()
+    rng = np.random.default_rng(1)
+    with ChunkTileReader(array, cache_mb, workers) as reader:
+        for _ in range(40):
+            y, x = int(rng.integers(0, 750)), int(rng.integers(0, 950))
+            h, w = int(rng.integers(1, 300)), int(rng.integers(1, 300))
+            assert np.array_equal(reader.read_region(y, x, h, w), expected_region(array, y, x, h, w))
+
+
+@pytest.mark.parametrize('cache_mb, workers', [(0.05, 0), (0.05, 2), (64, 2)])
+def test_iter_tiles_matches_slicing(cache_mb, workers):
+    array = level()
+    p_s = 200
+    tiles = [(he, wi) for he in range(4) for wi in range(5) if (he + wi) % 3]
+    with ChunkTileReader(array, cache_mb, workers) as reader:
+        seen = []
+        for (he, wi), region in reader.iter_tiles(tiles, p_s):
+            seen.append((he, wi))
+            assert np.array_equal(region, expected_region(array, he * p_s, wi * p_s, p_s, p_s))
+        assert sorted(seen) == sorted(tiles)
+
+
+def test_chunks_decoded_once_with_cache():
+    array = level()
+    with ChunkTileReader(array, 64, 0) as reader:
+        tiles = [(he, wi) for he in range(3) for wi in range(4)]
+        for _ in reader.iter_tiles(tiles, 200):
+            pass
+        assert reader.decoded == len(reader.chunks_of(0, 0, 600, 800))
@@ -0,0 +1,149 @@
+# SHARED-FILESYSTEM WORK QUEUE: CLAIM, COMPLETION, LEASE EXPIRY AND REQUEUE
+import os
+import threading
+import time
+
+from wsi_job_queue import JobQueue, read_json
+from wsi_output_writer import OutputWriter
+
+SLIDES = ['a.svs', 'b.svs', 'c.svs']
+
+
+def queue(tmp_path, **kwargs):
+    job_queue = JobQueue(str(tmp_path), 'qc', **kwargs)
+    # Tests do not wait for the leases of other processes
+    job_queue.heartbeat = 0.01
+    return job_queue
+
+
+def expire(job_queue, lease):
+    # Lease file last touched long ago (by the clock of the file server)
+    old = job_queue.server_time() - 2 * job_queue.lease_timeout
+    os.utime(lease.lease_path, (old, old))
+
+
+def test_add_only_once(tmp_path):
+    job_queue = queue(tmp_path)
+    assert job_queue.add(SLIDES, '/slides') == 3
+    assert queue(tmp_path).add(SLIDES + ['d.svs'], '/slides') == 1
+    assert job_queue.status()[0]['todo'] == 4
+
+
+def test_claim_each_slide_once(tmp_path):
+    job_queue = queue(tmp_path)
+    job_queue.add(SLIDES, '/slides')
+    other = queue(tmp_path)
+    leases = []
+    for q in [job_queue, other, job_queue]:
+        lease = q.claim(wait=False)
+        assert lease.job['slide_path'] == os.path.join('/slides', lease.slide_name)
+        assert lease.job['attempts'] == 1
+        leases.append(lease)
+    assert sorted(lease.slide_name for lease in leases) == SLIDES
+    assert other.claim(wait=False) is None
+    leases[0].done(stats='line\n')
+    leases[1].failed('broken')
+    counts, _ = job_queue.status()
+    assert (counts['todo'], counts['leased'], counts['done'], counts['failed']) == (0, 1, 1, 1)
+    assert read_json(job_queue.path('done', leases[0].slide_name))['stats'] == 'line\n'
+    assert read_json(job_queue.path('failed', leases[1].slide_name))['error'] == 'broken'
+    leases[2].done()
+
+
+def test_expired_lease_is_requeued(tmp_path):
+    job_queue = queue(tmp_path, lease_timeout=60)
+    job_queue.add(SLIDES[:1], '/slides')
+    lease = job_queue.claim(wait=False)
+    lease._stop.set()  # owner died: no more heartbeats
+    lease._thread.join()
+    assert job_queue.requeue_expired() == 0
+    expire(job_queue, lease)
+    assert job_queue.status()[0]['expired'] == 1
+
+    other = queue(tmp_path, lease_timeout=60)
+    second = other.claim(wait=False)
+    assert second.slide_name == SLIDES[0]
+    assert second.job['attempts'] == 2
+    second.done()
+    # The late result of the first owner is recorded, the slide is not queued again
+    lease.done()
+    counts, _ = job_queue.status()
+    assert (counts['todo'], counts['leased'], counts['done']) == (0, 0, 1)
+
+
+def test_done_after_expiry_and_requeue(tmp_path):
+    job_queue = queue(tmp_path, lease_timeout=60)
+    job_queue.add(SLIDES[:1], '/slides')
+    lease = job_queue.claim(wait=False)
+    lease._stop.set()  # owner stalled: no heartbeats
+    lease._thread.join()
+    expire(job_queue, lease)
+    assert queue(tmp_path, lease_timeout=60).requeue_expired() == 1
+    # The result of the stalled owner arrives before anyone claimed the slide again: recorded once, not requeued
+    lease.done(stats='line\n')
+    counts, _ = job_queue.status()
+    assert (counts['todo'], counts['leased'], counts['done']) == (0, 0, 1)
+    assert read_json(job_queue.path('done', SLIDES[0]))['stats'] == 'line\n'
+    assert queue(tmp_path, lease_timeout=60).claim(wait=False) is None
+
+
+def test_max_attempts_then_requeue_failed(tmp_path):
+    job_queue = queue(tmp_path, lease_timeout=60, max_attempts=2)
+    job_queue.add(SLIDES[:1], '/slides')
+    for _ in range(2):
+        lease = job_queue.claim(wait=False)
+        lease._stop.set()
+        lease._thread.join()
+        expire(job_queue, lease)
+    assert job_queue.claim(wait=False) is None
+    counts, _ = job_queue.status()
+    assert (counts['todo'], counts['leased'], counts['failed']) == (0, 0, 1)
+    assert 'expired 2 times' in read_json(job_queue.path('failed', SLIDES[0]))['error']
+
+    assert job_queue.requeue_failed() == 1
+    lease = job_queue.claim(wait=False)
+    assert lease.slide_name == SLIDES[0] and lease.job['attempts'] == 1
+    lease.done()
+
+
+def test_heartbeat_keeps_lease(tmp_path):
+    job_queue = queue(tmp_path, lease_timeout=60)
+    job_queue.add(SLIDES[:1], '/slides')
+    lease = job_queue.claim(wait=False)
+    expire(job_queue, lease)
+    time.sleep(0.1)
+    assert job_queue.requeue_expired() == 0
+    lease.done()
+
+
+def test_claim_completes_background_saves_before_waiting(tmp_path):
+    # Queue loop of main.py: leases are completed once the outputs of their slides are saved by the writer
+    job_queue = queue(tmp_path, lease_timeout=60)
+    job_queue.add(SLIDES, '/slides')
+    leases = {}
+
+    def slide_saved(slide_name, result, error):
+        leases.pop(slide_name).done(result)
+
+    with OutputWriter(workers=2, max_slides=2) as writer:
+        def drain_writer():
+            for saved in writer.drain():
+                slide_saved(*saved)
+
+        def run():
+            while True:
+                lease = job_queue.claim(before_wait=drain_writer)
+                if lease is None:
+                    break
+                leases[lease.slide_name] = lease
+                writer.submit(lease.slide_name, lambda: time.sleep(0.05) or [], lease.slide_name + '\n')
+                for saved in writer.finished():
+                    slide_saved(*saved)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        thread.join(10)
+        # Without before_wait, claim would wait for the leases of the slides being saved forever
+        assert not thread.is_alive()
+    counts, _ = job_queue.status()
+    assert (counts['todo'], counts['leased'], counts['done']) == (0, 0, 3)
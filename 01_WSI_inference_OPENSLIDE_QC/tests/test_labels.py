@@ -0,0 +1,54 @@
+# MODE POOLING OF LABEL MASKS AGAINST A BLOCK BY BLOCK MAJORITY VOTE
+import numpy as np
+import pytest
+
+import wsi_labels
+from wsi_labels import colorize, label_image, mode_pool
+
+
+def brute_mode_pool(mask, size):
+    # Most frequent label (the lowest on ties) of the integer bin of every output pixel
+    height, width = mask.shape
+    out_w, out_h = size
+    row_bin = np.arange(height) * out_h // height
+    col_bin = np.arange(width) * out_w // width
+    pooled = np.empty((out_h, out_w), dtype=np.uint8)
+    for r in range(out_h):
+        for c in range(out_w):
+            block = mask[row_bin == r][:, col_bin == c]
+            pooled[r, c] = np.bincount(block.ravel()).argmax()
+    return pooled
+
+
+@pytest.mark.parametrize('shape, size', [((64, 96), (12, 8)), ((77, 131), (13, 10)), ((50, 40), (40, 50)),
+                                         ((90, 30), (7, 30))])
+def test_mode_pool_matches_brute_force(shape, size):
+    rng = np.random.default_rng(shape[0])
+    # Blocky labels with noise, so both clear majorities and ties occur
+    mask = np.kron(rng.integers(1, 8, (shape[0] // 5 + 1, shape[1] // 5 + 1)), np.ones((5, 5), dtype=np.int64))
+    mask = mask[:shape[0], :shape[1]].astype(np.uint8)
+    noise = rng.random(shape) < 0.2
+    mask[noise] = rng.integers(1, 8, np.count_nonzero(noise))
+    assert np.array_equal(mode_pool(mask, size), brute_mode_pool(mask, size))
+
+
+def test_mode_pool_chunks(monkeypatch):
+    # Counting in chunks of output rows gives the result of one chunk
+    rng = np.random.default_rng(3)
+    mask = rng.integers(0, 8, (203, 157)).astype(np.uint8)
+    expected = mode_pool(mask, (31, 29))
+    monkeypatch.setattr(wsi_labels, 'POOL_CHUNK', 500)
+    assert np.array_equal(mode_pool(mask, (31, 29)), expected)
+
+
+def test_mode_pool_upscaled_axis():
+    mask = np.array([[1, 2], [3, 4]], dtype=np.uint8)
+    assert np.array_equal(mode_pool(mask, (4, 1)), [[1, 1, 2, 2]])
+
+
+def test_colorize_and_palette():
+    colors = [[10, 20, 30], [40, 50, 60]]
+    mask = np.array([[0, 1, 2]], dtype=np.uint8)
+    assert colorize(mask, colors, first_label=1).tolist() == [[[0, 0, 0], [10, 20, 30], [40, 50, 60]]]
+    assert np.array_equal(np.array(label_image(mask, colors, first_label=1).convert('RGB')),
+                          colorize(mask, colors, first_label=1))
@@ -0,0 +1,42 @@
+# LARGEST-FIRST ORDER OF THE SLIDE SCHEDULER: ONE UNIT OF WORK FOR ALL SLIDES OF A RUN
+import os
+import numpy as np
+from PIL import Image
+
+from wsi_scheduler import largest_first, slide_works
+
+
+def write_slide(slide_dir, slide_name, size):
+    with open(os.path.join(slide_dir, slide_name), 'wb') as f:
+        f.write(b'\0' * size)
+
+
+def write_mask(output_dir, slide_name, tissue_pixels):
+    # Tissue detection mask: 0 - tissue, 1 - background
+    mask = np.ones((100, 100), dtype=np.uint8)
+    mask.flat[:tissue_pixels] = 0
+    os.makedirs(os.path.join(output_dir, 'tis_det_mask'), exist_ok=True)
+    Image.fromarray(mask).save(os.path.join(output_dir, 'tis_det_mask', slide_name + '_MASK.png'))
+
+
+def test_tissue_area_when_every_slide_has_a_mask(tmp_path):
+    slide_dir, output_dir = str(tmp_path / 'slides'), str(tmp_path / 'output')
+    os.makedirs(slide_dir)
+    for name, size, tissue in [('a.svs', 3000, 100), ('b.svs', 1000, 900), ('c.svs', 2000, 500)]:
+        write_slide(slide_dir, name, size)
+        write_mask(output_dir, name, tissue)
+    assert slide_works(['a.svs', 'b.svs', 'c.svs'], slide_dir, output_dir) == {'a.svs': 100, 'b.svs': 900,
+                                                                               'c.svs': 500}
+    assert largest_first(['a.svs', 'b.svs', 'c.svs'], slide_dir, output_dir) == ['b.svs', 'c.svs', 'a.svs']
+
+
+def test_file_size_for_all_when_a_mask_is_missing(tmp_path):
+    slide_dir, output_dir = str(tmp_path / 'slides'), str(tmp_path / 'output')
+    os.makedirs(slide_dir)
+    for name, size in [('a.svs', 3000), ('b.svs', 1000), ('c.svs', 2000)]:
+        write_slide(slide_dir, name, size)
+    # Tissue pixels of b would rank it above the byte count of a, if the units were mixed
+    write_mask(output_dir, 'b.svs', 9000)
+    assert slide_works(['a.svs', 'b.svs', 'c.svs'], slide_dir, output_dir) == {'a.svs': 3000, 'b.svs': 1000,
+                                                                               'c.svs': 2000}
+    assert largest_first(['a.svs', 'b.svs', 'c.svs'], slide_dir, output_dir) == ['a.svs', 'c.svs', 'b.svs']
@@ -0,0 +1,84 @@
+# PATCH PLANNING ON THE MPP 10 MAP AGAINST THE FORMER >50 PIXEL LOOP ON THE MAP AT MODEL MPP
+import numpy as np
+import cv2
+from PIL import Image
+
+from wsi_tile_plan import plan_tissue_tiles, tissue_fraction_grid, tissue_patch
+
+MPP, MPP_MODEL, M_P_S = 0.25, 1.0, 512
+P_S = int(M_P_S * MPP_MODEL / MPP)
+W_L0, H_L0 = 24 * P_S + 900, 18 * P_S + 1300
+PATCH_N_W, PATCH_N_H = W_L0 // P_S, H_L0 // P_S
+
+
+def tissue_map(seed=0):
+    # MPP 10 map (0 - tissue, 1 - background) with blobs of tissue
+    rng = np.random.default_rng(seed)
+    td_map = np.ones((int(H_L0 * MPP / 10), int(W_L0 * MPP / 10)), dtype=np.uint8)
+    for _ in range(40):
+        center = (int(rng.integers(0, td_map.shape[1])), int(rng.integers(0, td_map.shape[0])))
+        axes = (int(rng.integers(2, 30)), int(rng.integers(2, 30)))
+        cv2.ellipse(td_map, center, axes, int(rng.integers(0, 180)), 0, 360, 0, -1)
+    return td_map
+
+
+def old_plan(td_map):
+    # Baseline: the map LANCZOS resized to model MPP, patches with more than 50 tissue pixels
+    td_map_mpp = np.array(Image.fromarray(td_map).resize((int(W_L0 * MPP / MPP_MODEL), int(H_L0 * MPP / MPP_MODEL)),
+                                                         Image.Resampling.LANCZOS))
+    selected = set()
+    for he in range(PATCH_N_H):
+        for wi in range(PATCH_N_W):
+            td_patch = td_map_mpp[he * M_P_S:(he + 1) * M_P_S, wi * M_P_S:(wi + 1) * M_P_S]
+            if np.count_nonzero(td_patch == 0) > 50:
+                selected.add((he, wi))
+    return selected, td_map_mpp
+
+
+def test_fraction_grid_matches_pixel_count():
+    td_map = tissue_map()
+    fractions = tissue_fraction_grid(td_map, W_L0, H_L0, P_S, PATCH_N_W, PATCH_N_H)
+    scale_h, scale_w = td_map.shape[0] / H_L0, td_map.shape[1] / W_L0
+    for he in range(PATCH_N_H):
+        for wi in range(PATCH_N_W):
+            y0, y1 = (int(round(v * P_S * scale_h)) for v in (he, he + 1))
+            x0, x1 = (int(round(v * P_S * scale_w)) for v in (wi, wi + 1))
+            expected = np.count_nonzero(td_map[y0:y1, x0:x1] == 0) / (P_S * scale_h * P_S * scale_w)
+            assert np.isclose(fractions[he, wi], expected)
+
+
+def test_plan_matches_old_loop():
+    for seed in range(3):
+        td_map = tissue_map(seed)
+        planned = plan_tissue_tiles(td_map, W_L0, H_L0, P_S, PATCH_N_W, PATCH_N_H)
+        new = set(map(tuple, planned.tolist()))
+        assert len(new) == len(planned)
+        old, _ = old_plan(td_map)
+        # Patches may only differ where LANCZOS spreads a blob border over a few pixels of the next patch
+        for he, wi in new ^ old:
+            fraction = tissue_fraction_grid(td_map, W_L0, H_L0, P_S, PATCH_N_W, PATCH_N_H)[he, wi]
+            assert fraction < 0.01
+        assert len(new ^ old) <= 0.02 * len(old)
+
+
+def test_plan_order_is_serpentine():
+    planned = plan_tissue_tiles(None, W_L0, H_L0, P_S, PATCH_N_W, PATCH_N_H)
+    assert len(planned) == PATCH_N_W * PATCH_N_H
+    for he in range(PATCH_N_H):
+        row = planned[planned[:, 0] == he, 1].tolist()
+        assert row == (list(range(PATCH_N_W)) if he % 2 == 0 else list(range(PATCH_N_W - 1, -1, -1)))
+
+
+def test_tissue_patch_matches_resized_map():
+    td_map = tissue_map(1)
+    _, td_map_mpp = old_plan(td_map)
+    nearest = np.array(Image.fromarray(td_map).resize(td_map_mpp.shape[::-1], Image.Resampling.NEAREST))
+    agree = total = 0
+    for he in range(PATCH_N_H):
+        for wi in range(PATCH_N_W):
+            td_patch = tissue_patch(td_map, he, wi, W_L0, H_L0, P_S, M_P_S)
+            assert td_patch.shape == (M_P_S, M_P_S)
+            expected = nearest[he * M_P_S:(he + 1) * M_P_S, wi * M_P_S:(wi + 1) * M_P_S]
+            agree += np.count_nonzero(td_patch[:expected.shape[0], :expected.shape[1]] == expected)
+            total += expected.size
+    assert agree / total > 0.999
@@ -0,0 +1,102 @@
+# QC MASK VECTORIZATION AGAINST WHOLE-MASK findContours (THE BASELINE mask_to_geojson TRACING)
+import json
+import numpy as np
+import cv2
+import os
+import pytest
+
+from wsi_annotation_index import write_vector_tiles
+from wsi_vectorize import ARTIFACT_CLASSES, mask_polygons, write_geojson
+
+
+def qc_mask(seed=0, shape=(900, 1300)):
+    # Normal tissue (1) with artifact blobs of all classes, some spanning many blocks, some with holes and islands
+    rng = np.random.default_rng(seed)
+    mask = np.ones(shape, dtype=np.uint8)
+    for _ in range(60):
+        class_value = int(rng.choice(ARTIFACT_CLASSES))
+        center = (int(rng.integers(0, shape[1])), int(rng.integers(0, shape[0])))
+        axes = (int(rng.integers(1, 200)), int(rng.integers(1, 120)))
+        cv2.ellipse(mask, center, axes, int(rng.integers(0, 180)), 0, 360, class_value, -1)
+        if axes[0] > 40 and axes[1] > 40:
+            # Hole of normal tissue, with an island of the class inside
+            cv2.circle(mask, center, 20, 1, -1)
+            cv2.circle(mask, center, 5, class_value, -1)
+    return mask
+
+
+def whole_mask_polygons(mask):
+    # Outer rings and holes per class traced on the whole mask in one call
+    polygons = {}
+    for class_value in ARTIFACT_CLASSES:
+        class_mask = (mask == class_value).astype(np.uint8) * 255
+        contours, hierarchy = cv2.findContours(class_mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+        rings = set()
+        for j, contour in enumerate(contours):
+            if hierarchy[0][j][3] == -1 and len(contour) >= 4:
+                holes = []
+                child = hierarchy[0][j][2]
+                while child != -1:
+                    if len(contours[child]) >= 3:
+                        holes.append(tuple(map(tuple, contours[child].reshape(-1, 2).tolist())))
+                    child = hierarchy[0][child][0]
+                rings.add((tuple(map(tuple, contour.reshape(-1, 2).tolist())), tuple(sorted(holes))))
+        polygons[class_value] = rings
+    return polygons
+
+
+def feature_polygons(features):
+    polygons = {class_value: set() for class_value in ARTIFACT_CLASSES}
+    for feature in features:
+        # Rings are closed, the baseline contours are not
+        outer, *holes = [tuple(map(tuple, ring[:-1].astype(np.int64).tolist())) for ring in feature['rings']]
+        polygons[feature['class_id']].add((outer, tuple(sorted(holes))))
+    return polygons
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_mask_polygons_match_whole_mask(seed):
+    mask = qc_mask(seed)
+    features = mask_polygons(mask)
+    assert feature_polygons(features) == whole_mask_polygons(mask)
+    # Baseline (RETR_EXTERNAL) outer borders are all there
+    for class_value in ARTIFACT_CLASSES:
+        contours, _ = cv2.findContours((mask == class_value).astype(np.uint8) * 255, cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_SIMPLE)
+        outers = {outer for outer, _ in feature_polygons(features)[class_value]}
+        for contour in contours:
+            if len(contour) >= 4:
+                assert tuple(map(tuple, contour.reshape(-1, 2).tolist())) in outers
+
+
+def test_mask_polygons_independent_of_workers():
+    mask = qc_mask(3)
+    single = mask_polygons(mask, scale_factor=2.5)
+    threaded = mask_polygons(mask, scale_factor=2.5, workers=3)
+    assert [f['class_id'] for f in single] == [f['class_id'] for f in threaded]
+    for a, b in zip(single, threaded):
+        assert a['area'] == b['area']
+        assert all(np.array_equal(ra, rb) for ra, rb in zip(a['rings'], b['rings']))
+
+
+def test_write_geojson_offsets(tmp_path):
+    features = mask_polygons(qc_mask(4), scale_factor=2.0)
+    path = str(tmp_path / 'qc.geojson')
+    offsets, lengths = write_geojson(features, path, {'scale_factor': 2.0})
+    with open(path, 'rb') as f:
+        data = f.read()
+    geojson = json.loads(data)
+    assert len(geojson['features']) == len(features)
+    for feature, offset, length in zip(geojson['features'], offsets, lengths):
+        assert json.loads(data[offset:offset + length]) == feature
+
+
+def test_write_vector_tiles_returns_written_files(tmp_path):
+    # The returned paths are what the background writer syncs: every file of the pyramid and nothing else
+    mask = qc_mask(5)
+    tiles_dir = str(tmp_path / 'tiles')
+    written = write_vector_tiles(mask_polygons(mask, scale_factor=4.0), tiles_dir,
+                                 (mask.shape[1] * 4.0, mask.shape[0] * 4.0), str, min_tile_size=512)
+    on_disk = [os.path.join(root, name) for root, _, names in os.walk(tiles_dir) for name in names]
+    assert len(on_disk) > 2
+    assert sorted(written) == sorted(on_disk)
@@ -0,0 +1,110 @@
+# WORKER DAEMON: ACCESS TOKEN, JSON BODIES, OUTPUT ROOT AND SHUTDOWN AFTER THE RUNNING JOB
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+from queue import Queue
+
+import pytest
+
+from wsi_worker import GrandQCWorker, make_handler, output_dir_in_root, read_token, write_token
+
+
+class Jobs(object):
+    # Job bookkeeping of GrandQCWorker without the models
+    def __init__(self):
+        self.submitted = []
+
+    def health(self):
+        return {'ok': True}
+
+    def submit(self, request):
+        self.submitted.append(request)
+        return 'job1'
+
+    def job(self, job_id):
+        return None
+
+    def all_jobs(self):
+        return []
+
+
+@pytest.fixture
+def server(tmp_path):
+    token = write_token(str(tmp_path / 'worker.token'))
+    jobs = Jobs()
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(jobs, lambda: None, token))
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}", token, jobs
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def status(url, body=None, headers=None):
+    req = urllib.request.Request(url, data=body, headers=headers or {}, method='POST' if body is not None else 'GET')
+    try:
+        with urllib.request.urlopen(req) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def test_token_file_is_private(tmp_path):
+    token_file = str(tmp_path / 'worker.token')
+    token = write_token(token_file)
+    assert read_token(token_file) == token and len(token) == 64
+    assert os.stat(token_file).st_mode & 0o077 == 0
+
+
+def test_requests_need_token_and_json(server):
+    url, token, jobs = server
+    body = json.dumps({'slide_path': 'a.svs', 'output_dir': 'out'}).encode()
+    auth = {'Authorization': 'Bearer ' + token}
+    assert status(url + '/health') == 401
+    assert status(url + '/health', headers={'Authorization': 'Bearer wrong'}) == 401
+    assert status(url + '/health', headers=auth) == 200
+    # A cross-site form post: no token, form content type
+    assert status(url + '/jobs', body, {'Content-Type': 'application/x-www-form-urlencoded'}) == 401
+    assert status(url + '/jobs', body, dict(auth, **{'Content-Type': 'text/plain'})) == 415
+    assert jobs.submitted == []
+    assert status(url + '/jobs', body, dict(auth, **{'Content-Type': 'application/json'})) == 202
+    assert jobs.submitted == [{'slide_path': 'a.svs', 'output_dir': 'out'}]
+
+
+def test_output_dir_inside_root(tmp_path):
+    root = tmp_path / 'outputs'
+    root.mkdir()
+    assert output_dir_in_root(str(root / 'a' / 'b'), str(root)) == os.path.realpath(str(root / 'a' / 'b'))
+    assert output_dir_in_root(str(root), str(root)) == os.path.realpath(str(root))
+    for outside in [str(tmp_path), str(root / '..' / 'other'), str(tmp_path / 'outputs2'), '/etc']:
+        with pytest.raises(ValueError):
+            output_dir_in_root(outside, str(root))
+    os.symlink('/etc', str(root / 'link'))
+    with pytest.raises(ValueError):
+        output_dir_in_root(str(root / 'link'), str(root))
+
+
+def test_shutdown_after_running_job():
+    # The job thread of GrandQCWorker, with a job that asks for the shutdown while it runs
+    worker = GrandQCWorker.__new__(GrandQCWorker)
+    worker.jobs = {job_id: {'job_id': job_id, 'state': 'queued'} for job_id in ['a', 'b', 'c']}
+    worker.lock = threading.Lock()
+    worker.queue = Queue()
+    worker.stopping = threading.Event()
+    processed = []
+
+    def process(job):
+        processed.append(job['job_id'])
+        worker.stop()
+
+    worker._process = process
+    for job_id in ['a', 'b', 'c']:
+        worker.queue.put(job_id)
+    worker._run()
+    assert processed == ['a']
+    assert [worker.jobs[job_id]['state'] for job_id in ['a', 'b', 'c']] == ['done', 'queued', 'queued']
+    with pytest.raises(ValueError):
+        worker.submit({'slide_path': __file__, 'output_dir': '.'})
@@ -0,0 +1,251 @@
+"""
+Spatial index of the QC annotations, for reading only the artifacts of a region (e.g. the viewport of a viewer).
+
+<slide>.geojson.idx, written next to the GeoJSON, is a packed Hilbert R-tree over the bounding boxes of the polygons
+(level 0 pixels) with the byte range of every feature in the GeoJSON. query() memory-maps the index, walks the tree
+and reads and parses only the features that intersect the box:
+
+    from wsi_annotation_index import query
+    features = query('output/geojson_qc/a.svs.geojson', (x0, y0, x1, y1), classes=[2, 5])
+    features = query('a.svs', (x0, y0, x1, y1), output_dir='output')
+
+For GeoParquet output query() filters on the bounding box columns, the rows are in Hilbert order so that the
+statistics of the row groups skip most of the file. write_vector_tiles() writes a tiled pyramid of the polygons
+(one small GeoJSON per tile and zoom level, simplified to the tile resolution), MVT-style, for viewers.
+
+    python wsi_annotation_index.py query --geojson A.geojson --bbox X0 Y0 X1 Y1 [--classes 2 5]
+"""
+import argparse
+import json
+import math
+import os
+import cv2
+import numpy as np
+
+INDEX_MAGIC = b'GQCIDX01'
+NODE_SIZE = 16
+TILE_PIXELS = 512   # resolution of a vector tile, the polygons of a tile are simplified to it
+MIN_TILE_SIZE = 2048  # level 0 pixels covered by a tile of the highest zoom level
+
+
+def hilbert_order(boxes, bits=16):
+    # Order of the boxes along a Hilbert curve through their centers
+    if not len(boxes):
+        return np.zeros(0, dtype=np.int64)
+    centers = np.stack([(boxes[:, 0] + boxes[:, 2]) / 2, (boxes[:, 1] + boxes[:, 3]) / 2], axis=1)
+    low = centers.min(axis=0)
+    span = np.maximum(centers.max(axis=0) - low, 1e-9)
+    n = 1 << bits
+    xy = ((centers - low) / span * (n - 1)).astype(np.int64)
+    x, y = xy[:, 0].copy(), xy[:, 1].copy()
+    d = np.zeros(len(boxes), dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # Rotate the quadrant
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return np.argsort(d, kind='stable')
+
+
+def feature_boxes(features):
+    # (n, 4) bounding boxes xmin, ymin, xmax, ymax of the outer rings
+    return np.array([np.concatenate([f['rings'][0].min(axis=0), f['rings'][0].max(axis=0)]) for f in features],
+                    dtype=np.float64).reshape(-1, 4)
+
+
+def write_index(index_path, boxes, classes, offsets, lengths, node_size=NODE_SIZE):
+    '''
+    Packed Hilbert R-tree: the features sorted along the Hilbert curve form the leaves, every node_size
+    consecutive entries of a level are one node of the level above, up to a single root.
+    '''
+    order = hilbert_order(boxes)
+    levels = [boxes[order]]
+    while len(levels[-1]) > 1:
+        level = levels[-1]
+        starts = np.arange(0, len(level), node_size)
+        levels.append(np.stack([np.minimum.reduceat(level[:, 0], starts), np.minimum.reduceat(level[:, 1], starts),
+                                np.maximum.reduceat(level[:, 2], starts), np.maximum.reduceat(level[:, 3], starts)],
+                               axis=1))
+    header = json.dumps({'count': len(boxes), 'node_size': node_size,
+                         'levels': [len(level) for level in levels]}).encode()
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(INDEX_MAGIC)
+        f.write(np.uint32(len(header)).tobytes())
+        f.write(header)
+        f.write(np.asarray(classes, dtype=np.uint8)[order].tobytes())
+        f.write(np.asarray(offsets, dtype=np.uint64)[order].tobytes())
+        f.write(np.asarray(lengths, dtype=np.uint32)[order].tobytes())
+        for level in levels:
+            f.write(level.astype(np.float64).tobytes())
+    os.replace(tmp_path, index_path)
+
+
+def load_index(index_path):
+    # Memory-mapped arrays of the index, only the parts a query touches are read
+    with open(index_path, 'rb') as f:
+        if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+            raise Exception(f"{index_path} is not a GrandQC annotation index")
+        header_length = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(header_length))
+    position = len(INDEX_MAGIC) + 4 + header_length
+    count = header['count']
+    index = {'node_size': header['node_size']}
+    for name, dtype in [('classes', np.uint8), ('offsets', np.uint64), ('lengths', np.uint32)]:
+        index[name] = np.memmap(index_path, dtype=dtype, mode='r', offset=position, shape=(count,)) \
+            if count else np.zeros(0, dtype=dtype)
+        position += count * np.dtype(dtype).itemsize
+    index['levels'] = []
+    for size in header['levels']:
+        index['levels'].append(np.memmap(index_path, dtype=np.float64, mode='r', offset=position, shape=(size, 4)))
+        position += size * 4 * 8
+    return index
+
+
+def query_index(index, bbox, classes=None):
+    # Positions (in the index) of the features whose box intersects bbox = (xmin, ymin, xmax, ymax)
+    x0, y0, x1, y1 = bbox
+    levels = index['levels']
+    if not levels:
+        return np.zeros(0, dtype=np.int64)
+    node_size = index['node_size']
+    candidates = np.arange(len(levels[-1]))
+    for depth in range(len(levels) - 1, -1, -1):
+        boxes = np.asarray(levels[depth][candidates])
+        hit = candidates[(boxes[:, 0] <= x1) & (boxes[:, 2] >= x0) & (boxes[:, 1] <= y1) & (boxes[:, 3] >= y0)]
+        if depth == 0:
+            candidates = hit
+            break
+        # Children of the hit nodes on the level below
+        candidates = (hit[:, None] * node_size + np.arange(node_size)[None, :]).ravel()
+        candidates = candidates[candidates < len(levels[depth - 1])]
+    if classes is not None:
+        candidates = candidates[np.isin(np.asarray(index['classes'][candidates]), list(classes))]
+    return candidates
+
+
+def annotation_path(slide, output_dir=None):
+    # GeoJSON / GeoParquet of a slide: a path, or a slide name in <output_dir>/geojson_qc
+    if output_dir is None or os.path.exists(slide):
+        return slide
+    for extension in ['.geojson', '.parquet']:
+        path = os.path.join(output_dir, 'geojson_qc', slide + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No annotations of {slide} in {os.path.join(output_dir, 'geojson_qc')}")
+
+
+def query(slide, bbox, classes=None, output_dir=None):
+    '''
+    GeoJSON features of the artifact polygons of a slide whose bounding box intersects bbox = (xmin, ymin, xmax,
+    ymax) in level 0 pixels, optionally only of the given classes. Only the index and the matching features are read.
+    '''
+    path = annotation_path(slide, output_dir)
+    if path.endswith('.parquet'):
+        return query_geoparquet(path, bbox, classes)
+
+    index = load_index(path + '.idx')
+    hits = np.sort(query_index(index, bbox, classes))
+    offsets = np.asarray(index['offsets'][hits])
+    lengths = np.asarray(index['lengths'][hits])
+    # Read in file order
+    order = np.argsort(offsets, kind='stable')
+    features = []
+    with open(path, 'rb') as f:
+        for offset, length in zip(offsets[order], lengths[order]):
+            f.seek(int(offset))
+            features.append(json.loads(f.read(int(length))))
+    return features
+
+
+def query_geoparquet(path, bbox, classes=None):
+    # Features of a GeoParquet file (see write_geoparquet) intersecting bbox, as GeoJSON features
+    import pyarrow.parquet as pq
+    from wsi_vectorize import wkb_polygon
+
+    x0, y0, x1, y1 = bbox
+    filters = [('xmin', '<=', x1), ('xmax', '>=', x0), ('ymin', '<=', y1), ('ymax', '>=', y0)]
+    if classes is not None:
+        filters.append(('class_id', 'in', [int(c) for c in classes]))
+    table = pq.read_table(path, filters=filters)
+    features = []
+    for row in table.to_pylist():
+        features.append({'type': 'Feature',
+                         'properties': {'class_id': row['class_id'], 'classification': row['classification'],
+                                        'area': row['area']},
+                         'geometry': {'type': 'Polygon',
+                                      'coordinates': [ring.tolist() for ring in wkb_polygon(row['geometry'])]}})
+    return features
+
+
+def write_vector_tiles(features, tiles_dir, extent, classification, min_tile_size=MIN_TILE_SIZE,
+                       tile_pixels=TILE_PIXELS):
+    '''
+    Tiled pyramid of the polygons in tiles_dir/{z}/{x}/{y}.geojson. Zoom level z splits the square of side
+    2^k >= max(extent) (level 0 pixels, origin top left) into 2^z x 2^z tiles, the highest level has tiles of at
+    least min_tile_size pixels. A tile holds the polygons intersecting it (not clipped), simplified to the tile
+    resolution of tile_pixels. tiles_dir/tiles.json describes the pyramid. Returns the paths of the written files.
+    '''
+    side = 2 ** math.ceil(math.log2(max(max(extent), 1)))
+    max_zoom = max(int(math.log2(max(side // min_tile_size, 1))), 0)
+    boxes = feature_boxes(features)
+    written = []
+    for z in range(max_zoom + 1):
+        tile_size = side / 2 ** z
+        tolerance = tile_size / tile_pixels
+        tiles = {}
+        for k, box in enumerate(boxes):
+            for tx in range(int(box[0] // tile_size), int(box[2] // tile_size) + 1):
+                for ty in range(int(box[1] // tile_size), int(box[3] // tile_size) + 1):
+                    tiles.setdefault((tx, ty), []).append(k)
+        for (tx, ty), members in tiles.items():
+            tile_features = []
+            for k in members:
+                rings = []
+                for ring in features[k]['rings']:
+                    ring = cv2.approxPolyDP(ring[:-1].astype(np.float32).reshape(-1, 1, 2), tolerance, True)
+                    ring = np.round(ring.reshape(-1, 2)).astype(np.int64)
+                    if len(ring) >= 3:
+                        rings.append(np.concatenate([ring, ring[:1]]).tolist())
+                if not rings:
+                    continue
+                tile_features.append({'type': 'Feature',
+                                      'properties': {'class_id': int(features[k]['class_id']),
+                                                     'classification': classification(features[k]['class_id'])},
+                                      'geometry': {'type': 'Polygon', 'coordinates': rings}})
+            if not tile_features:
+                continue
+            tile_dir = os.path.join(tiles_dir, str(z), str(tx))
+            os.makedirs(tile_dir, exist_ok=True)
+            tile_path = os.path.join(tile_dir, f"{ty}.geojson")
+            with open(tile_path, 'w') as f:
+                json.dump({'type': 'FeatureCollection', 'features': tile_features}, f, separators=(',', ':'))
+            written.append(tile_path)
+    os.makedirs(tiles_dir, exist_ok=True)
+    with open(os.path.join(tiles_dir, 'tiles.json'), 'w') as f:
+        json.dump({'tiles': '{z}/{x}/{y}.geojson', 'minzoom': 0, 'maxzoom': max_zoom, 'extent': list(extent),
+                   'side': side, 'tile_pixels': tile_pixels}, f, indent=1)
+    written.append(os.path.join(tiles_dir, 'tiles.json'))
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['query'], type=str)
+    parser.add_argument('--geojson', dest='geojson', required=True,
+                        help='path to the GeoJSON / GeoParquet, or slide name with --output_dir', type=str)
+    parser.add_argument('--output_dir', dest='output_dir', default=None, help='path to output folder', type=str)
+    parser.add_argument('--bbox', dest='bbox', nargs=4, required=True, help='xmin ymin xmax ymax (level 0)',
+                        type=float)
+    parser.add_argument('--classes', dest='classes', nargs='*', default=None, help='class ids', type=int)
+    args = parser.parse_args()
+
+    result = query(args.geojson, args.bbox, args.classes, args.output_dir)
+    print(json.dumps({'type': 'FeatureCollection', 'features': result}, separators=(',', ':')))
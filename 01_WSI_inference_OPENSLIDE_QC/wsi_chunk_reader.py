@@ -0,0 +1,135 @@
+# CHUNK-ALIGNED TILE READER FOR ZARR / OME-TIFF SLIDES WITH AN LRU CACHE OF DECODED CHUNKS
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+
+class ChunkTileReader(object):
+    """
+    Reads regions of a (C, Y, X) zarr array of a slide level chunk by chunk.
+
+    The chunks (the tiles of the TIFF) a region touches are decoded once, in a pool of workers threads (tifffile
+    decodes them with imagecodecs, which releases the GIL), and kept in an LRU cache of at most
+    cache_mb MB, so patches that share a chunk with a previous patch do not decode it again. iter_tiles() visits the
+    patches in an order that reuses the cached chunks and fetches the chunks of the next patch while the caller works
+    on the current one.
+    """
+
+    def __init__(self, array, cache_mb=256, workers=4):
+        self.array = array
+        self.n_channels, self.height, self.width = array.shape
+        self.chunk_h, self.chunk_w = array.chunks[1], array.chunks[2]
+        self.chunk_bytes = self.n_channels * self.chunk_h * self.chunk_w * array.dtype.itemsize
+        self.cache_bytes = int(cache_mb * (1 << 20))
+        self.workers = workers
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+        self.decoded = 0
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._cache.clear()
+        self._cached_bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def chunks_of(self, y, x, h, w):
+        # (cy, cx) of the chunks under the region, clipped to the array
+        y1, x1 = min(y + h, self.height), min(x + w, self.width)
+        if y1 <= y or x1 <= x:
+            return []
+        return [(cy, cx) for cy in range(y // self.chunk_h, (y1 - 1) // self.chunk_h + 1)
+                for cx in range(x // self.chunk_w, (x1 - 1) // self.chunk_w + 1)]
+
+    def _decode(self, key):
+        cy, cx = key
+        y0, x0 = cy * self.chunk_h, cx * self.chunk_w
+        chunk = self.array[:, y0:y0 + self.chunk_h, x0:x0 + self.chunk_w]
+        with self._lock:
+            self.decoded += 1
+            self._pending.pop(key, None)
+            if key not in self._cache:
+                self._cache[key] = chunk
+                self._cached_bytes += chunk.nbytes
+                # Least recently used chunks out, the new one stays
+                while self._cached_bytes > self.cache_bytes and len(self._cache) > 1:
+                    _, old = self._cache.popitem(last=False)
+                    self._cached_bytes -= old.nbytes
+        return chunk
+
+    def fetch(self, keys):
+        # Starts decoding the chunks of keys that are neither cached nor being decoded, returns their futures
+        futures = {}
+        with self._lock:
+            for key in keys:
+                if key in self._cache:
+                    continue
+                if key not in self._pending:
+                    if self._executor is None:
+                        continue
+                    self._pending[key] = self._executor.submit(self._decode, key)
+                futures[key] = self._pending[key]
+        return futures
+
+    def _chunk(self, key, futures):
+        with self._lock:
+            chunk = self._cache.get(key)
+            if chunk is not None:
+                self._cache.move_to_end(key)
+                return chunk
+        if key in futures:
+            return futures[key].result()
+        return self._decode(key)
+
+    def read_region(self, y, x, h, w):
+        # Region [y, y + h) x [x, x + w) as (h, w, C) array, clipped to the array like slicing the zarr array
+        y1, x1 = min(y + h, self.height), min(x + w, self.width)
+        region = np.empty((self.n_channels, max(y1 - y, 0), max(x1 - x, 0)), dtype=self.array.dtype)
+        keys = self.chunks_of(y, x, h, w)
+        futures = self.fetch(keys)
+        for cy, cx in keys:
+            chunk = self._chunk((cy, cx), futures)
+            cy0, cx0 = cy * self.chunk_h, cx * self.chunk_w
+            ty0, tx0 = max(y, cy0), max(x, cx0)
+            ty1, tx1 = min(y1, cy0 + chunk.shape[1]), min(x1, cx0 + chunk.shape[2])
+            region[:, ty0 - y:ty1 - y, tx0 - x:tx1 - x] = chunk[:, ty0 - cy0:ty1 - cy0, tx0 - cx0:tx1 - cx0]
+        return np.transpose(region, (1, 2, 0))
+
+    def strip_width(self, p_s):
+        '''
+        Patches per vertical strip for iter_tiles: the chunks of one patch row of the strip have to fit into the
+        cache, so the chunk row shared with the next patch row is still cached when that row is read.
+        '''
+        patch_chunks_w = p_s // self.chunk_w + 1
+        patch_chunks_h = p_s // self.chunk_h + 2
+        return max(1, self.cache_bytes // (self.chunk_bytes * patch_chunks_w * patch_chunks_h))
+
+    def order(self, tiles, p_s):
+        # Patch grid positions (he, wi) in vertical strips, row by row within a strip
+        strip = self.strip_width(p_s)
+        return sorted(tiles, key=lambda t: (t[1] // strip, t[0], t[1]))
+
+    def iter_tiles(self, tiles, p_s, origin=None):
+        '''
+        Yields ((he, wi), (p_s, p_s, C) region) for the patch grid positions of tiles, in chunk-friendly order
+        (see order). origin(he, wi) gives the top left corner (y, x) of a patch, default (he * p_s, wi * p_s).
+        While a patch is handed out, the chunks of the next one are decoded.
+        '''
+        ordered = self.order(tiles, p_s)
+        corners = [origin(he, wi) if origin is not None else (he * p_s, wi * p_s) for he, wi in ordered]
+        for i, (he, wi) in enumerate(ordered):
+            y, x = corners[i]
+            region = self.read_region(y, x, p_s, p_s)
+            if i + 1 < len(ordered):
+                next_y, next_x = corners[i + 1]
+                self.fetch(self.chunks_of(next_y, next_x, p_s, p_s))
+            yield (he, wi), region
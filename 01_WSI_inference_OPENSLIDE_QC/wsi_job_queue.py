@@ -0,0 +1,284 @@
+"""
+Work queue on a shared file system (e.g. NFS), for running wsi_tis_detect.py and main.py with --queue_dir on any
+number of hosts over one cohort: every slide is claimed by one process at a time, slides of dead processes are
+handed out again.
+
+Layout of <queue_dir>/<stage>/ (stage: tis_detect or qc), one JSON file per slide:
+    jobs/       one empty record per slide ever added, so a slide is queued only once
+    todo/       slides waiting
+    leased/     <owner>__<slide>: slides being processed, the owner touches the file every lease_timeout / 10 s
+    done/       finished slides (with the line of the per-slide report for qc)
+    failed/     slides with an error, or whose lease expired max_attempts times
+Claiming, completing and requeueing are renames, which are atomic on a shared file system. A lease whose file was
+not touched for lease_timeout seconds (measured with the clock of the file server) is moved back to todo/ by the next
+process looking for work; its owner finds out when it renames the lease to complete it.
+
+    python wsi_job_queue.py add --queue_dir Q --stage qc --slide_folder S     (done by the entry points as well)
+    python wsi_job_queue.py status --queue_dir Q [--stage qc] [--verbose]
+    python wsi_job_queue.py requeue --queue_dir Q --stage qc [--failed]
+    python wsi_job_queue.py report --queue_dir Q --output stats_per_slide.txt   (per-slide report of all qc hosts)
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import threading
+import time
+import uuid
+
+STAGES = ['tis_detect', 'qc']
+STATES = ['todo', 'leased', 'done', 'failed']
+LEASE_SEP = '__'
+
+
+def read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except ValueError:
+        # Being rewritten by its owner
+        return {}
+
+
+class JobQueue(object):
+    def __init__(self, queue_dir, stage, lease_timeout=600, max_attempts=3):
+        if stage not in STAGES:
+            raise Exception(f"stage of the queue can only be {', '.join(STAGES)}")
+        self.dir = os.path.join(queue_dir, stage)
+        for state in ['jobs', 'tmp'] + STATES:
+            os.makedirs(os.path.join(self.dir, state), exist_ok=True)
+        self.lease_timeout = lease_timeout
+        self.heartbeat = max(lease_timeout / 10, 1)
+        self.max_attempts = max_attempts
+        # No LEASE_SEP in the owner, lease file names are split at its first occurrence
+        self.owner = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}".replace(LEASE_SEP, '-')
+        self._candidates = []
+
+    def path(self, state, name):
+        return os.path.join(self.dir, state, name)
+
+    def write_json(self, path, data):
+        # Written next to the queue first and renamed, so a job never appears half-written
+        tmp_path = self.path('tmp', self.owner + '_' + uuid.uuid4().hex[:6])
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def add(self, slide_names, slide_dir):
+        # Queue the slides that were never added before, returns their number
+        known = set(os.listdir(os.path.join(self.dir, 'jobs')))
+        added = 0
+        for slide_name in slide_names:
+            if slide_name in known:
+                continue
+            try:
+                # Exclusive creation: of several hosts adding the same slide only one succeeds
+                os.close(os.open(self.path('jobs', slide_name), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            except FileExistsError:
+                continue
+            self.write_json(self.path('todo', slide_name),
+                            {'slide_name': slide_name, 'slide_path': os.path.join(slide_dir, slide_name),
+                             'attempts': 0, 'added': time.time()})
+            added += 1
+        return added
+
+    def server_time(self):
+        # Current time of the file server, lease ages do not depend on the clocks of the hosts
+        clock_path = os.path.join(self.dir, '.clock')
+        with open(clock_path, 'a'):
+            pass
+        os.utime(clock_path, None)
+        return os.stat(clock_path).st_mtime
+
+    def leases(self):
+        # (slide_name, owner, lease path, age in s) of all current leases
+        now = self.server_time()
+        leases = []
+        for entry in os.listdir(os.path.join(self.dir, 'leased')):
+            owner, slide_name = entry.split(LEASE_SEP, 1)
+            lease_path = self.path('leased', entry)
+            try:
+                age = now - os.stat(lease_path).st_mtime
+            except FileNotFoundError:
+                continue
+            leases.append((slide_name, owner, lease_path, age))
+        return leases
+
+    def requeue_expired(self):
+        requeued = 0
+        for slide_name, owner, lease_path, age in self.leases():
+            if age > self.lease_timeout:
+                try:
+                    os.rename(lease_path, self.path('todo', slide_name))
+                except FileNotFoundError:
+                    continue
+                print(f"Lease of {slide_name} by {owner} expired ({int(age)} s), requeued")
+                requeued += 1
+        return requeued
+
+    def requeue_failed(self):
+        requeued = 0
+        for slide_name in os.listdir(os.path.join(self.dir, 'failed')):
+            job = read_json(self.path('failed', slide_name))
+            job.update(attempts=0, error=None)
+            self.write_json(self.path('todo', slide_name), job)
+            os.remove(self.path('failed', slide_name))
+            requeued += 1
+        return requeued
+
+    def claim(self, wait=True, before_wait=None):
+        '''
+        Lease of the next slide, None when the queue is drained. With wait, a process without work waits as long as
+        other processes hold leases, to take over their slides if they die. Its own leases count as well, so
+        before_wait() is called before waiting to complete them (e.g. slides whose outputs are saved in the
+        background).
+        '''
+        while True:
+            if not self._candidates:
+                self.requeue_expired()
+                self._candidates = os.listdir(os.path.join(self.dir, 'todo'))
+                # Hosts start at different slides instead of all competing for the first one
+                random.shuffle(self._candidates)
+                if not self._candidates:
+                    if wait and before_wait is not None:
+                        before_wait()
+                    if wait and self.leases():
+                        time.sleep(self.heartbeat)
+                        continue
+                    return None
+            slide_name = self._candidates.pop()
+            lease_path = self.path('leased', self.owner + LEASE_SEP + slide_name)
+            try:
+                os.rename(self.path('todo', slide_name), lease_path)
+            except FileNotFoundError:
+                # Claimed by another process (or a retransmitted rename that already succeeded)
+                if not os.path.exists(lease_path):
+                    continue
+            job = read_json(lease_path)
+            job['attempts'] = job.get('attempts', 0) + 1
+            job['owner'] = self.owner
+            if job['attempts'] > self.max_attempts:
+                job['error'] = f"lease expired {self.max_attempts} times"
+                self.write_json(self.path('failed', slide_name), job)
+                os.remove(lease_path)
+                print(f"{slide_name}: {job['error']}, moved to failed")
+                continue
+            self.write_json(lease_path, job)
+            return Lease(self, slide_name, lease_path, job)
+
+    def status(self):
+        counts = {state: len(os.listdir(os.path.join(self.dir, state))) for state in STATES}
+        leases = self.leases()
+        counts['expired'] = sum(1 for lease in leases if lease[3] > self.lease_timeout)
+        return counts, leases
+
+
+class Lease(object):
+    '''
+    A claimed slide. Its lease file is touched in a background thread until done() or failed() is called.
+    '''
+
+    def __init__(self, job_queue, slide_name, lease_path, job):
+        self.job_queue = job_queue
+        self.slide_name = slide_name
+        self.lease_path = lease_path
+        self.job = job
+        self.lost = False
+        self.start = time.time()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._heartbeat, daemon=True)
+        self._thread.start()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.job_queue.heartbeat):
+            try:
+                os.utime(self.lease_path, None)
+            except FileNotFoundError:
+                self.lost = True
+                print(f"Lease of {self.slide_name} was lost (expired and requeued)")
+                return
+
+    def _finish(self, state, **fields):
+        self._stop.set()
+        self._thread.join()
+        self.job.update(fields, finished=time.time(), seconds=round(time.time() - self.start, 1))
+        record_path = self.job_queue.path(state, self.slide_name)
+        # The lease is taken out of leased/ first: a single rename, so it either still belongs to this owner or was
+        # requeued (writing it in place would recreate the file of a lease that was already requeued)
+        finish_path = self.job_queue.path('tmp', self.job_queue.owner + LEASE_SEP + self.slide_name)
+        try:
+            os.rename(self.lease_path, finish_path)
+        except FileNotFoundError:
+            # Lease expired meanwhile: record the result anyway and take the slide out of todo/ if still there
+            self.lost = True
+            self.job_queue.write_json(record_path, self.job)
+            try:
+                os.remove(self.job_queue.path('todo', self.slide_name))
+            except FileNotFoundError:
+                pass
+            return
+        self.job_queue.write_json(finish_path, self.job)
+        os.rename(finish_path, record_path)
+
+    def done(self, stats=None):
+        self._finish('done', stats=stats)
+
+    def failed(self, error):
+        self._finish('failed', error=error)
+
+
+def print_status(job_queue, stage, verbose=False):
+    counts, leases = job_queue.status()
+    print(f"{stage}: todo {counts['todo']}, leased {counts['leased']} ({counts['expired']} expired), "
+          f"done {counts['done']}, failed {counts['failed']}")
+    if verbose:
+        for slide_name, owner, lease_path, age in sorted(leases):
+            expired = " EXPIRED" if age > job_queue.lease_timeout else ""
+            print(f"  leased  {slide_name}  {owner}  {int(age)} s{expired}")
+        for slide_name in sorted(os.listdir(os.path.join(job_queue.dir, 'failed'))):
+            print(f"  failed  {slide_name}  {read_json(job_queue.path('failed', slide_name)).get('error')}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['add', 'status', 'requeue', 'report'], type=str)
+    parser.add_argument('--queue_dir', dest='queue_dir', required=True, help='path to queue folder', type=str)
+    parser.add_argument('--stage', dest='stage', default=None, choices=STAGES,
+                        help='stage of the queue (all stages for status)', type=str)
+    parser.add_argument('--slide_folder', dest='slide_folder', help='path to WSIs (add)', type=str)
+    parser.add_argument('--lease_timeout', dest='lease_timeout', default=600,
+                        help='seconds without heartbeat after which a lease expires', type=int)
+    parser.add_argument('--failed', dest='failed', action='store_true',
+                        help='requeue the failed slides (requeue), otherwise only expired leases')
+    parser.add_argument('--output', dest='output', help='path of the per-slide report file (report)', type=str)
+    parser.add_argument('--verbose', dest='verbose', action='store_true', help='list leases and failed slides')
+    args = parser.parse_args()
+
+    stages = [args.stage] if args.stage else STAGES
+    if args.command == 'status':
+        for stage in stages:
+            if os.path.isdir(os.path.join(args.queue_dir, stage)):
+                print_status(JobQueue(args.queue_dir, stage, args.lease_timeout), stage, args.verbose)
+    elif args.command == 'add':
+        if not args.stage or not args.slide_folder:
+            raise Exception("add needs --stage and --slide_folder")
+        slide_names = sorted([f for f in os.listdir(args.slide_folder)
+                              if os.path.isfile(os.path.join(args.slide_folder, f))])
+        print("Added:", JobQueue(args.queue_dir, args.stage, args.lease_timeout).add(slide_names, args.slide_folder))
+    elif args.command == 'requeue':
+        if not args.stage:
+            raise Exception("requeue needs --stage")
+        job_queue = JobQueue(args.queue_dir, args.stage, args.lease_timeout)
+        print("Requeued:", job_queue.requeue_failed() if args.failed else job_queue.requeue_expired())
+    elif args.command == 'report':
+        from wsi_pipeline import stats_header
+
+        job_queue = JobQueue(args.queue_dir, 'qc', args.lease_timeout)
+        results = open(args.output, "w")
+        results.write(stats_header())
+        for slide_name in sorted(os.listdir(os.path.join(job_queue.dir, 'done'))):
+            stats = read_json(job_queue.path('done', slide_name)).get('stats')
+            if stats:
+                results.write(stats)
+        results.close()
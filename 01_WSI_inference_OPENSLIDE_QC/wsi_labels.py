@@ -0,0 +1,54 @@
+# RENDERING OF LABEL MASKS: MODE POOLED DOWNSAMPLING AND PALETTE COLORIZATION
+import numpy as np
+from PIL import Image
+
+POOL_CHUNK = 1 << 22  # mask pixels counted at once by mode_pool
+
+
+def lut(class_colors, first_label=0):
+    # (256, 3) color table: label first_label + i gets class_colors[i], all other labels are black
+    table = np.zeros((256, 3), dtype=np.uint8)
+    table[first_label:first_label + len(class_colors)] = np.asarray(class_colors, dtype=np.uint8)
+    return table
+
+
+def colorize(mask, class_colors, first_label=0):
+    # RGB image of a uint8 label mask, one table lookup per pixel
+    return lut(class_colors, first_label)[mask]
+
+
+def label_image(mask, class_colors, first_label=0):
+    # Palette ('P') image of a uint8 label mask: the labels are the pixel values, the colors are in the palette
+    image = Image.fromarray(np.ascontiguousarray(mask, dtype=np.uint8))
+    image.putpalette(lut(class_colors, first_label).tobytes())
+    return image
+
+
+def mode_pool(mask, size, n_labels=None):
+    '''
+    Label mask resized to size = (width, height) by majority vote: every output pixel gets the most frequent label
+    of its block of the mask (the lowest one on ties), so class borders do not turn into colors of no class. The
+    blocks are integer bins, any ratio works; axes that grow are scaled by nearest neighbour. The labels are counted
+    with one bincount per chunk of output rows.
+    '''
+    height, width = mask.shape
+    out_w, out_h = int(size[0]), int(size[1])
+    if n_labels is None:
+        n_labels = int(mask.max()) + 1
+    pool_w, pool_h = min(out_w, width), min(out_h, height)
+    if (pool_w, pool_h) == (width, height):
+        pooled = mask
+    else:
+        row_bin = np.arange(height) * pool_h // height
+        col_bin = (np.arange(width) * pool_w // width) * n_labels
+        pooled = np.empty((pool_h, pool_w), dtype=np.uint8)
+        rows_per_chunk = max(1, POOL_CHUNK // width * pool_h // height)
+        for r0 in range(0, pool_h, rows_per_chunk):
+            r1 = min(r0 + rows_per_chunk, pool_h)
+            y0, y1 = np.searchsorted(row_bin, [r0, r1])
+            keys = ((row_bin[y0:y1, None] - r0) * (pool_w * n_labels) + col_bin[None, :]) + mask[y0:y1]
+            counts = np.bincount(keys.ravel(), minlength=(r1 - r0) * pool_w * n_labels)
+            pooled[r0:r1] = counts.reshape(r1 - r0, pool_w, n_labels).argmax(axis=2)
+    if (pool_w, pool_h) != (out_w, out_h):
+        pooled = np.array(Image.fromarray(pooled).resize((out_w, out_h), Image.Resampling.NEAREST))
+    return pooled
@@ -0,0 +1,70 @@
+# LOW RESOLUTION VIEWS OF OME-TIFF SLIDES: PYRAMID LEVEL SELECTION AND DOWNSAMPLING IN STRIPS
+import numpy as np
+import cv2
+
+STRIP_BYTES = 64 << 20  # bytes of a level read at once by read_downsampled
+
+
+def pyramid_levels(slide):
+    # Arrays of the pyramid levels of a zarr opened slide, level 0 first (a slide without pyramid is a single array)
+    if hasattr(slide, 'array_keys'):
+        return [slide[key] for key in sorted(slide.array_keys(), key=int)]
+    return [slide]
+
+
+def level_size(array):
+    # (width, height) of a level, stored as (C, Y, X) or (Y, X, C)
+    if array.ndim == 3 and array.shape[0] != 3:
+        return array.shape[1], array.shape[0]
+    return array.shape[-1], array.shape[-2]
+
+
+def pick_level(slide, size):
+    '''
+    Smallest pyramid level that still has at least size = (width, height) pixels, level 0 if no level has. Only the
+    shapes of the levels (the metadata of the series) are looked at.
+    '''
+    levels = pyramid_levels(slide)
+    fitting = [level for level in levels if level_size(level)[0] >= size[0] and level_size(level)[1] >= size[1]]
+    if not fitting:
+        return levels[0]
+    return min(fitting, key=lambda level: level_size(level)[0] * level_size(level)[1])
+
+
+def read_downsampled(slide, size):
+    '''
+    RGB (H, W, 3) array of the slide resized to size = (width, height) by area averaging, read from the level chosen
+    by pick_level. The level is read in strips of whole chunk rows of at most STRIP_BYTES: every strip is shrunk to
+    the output width and its rows are added to the output rows they overlap, weighted by the overlap. The result is
+    the one of resizing the whole level with cv2.INTER_AREA, but only one strip of the level is in memory at a time.
+    '''
+    out_w, out_h = int(size[0]), int(size[1])
+    array = pick_level(slide, (out_w, out_h))
+    width, height = level_size(array)
+    channels_first = not (array.ndim == 3 and array.shape[0] != 3)
+
+    def rows(y0, y1):
+        # Rows [y0, y1) of the level as (Y, X, 3) array
+        if channels_first:
+            return np.ascontiguousarray(np.transpose(array[:3, y0:y1, :], (1, 2, 0)))
+        return np.ascontiguousarray(array[y0:y1, :, :3])
+
+    if out_w > width or out_h > height:
+        # Slide smaller than the output: no pyramid to stream from, the (small) slide is scaled up at once
+        return cv2.resize(rows(0, height), (out_w, out_h), interpolation=cv2.INTER_CUBIC)
+
+    chunk_h = array.chunks[-2] if channels_first else array.chunks[0]
+    strip_h = max(1, STRIP_BYTES // (width * 3 * array.dtype.itemsize * chunk_h)) * chunk_h
+    scale = height / out_h  # level rows per output row
+    image = np.zeros((out_h, out_w * 3), dtype=np.float32)
+    for y0 in range(0, height, strip_h):
+        y1 = min(y0 + strip_h, height)
+        strip = cv2.resize(rows(y0, y1), (out_w, y1 - y0), interpolation=cv2.INTER_AREA)
+        strip = strip.reshape(y1 - y0, out_w * 3).astype(np.float32)
+        # Output rows r cover the level rows [r * scale, (r + 1) * scale), weights are the overlaps with the strip rows
+        r0, r1 = int(y0 // scale), min(out_h, int(np.ceil(y1 / scale)))
+        out_rows = np.arange(r0, r1, dtype=np.float64)[:, None]
+        level_rows = np.arange(y0, y1, dtype=np.float64)[None, :]
+        weights = np.minimum((out_rows + 1) * scale, level_rows + 1) - np.maximum(out_rows * scale, level_rows)
+        image[r0:r1] += (np.clip(weights, 0, None) / scale).astype(np.float32) @ strip
+    return np.clip(np.rint(image), 0, 255).astype(np.uint8).reshape(out_h, out_w, 3)
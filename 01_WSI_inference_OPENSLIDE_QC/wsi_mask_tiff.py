@@ -0,0 +1,103 @@
+# STREAMING PYRAMIDAL TILED OME-TIFF WRITER FOR THE QC MASK
+import threading
+import numpy as np
+
+
+class TiledMaskWriter(object):
+    """
+    Writes the QC label mask as a tiled, compressed, pyramidal OME-TIFF while the inference fills it.
+
+    start(canvas) is called with the output canvas once it is allocated; a background thread then encodes the full
+    resolution tiles of every band of rows as soon as rows_done() reports the band as final, using workers threads
+    for the compression. After close() the lower resolution levels (halved, nearest neighbour, so labels stay
+    labels) are written as SubIFDs down to one tile. The physical pixel size mpp is stored in the OME metadata and
+    as TIFF resolution.
+    """
+
+    def __init__(self, path, mpp, tile=512, compression='zlib', workers=4):
+        self.path = path
+        self.mpp = mpp
+        self.tile = tile
+        self.compression = compression
+        self.workers = workers
+        self.canvas = None
+        self.rows_ready = 0
+        self.aborted = False
+        self.error = None
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self, canvas):
+        self.canvas = canvas
+        self._thread = threading.Thread(target=self._write, daemon=True)
+        self._thread.start()
+
+    def rows_done(self, rows):
+        # Rows [0, rows) of the canvas are final
+        with self._cond:
+            self.rows_ready = max(self.rows_ready, rows)
+            self._cond.notify_all()
+
+    def close(self, abort=False):
+        # Waits until the file is written (abort: stops writing, the file is incomplete)
+        if self._thread is None:
+            return
+        with self._cond:
+            self.aborted = abort
+            self.rows_ready = self.canvas.shape[0]
+            self._cond.notify_all()
+        self._thread.join()
+        if self.error is not None and not abort:
+            raise self.error
+
+    def _tiles(self, image, stream=False):
+        # Tiles in row-major order, padded to full tile size; with stream each band waits for its rows
+        height, width = image.shape
+        t = self.tile
+        for y in range(0, height, t):
+            if stream:
+                with self._cond:
+                    while self.rows_ready < min(y + t, height) and not self.aborted:
+                        self._cond.wait()
+            if self.aborted:
+                raise Exception("mask writing aborted")
+            for x in range(0, width, t):
+                tile = image[y:y + t, x:x + t]
+                if tile.shape != (t, t):
+                    tile = np.pad(tile, ((0, t - tile.shape[0]), (0, t - tile.shape[1])))
+                yield tile
+
+    def _levels(self):
+        # Halved levels until the image fits into one tile
+        levels = []
+        image = self.canvas
+        while max(image.shape) > self.tile:
+            image = image[::2, ::2]
+            levels.append(image)
+        return levels
+
+    def _write(self):
+        import tifffile
+
+        try:
+            height, width = self.canvas.shape
+            n_levels = 0
+            size = max(height, width)
+            while size > self.tile:
+                size = (size + 1) // 2
+                n_levels += 1
+            resolution = (1e4 / self.mpp, 1e4 / self.mpp)
+            options = dict(tile=(self.tile, self.tile), compression=self.compression, maxworkers=self.workers,
+                           resolution=resolution, resolutionunit='CENTIMETER')
+            with tifffile.TiffWriter(self.path, bigtiff=True, ome=True) as tif:
+                tif.write(self._tiles(self.canvas, stream=True), shape=(height, width), dtype=np.uint8,
+                          subifds=n_levels, photometric='minisblack',
+                          metadata={'axes': 'YX', 'PhysicalSizeX': self.mpp, 'PhysicalSizeXUnit': 'µm',
+                                    'PhysicalSizeY': self.mpp, 'PhysicalSizeYUnit': 'µm'}, **options)
+                for level in self._levels():
+                    level_options = dict(options, resolution=(resolution[0] * level.shape[1] / width,
+                                                              resolution[1] * level.shape[0] / height))
+                    tif.write(self._tiles(level), shape=level.shape, dtype=np.uint8, subfiletype=1,
+                              photometric='minisblack', **level_options)
+        except Exception as e:
+            self.error = e
@@ -0,0 +1,100 @@
+# CACHE OF READY-TO-RUN MODELS: STATE DICT + ARCHITECTURE, KEYED BY CHECKPOINT HASH AND LIBRARY VERSIONS
+import glob
+import hashlib
+import json
+import os
+import torch
+import timm
+import segmentation_models_pytorch as smp
+
+# Bump when the layout of the cached files changes
+CACHE_FORMAT = 1
+
+
+def library_versions():
+    return {'torch': str(torch.__version__), 'smp': str(smp.__version__), 'timm': str(timm.__version__)}
+
+
+def file_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_sha256(path, cache_dir):
+    '''
+    SHA-256 of a checkpoint. Hashes are remembered in cache_dir/index.json together with size and modification time
+    of the file, so an unchanged checkpoint is not read again; without cache_dir (None) the file is always read.
+    '''
+    if cache_dir is None:
+        return file_digest(path)
+    os.makedirs(cache_dir, exist_ok=True)
+    index_path = os.path.join(cache_dir, 'index.json')
+    try:
+        with open(index_path) as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = index.get(key)
+    if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+        return entry['sha256']
+
+    index[key] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': file_digest(path)}
+    tmp_path = index_path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_path, index_path)
+    return index[key]['sha256']
+
+
+def build_model(arch):
+    # Empty model of the given architecture; no pretrained encoder weights, so nothing is downloaded
+    model_class = getattr(smp, arch['class'])
+    return model_class(encoder_name=arch['encoder_name'], encoder_weights=None, classes=arch['classes'],
+                       activation=None)
+
+
+def load_cached_model(model_path, arch, load_model, DEVICE, cache_dir):
+    '''
+    Model of checkpoint model_path from the cache in cache_dir. arch describes the architecture
+    ({'class': 'UnetPlusPlus', 'encoder_name': ..., 'classes': ...}).
+    On a cache miss the model is loaded with load_model() and its state dict is stored together with arch under a
+    key made of the checkpoint hash, arch and the torch / smp / timm versions; later starts rebuild the architecture
+    and load the state dict (weights only, no unpickling of code, no network access).
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    key_data = {'checkpoint': file_sha256(model_path, cache_dir), 'arch': arch, 'versions': library_versions(),
+                'format': CACHE_FORMAT}
+    key = hashlib.sha256(json.dumps(key_data, sort_keys=True).encode()).hexdigest()
+    name = os.path.splitext(os.path.basename(model_path))[0]
+    cache_path = os.path.join(cache_dir, name + '_' + key[:16] + '.pt')
+
+    if os.path.exists(cache_path):
+        try:
+            artifact = torch.load(cache_path, map_location='cpu', weights_only=True)
+            model = build_model(artifact['arch'])
+            model.load_state_dict(artifact['state_dict'])
+            return model.to(DEVICE).eval()
+        except Exception as e:
+            print(f"Cached model {cache_path} could not be loaded ({e}), loading {model_path}")
+
+    model = load_model()
+    try:
+        # The state dict has to fit the rebuilt architecture exactly, otherwise the model is not cached
+        reference = build_model(arch)
+        reference.load_state_dict(model.state_dict())
+        tmp_path = cache_path + '.' + str(os.getpid()) + '.tmp'
+        torch.save({'arch': arch, 'state_dict': reference.state_dict(), 'key': key_data}, tmp_path)
+        os.replace(tmp_path, cache_path)
+        # Older entries of the same checkpoint are not needed anymore
+        for old_path in glob.glob(os.path.join(cache_dir, name + '_*.pt')):
+            if old_path != cache_path:
+                os.remove(old_path)
+        print("Cached model:", cache_path)
+    except Exception as e:
+        print(f"Model {model_path} not cached: {e}")
+    return model.to(DEVICE).eval()
@@ -0,0 +1,125 @@
+# PATCHES FROM SLIDES AND MASK AGREEMENT FOR CHECKING EXPORTED / QUANTIZED MODELS
+import os
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+from wsi_slide_info import slide_info
+from wsi_slide_reader import open_slide_reader
+from wsi_tile_plan import plan_tissue_tiles
+from wsi_tile_reader import read_patch
+
+
+def pick_evenly(items, n):
+    # n items spread over the whole list
+    if len(items) <= n:
+        return list(items)
+    return [items[i] for i in np.linspace(0, len(items) - 1, n).round().astype(int)]
+
+
+def qc_sample_tiles(slide_path, n, m_p_s, mpp_model, tis_det_map=None):
+    '''
+    n uint8 RGB patches at model MPP, read as in main.py (tissue patches if the tissue detection map is given),
+    spread evenly over the slide.
+    '''
+    slide = open_slide_reader(slide_path)
+    p_s, patch_n_w_l0, patch_n_h_l0, mpp, w_l0, h_l0, _, read_level, p_s_level = slide_info(slide, m_p_s, mpp_model)
+    tiles = plan_tissue_tiles(tis_det_map, w_l0, h_l0, p_s, patch_n_w_l0, patch_n_h_l0).tolist()
+    patches = []
+    for he, wi in pick_evenly(tiles, n):
+        h = he * p_s + 1 if he > 0 else 0
+        w = wi * p_s + 1 if wi > 0 else 0
+        patches.append(np.asarray(read_patch(slide, w, h, read_level, p_s_level, m_p_s)))
+    slide.close()
+    return patches
+
+
+def td_sample_tiles(slide_path, n, m_p_s, mpp_model_td):
+    # n patches of the JPEG compressed thumbnail at MPP of the tissue detection model, as in wsi_tis_detect.py
+    slide = open_slide_reader(slide_path)
+    w_l0, h_l0 = slide.levels[0]
+    reduction_factor = mpp_model_td / slide.mpp
+    image = np.array(slide.get_thumbnail((w_l0 // reduction_factor, h_l0 // reduction_factor)))
+    slide.close()
+    result, image = cv2.imencode('.jpg', image, [int(cv2.IMWRITE_JPEG_QUALITY), 80])
+    image = cv2.imdecode(image, 1)
+    height, width = image.shape[:2]
+    corners = [(y, x) for y in range(0, height - m_p_s + 1, m_p_s) for x in range(0, width - m_p_s + 1, m_p_s)]
+    return [image[y:y + m_p_s, x:x + m_p_s] for y, x in pick_evenly(corners, n)]
+
+
+def slide_folder_tiles(slide_dir, get_tiles, n, m_p_s):
+    '''
+    Patches from all slides in slide_dir, get_tiles(slide_path, slide_name, n) returns the patches of one slide.
+    Without slides (or if none can be read) n random patches are returned (numerical checks only).
+    '''
+    patches = []
+    if slide_dir is not None:
+        for slide_name in sorted(os.listdir(slide_dir)):
+            try:
+                patches.extend(get_tiles(os.path.join(slide_dir, slide_name), slide_name, n))
+            except Exception as e:
+                print(f"Skipping {slide_name}: {e}")
+    if not patches:
+        print("No patches from slides, using random patches (numerical check only)")
+        rng = np.random.default_rng(0)
+        patches = [rng.integers(0, 256, (m_p_s, m_p_s, 3), dtype=np.uint8) for _ in range(n)]
+    return patches
+
+
+def tis_det_map_for(output_dir, slide_name):
+    # Tissue detection mask written by wsi_tis_detect.py, None if not there
+    if output_dir is None:
+        return None
+    mask_path = os.path.join(output_dir, 'tis_det_mask', slide_name + '_MASK.png')
+    if not os.path.exists(mask_path):
+        return None
+    return np.array(Image.open(mask_path))
+
+
+def normalize_patches(patches, norm):
+    # Stack uint8 RGB patches (H, W, 3) into a normalized float tensor (N, 3, H, W), norm from get_normalization
+    scale, mean, std, bgr = norm
+    x_tensor = torch.from_numpy(np.stack(patches)).permute(0, 3, 1, 2).float()
+    if bgr:
+        x_tensor = x_tensor.flip(1)
+    return (x_tensor * scale - mean.cpu()) / std.cpu()
+
+
+def compare_models(model_ref, model_test, patches, norm, classes, batch_size=4, tie_tol=0.0):
+    '''
+    Run both models on the patches and compare the argmax masks per pixel.
+    Pixels whose two best logits of model_ref differ by at most tie_tol are counted as ties.
+    Returns a dict with the numbers of pixels (pixels, mismatch, mismatch_tie), the maximum absolute logit difference
+    and, per class of the reference mask, the numbers of pixels (class_px) and of agreeing pixels (class_agree).
+    '''
+    result = {'pixels': 0, 'mismatch': 0, 'mismatch_tie': 0, 'max_diff': 0.0,
+              'class_px': np.zeros(classes, dtype=np.int64), 'class_agree': np.zeros(classes, dtype=np.int64)}
+    for i in range(0, len(patches), batch_size):
+        x_tensor = normalize_patches(patches[i:i + batch_size], norm)
+        with torch.no_grad():
+            logits_ref = model_ref.predict(x_tensor).cpu()
+            logits_test = model_test.predict(x_tensor).cpu()
+        result['max_diff'] = max(result['max_diff'], (logits_ref - logits_test).abs().max().item())
+        mask_ref = logits_ref.argmax(dim=1).numpy()
+        mask_test = logits_test.argmax(dim=1).numpy()
+        agree = mask_ref == mask_test
+        top2 = logits_ref.topk(2, dim=1).values
+        tie = ((top2[:, 0] - top2[:, 1]) <= tie_tol).numpy()
+        result['mismatch'] += int((~agree & ~tie).sum())
+        result['mismatch_tie'] += int((~agree & tie).sum())
+        result['pixels'] += agree.size
+        result['class_px'] += np.bincount(mask_ref.ravel(), minlength=classes)[:classes]
+        result['class_agree'] += np.bincount(mask_ref[agree], minlength=classes)[:classes]
+    return result
+
+
+def print_comparison(result):
+    print("Max. absolute logit difference: ", result['max_diff'])
+    print("Pixels with different class: ", result['mismatch'], "of", result['pixels'],
+          "(+", result['mismatch_tie'], "ties)")
+    print("Pixel agreement: ", round(1 - (result['mismatch'] + result['mismatch_tie']) / max(result['pixels'], 1), 6))
+    for c in range(len(result['class_px'])):
+        if result['class_px'][c] > 0:
+            print("  class", c, "pixels:", result['class_px'][c],
+                  "agreement:", round(result['class_agree'][c] / result['class_px'][c], 6))
@@ -0,0 +1,82 @@
+# LOADING OF THE QC AND TISSUE DETECTION MODELS
+import pickle
+import torch
+import segmentation_models_pytorch as smp
+from wsi_model_cache import load_cached_model
+
+
+# Custom pickle unpickler to handle timm module changes
+class TimmmUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        # Handle timm.models.layers.activations module changes
+        if module.startswith('timm.models.layers'):
+            module = module.replace('timm.models.layers', 'timm.models')
+        return super().find_class(module, name)
+
+
+def load_qc_model(model_path, ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, DEVICE, classes=8, cache_dir=None):
+    '''
+    QC model is stored as a whole pickled model. Older checkpoints may need the timm module names to be remapped,
+    as a last resort the architecture is rebuilt and the weights are loaded as a state dict. Raises if the weights
+    cannot be loaded at all, instead of going on with random weights.
+    With cache_dir the loaded model is cached as state dict + architecture (see wsi_model_cache.py).
+    '''
+    if cache_dir is not None:
+        arch = {'class': 'UnetPlusPlus', 'encoder_name': ENCODER_MODEL, 'classes': classes}
+        load_model = lambda: load_qc_model(model_path, ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, 'cpu', classes)
+        return load_cached_model(model_path, arch, load_model, DEVICE, cache_dir)
+    try:
+        # Try standard loading first
+        model = torch.load(model_path, map_location=DEVICE, weights_only=False)
+    except (ModuleNotFoundError, pickle.UnpicklingError, RuntimeError) as e:
+        # Fall back to custom unpickler for timm compatibility
+        print(f"Standard loading failed ({type(e).__name__}), trying custom unpickler...")
+        with open(model_path, 'rb') as f:
+            try:
+                unpickler = TimmmUnpickler(f)
+                model = unpickler.load()
+            except:
+                # If all else fails, rebuild model architecture and load state_dict
+                print("Rebuilding model from scratch...")
+                model = smp.UnetPlusPlus(
+                    encoder_name=ENCODER_MODEL,
+                    encoder_weights=ENCODER_MODEL_WEIGHTS,
+                    classes=classes,
+                    activation=None,
+                )
+                # Try to load state dict with relaxed constraints (extra keys are ignored, missing weights are not:
+                # a model with random weights would produce QC masks without any error, and be cached as well)
+                try:
+                    state = torch.load(model_path, map_location=DEVICE, weights_only=False)
+                except Exception as e:
+                    raise Exception(f"Weights of {model_path} could not be loaded: {e}") from e
+                if isinstance(state, dict):
+                    missing = model.load_state_dict(state, strict=False).missing_keys
+                    if missing:
+                        raise Exception(f"Weights of {model_path} could not be loaded: {len(missing)} tensors of the "
+                                        f"model are missing in the checkpoint (e.g. {missing[0]})")
+                else:
+                    model = state
+    return model
+
+
+def load_td_model(model_path, ENCODER_MODEL_TD, DEVICE, classes=2, cache_dir=None):
+    '''
+    Tissue detection model is stored as a state dict. All weights come from the checkpoint, so the encoder is built
+    without pretrained weights (no download).
+    With cache_dir the model is cached as state dict + architecture (see wsi_model_cache.py).
+    '''
+    if cache_dir is not None:
+        arch = {'class': 'UnetPlusPlus', 'encoder_name': ENCODER_MODEL_TD, 'classes': classes}
+        load_model = lambda: load_td_model(model_path, ENCODER_MODEL_TD, 'cpu', classes)
+        return load_cached_model(model_path, arch, load_model, DEVICE, cache_dir)
+    model = smp.UnetPlusPlus(
+        encoder_name=ENCODER_MODEL_TD,
+        encoder_weights=None,
+        classes=classes,
+        activation=None,
+    )
+    model.load_state_dict(torch.load(model_path, map_location='cpu'))
+    model.to(DEVICE)
+    model.eval()
+    return model
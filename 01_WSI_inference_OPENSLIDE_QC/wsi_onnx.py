@@ -0,0 +1,137 @@
+# ONNX EXPORT AND ONNX RUNTIME INFERENCE OF THE SEGMENTATION MODELS
+import inspect
+import os
+import numpy as np
+import torch
+from wsi_model_cache import file_sha256
+
+ONNX_OPSET = 17
+
+
+def onnx_path_for(model_path, precision='fp32', cache_dir=None):
+    '''
+    Exported graph is stored next to the checkpoint, named after the SHA-256 of the checkpoint (see file_sha256,
+    cache_dir keeps the hashes): GrandQC_MPP15.pth -> GrandQC_MPP15_<sha256[:12]>.onnx (_int8.onnx). A replaced
+    checkpoint gets new names, so graphs of the old weights are never used for it.
+    '''
+    stem = os.path.splitext(model_path)[0] + '_' + file_sha256(model_path, cache_dir)[:12]
+    if precision == 'int8':
+        return stem + '_int8.onnx'
+    return stem + '.onnx'
+
+
+def export_kwargs():
+    # torch >= 2.5 has a dynamo based exporter as well (the default in newer versions), the TorchScript one is used
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        return {'dynamo': False}
+    return {}
+
+
+def export_onnx(model, onnx_path, m_p_s, opset=ONNX_OPSET):
+    '''
+    Export a segmentation model to ONNX with a dynamic batch axis.
+    Input "input" (N, 3, m_p_s, m_p_s) float32 normalized patches, output "logits" (N, classes, m_p_s, m_p_s).
+    '''
+    model = model.cpu().float().eval()
+    dummy = torch.zeros((1, 3, m_p_s, m_p_s), dtype=torch.float32)
+    # Written under a temporary name first, so an interrupted export never leaves a broken graph behind
+    tmp_path = onnx_path + '.' + str(os.getpid()) + '.tmp'
+    with torch.no_grad():
+        torch.onnx.export(model, (dummy,), tmp_path,
+                          input_names=['input'], output_names=['logits'],
+                          dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}},
+                          opset_version=opset, do_constant_folding=True, **export_kwargs())
+    os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+
+def quantize_onnx(onnx_path, int8_path, calibration_batches=None, per_channel=True):
+    '''
+    INT8 variant of an exported graph written to int8_path.
+    With calibration_batches (iterable of normalized float32 arrays (N, 3, H, W), small N keeps memory low) weights
+    and activations are quantized statically (QDQ format, activation ranges from the calibration data), otherwise
+    only the weights are quantized (dynamic quantization, activations quantized at runtime).
+    '''
+    from onnxruntime.quantization import (quantize_static, quantize_dynamic, CalibrationDataReader, CalibrationMethod,
+                                          QuantFormat, QuantType)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class BatchReader(CalibrationDataReader):
+        def __init__(self, batches):
+            self.batches = iter(batches)
+
+        def get_next(self):
+            batch = next(self.batches, None)
+            return None if batch is None else {'input': np.ascontiguousarray(batch, dtype=np.float32)}
+
+    # Graph is optimized (constant folding, shape inference) before quantization
+    pre_path = int8_path + '.pre.onnx'
+    tmp_path = int8_path + '.tmp'
+    quant_pre_process(onnx_path, pre_path, skip_symbolic_shape=True)
+    try:
+        if calibration_batches is not None:
+            quantize_static(pre_path, tmp_path, BatchReader(calibration_batches), quant_format=QuantFormat.QDQ,
+                            per_channel=per_channel, activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                            calibrate_method=CalibrationMethod.MinMax)
+        else:
+            quantize_dynamic(pre_path, tmp_path, per_channel=per_channel, weight_type=QuantType.QUInt8)
+        os.replace(tmp_path, int8_path)
+    finally:
+        for path in (pre_path, tmp_path):
+            if os.path.exists(path):
+                os.remove(path)
+    return int8_path
+
+
+class OnnxModel(object):
+    """
+    Runs an exported model with ONNX Runtime (all graph optimizations enabled).
+
+    Mimics the part of the smp model interface used by the pipeline: predict() takes and returns torch tensors,
+    to(), eval() and float() are no-ops, so the model can be passed wherever the PyTorch model is used.
+    The CUDA execution provider is used for DEVICE 'cuda' when onnxruntime provides it, otherwise the CPU one.
+    """
+
+    def __init__(self, onnx_path, DEVICE='cpu', threads=0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        providers = ['CPUExecutionProvider']
+        if str(DEVICE).startswith('cuda') and 'CUDAExecutionProvider' in ort.get_available_providers():
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.onnx_path = onnx_path
+        self.session = ort.InferenceSession(onnx_path, sess_options=options, providers=providers)
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, x):
+        x_np = np.ascontiguousarray(x.detach().cpu().numpy(), dtype=np.float32)
+        logits = self.session.run(None, {self.input_name: x_np})[0]
+        return torch.from_numpy(logits).to(x.device)
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def eval(self):
+        return self
+
+    def float(self):
+        return self
+
+
+def load_onnx_model(model_path, load_torch_model, m_p_s, DEVICE='cpu', threads=0, precision='fp32', cache_dir=None):
+    '''
+    ONNX Runtime model for the checkpoint model_path. If the exported graph of this checkpoint is not there yet, the
+    PyTorch model is loaded with load_torch_model() and exported first (see export_onnx.py to export and validate in
+    advance). INT8 graphs (precision 'int8') need calibration patches and are made by quantize_onnx.py only.
+    '''
+    onnx_path = onnx_path_for(model_path, precision, cache_dir)
+    if precision == 'int8':
+        if not os.path.exists(onnx_path):
+            raise FileNotFoundError(f"INT8 model {onnx_path} not found, create it with quantize_onnx.py")
+    elif not os.path.exists(onnx_path):
+        print('Exporting', os.path.basename(model_path), 'to ONNX:', onnx_path)
+        export_onnx(load_torch_model(), onnx_path, m_p_s)
+    return OnnxModel(onnx_path, DEVICE, threads)
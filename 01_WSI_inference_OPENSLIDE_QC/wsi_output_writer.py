@@ -0,0 +1,70 @@
+# BACKGROUND WRITER OF SLIDE OUTPUTS: THE NEXT SLIDE STARTS WHILE THE LAST ONE IS SAVED
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def sync_paths(paths):
+    # Flushes the written files to disk (folders and missing paths are skipped)
+    for path in paths:
+        if os.path.isfile(path):
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+
+class OutputWriter(object):
+    """
+    Saves the outputs of finished slides in workers threads while the caller goes on with the next slide.
+
+    submit(slide_name, save, result) hands over save(), which owns the arrays of the slide, writes its outputs and
+    returns their paths; the files are synced to disk afterwards. At most max_slides slides are being saved at a
+    time: submit blocks until one of them is done, so the memory of finished slides stays bounded.
+    finished() yields (slide_name, result, error) of the slides saved since the last call, drain() waits for all;
+    both run in the calling thread, so the caller can write its report there once the outputs of a slide are on disk.
+    """
+
+    def __init__(self, workers=2, max_slides=2):
+        self.max_slides = max(max_slides, 1)
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1))
+        self._pending = []
+        self._done = []
+
+    def _save(self, save):
+        sync_paths(save())
+
+    def _collect(self):
+        still_pending = []
+        for slide_name, future, result in self._pending:
+            if future.done():
+                self._done.append((slide_name, result, future.exception()))
+            else:
+                still_pending.append((slide_name, future, result))
+        self._pending = still_pending
+
+    def submit(self, slide_name, save, result=None):
+        while len(self._pending) >= self.max_slides:
+            wait([future for _, future, _ in self._pending], return_when=FIRST_COMPLETED)
+            self._collect()
+        self._pending.append((slide_name, self._executor.submit(self._save, save), result))
+
+    def finished(self):
+        self._collect()
+        done, self._done = self._done, []
+        for item in done:
+            yield item
+
+    def drain(self):
+        wait([future for _, future, _ in self._pending])
+        for item in self.finished():
+            yield item
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,409 @@
+# PER-SLIDE STEPS OF THE PIPELINE (TISSUE DETECTION, QC) AND MODEL LOADING, SHARED BY THE ENTRY POINTS
+import os
+import timeit
+import cv2
+import numpy as np
+import torch
+import segmentation_models_pytorch as smp
+from PIL import Image
+from wsi_colors import colors_QC7 as colors
+from wsi_labels import colorize, label_image
+from wsi_maps import make_overlay
+from wsi_mask_tiff import TiledMaskWriter
+from wsi_models import load_qc_model, load_td_model
+from wsi_onnx import load_onnx_model
+from wsi_process import slide_process_single, mask_to_geojson
+from wsi_slide_info import slide_info
+from wsi_slide_reader import open_slide_reader
+from wsi_tis_detect_helper_fx import get_preprocessing
+Image.MAX_IMAGE_PIXELS = 1000000000
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Checkpoints in <MODEL_DIR>/qc and <MODEL_DIR>/td, GRANDQC_MODEL_DIR points to another models folder
+MODEL_DIR = os.environ.get('GRANDQC_MODEL_DIR', os.path.join(SCRIPT_DIR, 'models'))
+MODEL_CACHE_DIR = os.path.join(MODEL_DIR, 'cache')
+
+# MODEL QC
+MODEL_QC_DIR = os.path.join(MODEL_DIR, 'qc')
+MODEL_QC_NAMES = {1.0: 'GrandQC_MPP1.pth', 1.5: 'GrandQC_MPP15.pth', 2.0: 'GrandQC_MPP2.pth'}
+M_P_S_MODEL = 512
+ENCODER_MODEL = 'timm-efficientnet-b0'
+ENCODER_MODEL_WEIGHTS = 'imagenet'
+BACK_CLASS = 7
+
+# MODEL TISSUE DETECTION
+MODEL_TD_DIR = os.path.join(MODEL_DIR, 'td')
+MODEL_TD_NAME = 'Tissue_Detection_MPP10.pth'
+MPP_MODEL_TD = 10
+M_P_S_MODEL_TD = 512
+ENCODER_MODEL_TD = 'timm-efficientnet-b0'
+ENCODER_MODEL_TD_WEIGHTS = 'imagenet'
+
+# TISSUE DETECTION OVERLAY PARAMETERS (TRANSPARENCY)
+OVER_IMAGE = 0.7    # % original image
+OVER_MASK = 0.3     # % segmentation mask
+
+# COLORS for TISSUE DETECTION MASK
+colors_td = [[50, 50, 250],    # BLUE: TISSUE
+             [128, 128, 128]]  # GRAY: BACKGROUND
+
+
+def qc_model_path(mpp_model):
+    if mpp_model not in MODEL_QC_NAMES:
+        raise Exception("mpp of the model can only be 1.0, 1.5, 2.0")
+    return os.path.join(MODEL_QC_DIR, MODEL_QC_NAMES[mpp_model])
+
+
+def load_qc(mpp_model, DEVICE, backend='pytorch', precision='fp32', model_cache="Y"):
+    # QC model for the given MPP; int8 always runs with onnxruntime
+    model_path = qc_model_path(mpp_model)
+    cache_dir = MODEL_CACHE_DIR if model_cache == "Y" else None
+    if backend == 'onnxruntime' or precision == 'int8':
+        return load_onnx_model(model_path,
+                               lambda: load_qc_model(model_path, ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, 'cpu',
+                                                     cache_dir=cache_dir),
+                               M_P_S_MODEL, DEVICE, precision=precision, cache_dir=cache_dir)
+    return load_qc_model(model_path, ENCODER_MODEL, ENCODER_MODEL_WEIGHTS, DEVICE, cache_dir=cache_dir)
+
+
+def load_td(DEVICE, backend='pytorch', precision='fp32', model_cache="Y"):
+    # Tissue detection model; int8 always runs with onnxruntime
+    model_path = os.path.join(MODEL_TD_DIR, MODEL_TD_NAME)
+    cache_dir = MODEL_CACHE_DIR if model_cache == "Y" else None
+    if backend == 'onnxruntime' or precision == 'int8':
+        return load_onnx_model(model_path,
+                               lambda: load_td_model(model_path, ENCODER_MODEL_TD, 'cpu', cache_dir=cache_dir),
+                               M_P_S_MODEL_TD, DEVICE, precision=precision, cache_dir=cache_dir)
+    return load_td_model(model_path, ENCODER_MODEL_TD, DEVICE, cache_dir=cache_dir)
+
+
+def td_preprocessing_fn():
+    return smp.encoders.get_preprocessing_fn(ENCODER_MODEL_TD, ENCODER_MODEL_TD_WEIGHTS)
+
+
+# =============================================================================
+# TISSUE DETECTION
+# =============================================================================
+def tis_det_dirs(output_dir):
+    # Output folders of the tissue detection, created if needed
+    dirs = {'mask': os.path.join(output_dir, 'tis_det_mask/'),
+            'overlay': os.path.join(output_dir, 'tis_det_overlay/'),
+            'thumbnail': os.path.join(output_dir, 'tis_det_thumbnail/'),
+            'mask_col': os.path.join(output_dir, 'tis_det_mask_col/')}
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def tis_det_thumbnail_size(slide):
+    # Size of the thumbnail at MPP_MODEL_TD the tissue detection runs on
+    return slide.thumbnail_size(MPP_MODEL_TD)
+
+
+def detect_tissue(model, preprocessing_fn, image_or, DEVICE, progress=None):
+    '''
+    Tissue detection on the thumbnail image_or (PIL, at MPP_MODEL_TD). Returns the JPEG compressed thumbnail the model
+    saw and the mask (0 - tissue, 1 - background). progress(done, total) is called after every patch row.
+    '''
+
+    '''
+    As tissue detector was trained on jpeg compressed images - we have to reproduce this step.
+    Otherwise it functions suboptimal.
+    '''
+
+    image = np.array(image_or)
+    encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
+    result, image = cv2.imencode('.jpg', image, encode_param)
+    image = cv2.imdecode(image, 1)
+    image = Image.fromarray(image)
+
+    width, height = image.size
+
+    wi_n = width // M_P_S_MODEL_TD
+    he_n = height // M_P_S_MODEL_TD
+
+    overhang_wi = width - wi_n * M_P_S_MODEL_TD
+    overhang_he = height - he_n * M_P_S_MODEL_TD
+
+    print('Overhang (< 1 patch) for width and height: ', overhang_wi, ',', overhang_he)
+
+    p_s = M_P_S_MODEL_TD
+
+    # Output canvas allocated once at final size and written in place per patch
+    end_image = np.zeros((height, width), dtype=np.uint8)
+
+    for h in range(he_n + 1):
+        # The last row of patches is aligned to the bottom border, only its overhang is kept
+        if h != he_n:
+            y_crop, y_off = h * p_s, 0
+        else:
+            y_crop, y_off = height - p_s, p_s - overhang_he
+        if y_off == p_s:
+            continue
+        for w in range(wi_n + 1):
+            # The last column of patches is aligned to the right border, only its overhang is kept
+            if w != wi_n:
+                x_crop, x_off = w * p_s, 0
+            else:
+                x_crop, x_off = width - p_s, p_s - overhang_wi
+            if x_off == p_s:
+                continue
+            image_work = image.crop((x_crop, y_crop, x_crop + p_s, y_crop + p_s))
+
+            image_pre = get_preprocessing(image_work, preprocessing_fn)
+            x_tensor = torch.from_numpy(image_pre).to(DEVICE).unsqueeze(0)
+            predictions = model.predict(x_tensor)
+            predictions = (predictions.squeeze().cpu().numpy())
+
+            mask = np.argmax(predictions, axis=0).astype(np.uint8)
+
+            end_image[y_crop + y_off:y_crop + p_s, x_crop + x_off:x_crop + p_s] = mask[y_off:, x_off:]
+        if progress is not None:
+            progress(h + 1, he_n + 1)
+
+    return image, end_image
+
+
+def save_tissue_outputs(image_or, image, end_image, slide_name, dirs):
+    # Writes thumbnail, mask, colored mask (palette PNG) and overlay of the tissue detection into dirs, returns their
+    # paths
+    thumbnail_path = dirs['thumbnail'] + slide_name + ".jpg"
+    image_or.save(thumbnail_path, quality=80)
+    mask_path = os.path.join(dirs['mask'], slide_name + '_MASK.png')
+    mask_col_path = os.path.join(dirs['mask_col'], slide_name + '_MASK_COL.png')
+    overlay_path = os.path.join(dirs['overlay'], slide_name + '_OVERLAY.jpg')
+    Image.fromarray(end_image).save(mask_path)
+    label_image(end_image, colors_td).save(mask_col_path)
+    overlay = cv2.addWeighted(np.array(image), OVER_IMAGE, colorize(end_image, colors_td), OVER_MASK, 0)
+    overlay = Image.fromarray(overlay)
+    overlay.save(overlay_path)
+    return {'thumbnail': thumbnail_path, 'mask': mask_path, 'mask_col': mask_col_path, 'overlay': overlay_path}
+
+
+def detect_tissue_slide(model, preprocessing_fn, path_slide, slide_name, dirs, DEVICE, progress=None,
+                        thumbnails=None):
+    '''
+    Tissue detection of one slide on its thumbnail at MPP_MODEL_TD. Writes thumbnail, mask (0 - tissue,
+    1 - background), colored mask and overlay into dirs (see tis_det_dirs) and returns their paths.
+    progress(done, total) is called after every patch row.
+    With thumbnails (see ThumbnailCache) the thumbnail comes from the cache if it was decoded from the slide.
+    '''
+    if thumbnails is not None:
+        image_or = thumbnails.view(path_slide, MPP_MODEL_TD, derive=False)
+    else:
+        with open_slide_reader(path_slide) as slide:
+            image_or = slide.thumbnail(MPP_MODEL_TD)
+
+    image, end_image = detect_tissue(model, preprocessing_fn, image_or, DEVICE, progress)
+    return save_tissue_outputs(image_or, image, end_image, slide_name, dirs)
+
+
+# =============================================================================
+# QC
+# =============================================================================
+def qc_dirs(output_dir, create_geojson="Y"):
+    # Output folders of the QC, created if needed
+    dirs = {'maps': os.path.join(output_dir, 'maps_qc'),
+            'overlays': os.path.join(output_dir, 'overlays_qc'),
+            'mask': os.path.join(output_dir, 'mask_qc')}
+    if create_geojson == "Y":
+        dirs['geojson'] = os.path.join(output_dir, 'geojson_qc')
+    for path in dirs.values():
+        os.makedirs(path, exist_ok=True)
+    return dirs
+
+
+def stats_header():
+    # Header of the per-slide report file
+    output_header = "slide_name" + "\t" + "obj_power" + "\t" + "mpp" + "\t"
+    output_header = output_header + "patch_n_h_l0" + "\t" + "patch_n_w_l0" + "\t"
+    output_header = output_header + "patch_overall" + "\t"
+    output_header = output_header + "height" + "\t" + "width" + "\t"
+    output_header = output_header + "time"
+    # Pixels of every class in the QC mask (at model MPP)
+    for c in range(BACK_CLASS + 1):
+        output_header = output_header + "\t" + "px_class_" + str(c)
+    output_header = output_header + "\n"
+    return output_header
+
+
+def qc_slide(model, path_slide, slide_name, output_dir, dirs, mpp_model, DEVICE, batch_size=1, reader_workers=2,
+             prefetch_depth=16, level_tolerance=0.1, overlay_factor=10, create_geojson="Y", progress=None,
+             slide=None, tis_det_map=None, slide_reduced=None, mask_format='png', mask_workers=4,
+             geojson_format='geojson', simplify_um=0, coord_precision=1, geojson_workers=4, geojson_index=True,
+             vector_tiles=False, thumbnails=None, preprocess_workers=1, stage_queue_depth=4, writer=None,
+             own_slide=False):
+    '''
+    QC of one slide with the tissue detection mask from output_dir/tis_det_mask. Writes map, mask, overlay
+    (and GeoJSON) into dirs (see qc_dirs). Returns the line of the per-slide report and the paths of the outputs.
+    progress(done, total) is called after every batch of patches.
+    An already open slide (see SlideReader), the tissue detection mask and the overlay thumbnail can be passed in (see
+    fused_slide), a slide passed in is only closed with own_slide (once its outputs are saved, or on an error).
+    mask_format 'tiff' writes the mask as tiled pyramidal OME-TIFF while the patches are predicted (see
+    TiledMaskWriter), compressed in mask_workers threads.
+    geojson_format 'geoparquet' writes the artifact polygons as GeoParquet instead of GeoJSON; simplify_um,
+    coord_precision and geojson_workers are passed to mask_to_geojson. geojson_index writes the spatial index next to
+    the GeoJSON, vector_tiles a tiled pyramid of the polygons into geojson_qc/<slide>_tiles (see wsi_annotation_index).
+    With thumbnails (see ThumbnailCache) the overlay thumbnail comes from the cache.
+    preprocess_workers and stage_queue_depth configure the stages of the patch pipeline (see slide_process_single).
+    With writer (see OutputWriter) the outputs are saved in the background after the inference and the slide is
+    closed there; the report line is returned at once and comes out of writer.finished() when the outputs are on
+    disk.
+    '''
+    # Register start time
+    start = timeit.default_timer()
+
+    # Open slide
+    close_slide = slide is None or own_slide
+    if slide is None:
+        slide = open_slide_reader(path_slide)
+
+    mask_writer = None
+    try:
+        # GET SLIDE INFO
+        p_s, patch_n_w_l0, patch_n_h_l0, mpp, w_l0, h_l0, obj_power, read_level, p_s_level = slide_info(
+            slide, M_P_S_MODEL, mpp_model, level_tolerance)
+
+        # LOAD TISSUE DETECTION MAP
+        if tis_det_map is None:
+            tis_det_map = np.array(Image.open(os.path.join(output_dir, 'tis_det_mask', slide_name + '_MASK.png')))
+        '''
+        Tissue detection map is generated on MPP = 10
+        This map is used to plan the patches which need model inference, it is used at its original resolution.
+        Classes: 0 - tissue, 1 - background
+        '''
+
+        if mask_format == 'tiff':
+            mask_path = os.path.join(dirs['mask'], slide_name + "_mask.ome.tif")
+            mask_writer = TiledMaskWriter(mask_path, mpp_model, workers=mask_workers)
+
+        map, full_mask, class_pixels = slide_process_single(model, tis_det_map, slide, patch_n_w_l0,
+                                                                patch_n_h_l0, p_s, M_P_S_MODEL, colors, ENCODER_MODEL,
+                                                                ENCODER_MODEL_WEIGHTS, DEVICE, BACK_CLASS, mpp_model,
+                                                                mpp, w_l0, h_l0, batch_size=batch_size,
+                                                                slide_path=path_slide, reader_workers=reader_workers,
+                                                                prefetch_depth=prefetch_depth, read_level=read_level,
+                                                                p_s_level=p_s_level, progress=progress,
+                                                                mask_writer=mask_writer,
+                                                                preprocess_workers=preprocess_workers,
+                                                                stage_queue_depth=stage_queue_depth)
+    except Exception:
+        if mask_writer is not None:
+            mask_writer.close(abort=True)
+        if close_slide:
+            slide.close()
+        raise
+
+    # Timer stop
+    stop = timeit.default_timer()
+
+    # Paths of the outputs
+    outputs = {'map': os.path.join(dirs['maps'], slide_name + "_map_QC.png")}
+    if mask_writer is None:
+        mask_path = os.path.join(dirs['mask'], slide_name + "_mask.png")
+    outputs['mask'] = mask_path
+    if create_geojson == "Y":
+        extension = '.parquet' if geojson_format == 'geoparquet' else '.geojson'
+        outputs['geojson'] = os.path.join(dirs['geojson'], slide_name + extension)
+    outputs['overlay'] = os.path.join(dirs['overlays'], slide_name + "_overlay_QC.jpg")
+
+    def save():
+        # Writes the outputs (owns map, mask and slide from here on), returns the paths of the written files
+        nonlocal map, full_mask, slide_reduced
+        try:
+            map.save(outputs['map'])
+
+            if mask_writer is not None:
+                mask_writer.close()
+            else:
+                cv2.imwrite(mask_path, full_mask)
+            written = [outputs['map'], mask_path]
+            if create_geojson == "Y":
+                geojson_path = outputs['geojson']
+                factor = mpp_model / mpp
+                written += mask_to_geojson(mask_path, geojson_path, factor, mask=full_mask, mask_mpp=mpp_model,
+                                           simplify_um=simplify_um, precision=coord_precision,
+                                           output_format=geojson_format, workers=geojson_workers, index=geojson_index,
+                                           tiles_dir=os.path.join(dirs['geojson'], slide_name + '_tiles')
+                                           if vector_tiles else None)
+
+            del full_mask
+
+            # =============================================================================
+            # 8. MAKE AND SAVE OVERLAY for C8: HEATMAP ON REDUCED AND CROPPED SLIDE CLON
+            # =============================================================================
+            if slide_reduced is None and thumbnails is not None:
+                slide_reduced = thumbnails.view(path_slide, mpp * overlay_factor, slide)
+            overlay = make_overlay(slide, map, p_s, patch_n_w_l0, patch_n_h_l0, overlay_factor, slide_reduced)
+
+            del map, slide_reduced
+
+            # Save overlaid image
+            overlay_im = Image.fromarray(overlay)
+            overlay_im.save(outputs['overlay'])
+            written.append(outputs['overlay'])
+
+            del overlay
+        finally:
+            if close_slide:
+                slide.close()
+        return written
+
+    # Write down per slide result
+    # Basic data about slide (size, pixel size, objective power, height, width)
+    output_temp = slide_name + "\t" + str(obj_power) + "\t" + str(mpp) + "\t"
+    output_temp = output_temp + str(patch_n_h_l0) + "\t" + str(patch_n_w_l0) + "\t"
+    output_temp = output_temp + str(patch_n_h_l0 * patch_n_w_l0) + "\t"
+    output_temp = output_temp + str(patch_n_h_l0 * p_s) + "\t" + str(patch_n_w_l0 * p_s) + "\t"
+
+    output_temp = output_temp + str(round((stop - start) / 60, 1))
+    for c in range(BACK_CLASS + 1):
+        output_temp = output_temp + "\t" + str(class_pixels[c])
+
+    output_temp = output_temp + "\n"
+
+    if writer is None:
+        save()
+    else:
+        writer.submit(slide_name, save, output_temp)
+    return output_temp, outputs
+
+
+# =============================================================================
+# TISSUE DETECTION + QC
+# =============================================================================
+def fused_slide(model_td, preprocessing_fn, model, path_slide, slide_name, output_dir, dirs, mpp_model, DEVICE,
+                tis_det_dirs=None, progress_td=None, overlay_factor=10, thumbnails=None, **qc_options):
+    '''
+    Tissue detection and QC of one slide in one pass: the slide is opened once and the tissue mask goes to the QC in
+    memory. The tissue detection thumbnail is decoded from the slide as in detect_tissue_slide, so the mask does not
+    depend on the way the slide is processed. It is not derived from the finer overlay thumbnail: that would save a
+    decode of a coarse pyramid level, but the mask would then differ from the one of wsi_tis_detect.py (and with
+    overlay_factor). The tissue detection outputs are only written with tis_det_dirs (see tis_det_dirs). With
+    thumbnails (see ThumbnailCache) both thumbnails come from the cache. qc_options are passed to qc_slide.
+    Returns the line of the per-slide report, the paths of the QC outputs and of the tissue detection outputs.
+    '''
+    slide = open_slide_reader(path_slide)
+    try:
+        if thumbnails is not None:
+            image_or = thumbnails.view(path_slide, MPP_MODEL_TD, slide, derive=False)
+            slide_reduced = thumbnails.view(path_slide, slide.mpp * overlay_factor, slide)
+        else:
+            w_l0, h_l0 = slide.levels[0]
+            image_or = slide.get_thumbnail(tis_det_thumbnail_size(slide))
+            slide_reduced = slide.get_thumbnail((w_l0 / overlay_factor, h_l0 / overlay_factor))
+
+        image, tis_det_map = detect_tissue(model_td, preprocessing_fn, image_or, DEVICE, progress_td)
+        outputs_td = {}
+        if tis_det_dirs is not None:
+            outputs_td = save_tissue_outputs(image_or, image, tis_det_map, slide_name, tis_det_dirs)
+        del image, image_or
+    except Exception:
+        slide.close()
+        raise
+
+    # The slide goes to qc_slide, it is closed there once the QC outputs are saved (in the background with a writer)
+    output_temp, outputs = qc_slide(model, path_slide, slide_name, output_dir, dirs, mpp_model, DEVICE,
+                                    overlay_factor=overlay_factor, slide=slide, tis_det_map=tis_det_map,
+                                    slide_reduced=slide_reduced, own_slide=True, **qc_options)
+    return output_temp, outputs, outputs_td
@@ -0,0 +1,334 @@
+"""
+Runs the pipeline (tissue detection, QC, HTML report, PDF report, overlays) as a DAG of steps with declared inputs and
+outputs, per slide where possible. A step is skipped when all its outputs exist, are newer than all its inputs and
+its parameters did not change since its last run (state in <output_dir>/.pipeline_state.json), so re-running a batch
+after adding slides only processes the new slides. Steps without dependencies between them run concurrently; the
+model steps (tissue detection, QC) run one at a time on the device, with each model loaded once and only if needed.
+
+    python wsi_pipeline_runner.py --output_dir OUT [--slide_folder OUT/slides_in] [--jobs 4] [--dry_run] [--force]
+
+The reports read the slides of <output_dir>/slides_in (the layout of run_pipeline.sh).
+"""
+import argparse
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+STEPS = ['tis_detect', 'qc', 'overlays', 'report', 'pdf_report']
+STATE_FILE_NAME = '.pipeline_state.json'
+
+
+class Step(object):
+    '''
+    One node of the DAG: run() produces outputs from inputs; deps are the ids of the steps that must finish first.
+    params are the options the outputs depend on, device steps use the model device and run one at a time.
+    '''
+
+    def __init__(self, step_id, run, inputs, outputs, params=None, deps=(), device=False):
+        self.id = step_id
+        self.run = run
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params_key = hashlib.sha256(json.dumps(params or {}, sort_keys=True).encode()).hexdigest()[:16]
+        self.deps = list(deps)
+        self.device = device
+
+
+def mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def is_fresh(step, state):
+    # Outputs exist, are not older than any input and were made with the same parameters
+    if state.get(step.id, {}).get('params') != step.params_key:
+        return False
+    output_times = [mtime(path) for path in step.outputs]
+    input_times = [mtime(path) for path in step.inputs]
+    if not output_times or None in output_times or None in input_times:
+        return False
+    return not input_times or min(output_times) >= max(input_times)
+
+
+class PipelineState(object):
+    # Parameters and results of the finished steps, saved after every step so an interrupted run loses nothing
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.steps = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.steps = {}
+
+    def update(self, step_id, **fields):
+        with self.lock:
+            self.steps[step_id] = fields
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.steps, f, indent=1)
+            os.replace(tmp_path, self.path)
+
+
+def run_dag(steps, state, jobs=4, force=False, dry_run=False):
+    '''
+    Runs steps in dependency order with up to jobs steps at a time (device steps one at a time). Fresh steps are
+    skipped, steps after a failed step are not run. Returns {step id: 'ran' | 'skipped' | 'failed' | 'blocked'}.
+    '''
+    by_id = {step.id: step for step in steps}
+    result = {}
+
+    def execute(step, upstream_ran):
+        # With dry_run nothing is written, so a step after a step that would run counts as stale
+        if not force and not (dry_run and upstream_ran) and is_fresh(step, state.steps):
+            return 'skipped'
+        if dry_run:
+            print("Would run:", step.id)
+            return 'ran'
+        print("Running:", step.id)
+        start = time.time()
+        try:
+            value = step.run()
+        except Exception as e:
+            print(f"Step {step.id} failed: {e}")
+            return 'failed'
+        state.update(step.id, params=step.params_key, finished=time.time(), seconds=round(time.time() - start, 1),
+                     value=value)
+        return 'ran'
+
+    pending = list(steps)
+    running = {}
+    device_busy = False
+    with ThreadPoolExecutor(max(jobs, 1)) as executor:
+        while pending or running:
+            for step in list(pending):
+                dep_results = [result.get(dep) for dep in step.deps if dep in by_id]
+                if any(r in ('failed', 'blocked') for r in dep_results):
+                    result[step.id] = 'blocked'
+                    pending.remove(step)
+                elif None not in dep_results and len(running) < max(jobs, 1) and not (step.device and device_busy):
+                    pending.remove(step)
+                    device_busy = device_busy or step.device
+                    running[executor.submit(execute, step, 'ran' in dep_results)] = step
+            if not running:
+                continue
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                result[step.id] = future.result()
+                if step.device:
+                    device_busy = False
+    return result
+
+
+def slide_base_name(slide_name):
+    # Slide name without extension, as used by the report and overlay scripts
+    return slide_name.replace('.svs', '').replace('.ndpi', '').replace('.tiff', '')
+
+
+def build_steps(args, slide_names, models):
+    '''
+    Steps of the pipeline for slide_names. models loads (and keeps) the models on first use, see Models.
+    '''
+    from wsi_pipeline import (tis_det_dirs, detect_tissue_slide, qc_dirs, qc_slide, qc_model_path, MODEL_TD_DIR,
+                              MODEL_TD_NAME)
+    from generate_overlays import create_overlay_visualization
+    from wsi_thumbnail_cache import ThumbnailCache
+
+    output_dir = args.output_dir
+    selected = args.steps.split(',')
+    steps = []
+    qc_params = {'mpp_model': args.MPP_MODEL, 'create_geojson': args.create_geojson, 'ol_factor': args.ol_factor,
+                 'level_tolerance': args.level_tolerance, 'backend': args.backend, 'precision': args.precision}
+    td_model_path = os.path.join(MODEL_TD_DIR, MODEL_TD_NAME)
+    thumbnails = ThumbnailCache(os.path.join(output_dir, 'thumbnail_cache'), args.thumbnail_cache_mb) \
+        if args.thumbnail_cache == "Y" else None
+    per_slide_outputs = []
+
+    for slide_name in slide_names:
+        path_slide = os.path.join(args.slide_folder, slide_name)
+        td_outputs = [os.path.join(output_dir, 'tis_det_mask', slide_name + '_MASK.png'),
+                      os.path.join(output_dir, 'tis_det_mask_col', slide_name + '_MASK_COL.png'),
+                      os.path.join(output_dir, 'tis_det_overlay', slide_name + '_OVERLAY.jpg'),
+                      os.path.join(output_dir, 'tis_det_thumbnail', slide_name + '.jpg')]
+        qc_outputs = [os.path.join(output_dir, 'mask_qc', slide_name + '_mask.png'),
+                      os.path.join(output_dir, 'maps_qc', slide_name + '_map_QC.png'),
+                      os.path.join(output_dir, 'overlays_qc', slide_name + '_overlay_QC.jpg')]
+        if args.create_geojson == "Y":
+            qc_outputs.append(os.path.join(output_dir, 'geojson_qc', slide_name + '.geojson'))
+
+        if 'tis_detect' in selected:
+            def run_td(path_slide=path_slide, slide_name=slide_name):
+                model, preprocessing_fn, DEVICE = models.td()
+                detect_tissue_slide(model, preprocessing_fn, path_slide, slide_name, tis_det_dirs(output_dir), DEVICE,
+                                    thumbnails=thumbnails)
+            steps.append(Step('tis_detect/' + slide_name, run_td, [path_slide, td_model_path], td_outputs,
+                              {'backend': args.backend, 'precision': args.precision}, device=True))
+
+        if 'qc' in selected:
+            def run_qc(path_slide=path_slide, slide_name=slide_name):
+                model, DEVICE = models.qc()
+                output_temp, outputs = qc_slide(model, path_slide, slide_name, output_dir,
+                                                qc_dirs(output_dir, args.create_geojson), args.MPP_MODEL, DEVICE,
+                                                batch_size=args.batch_size, reader_workers=args.reader_workers,
+                                                prefetch_depth=args.prefetch_depth,
+                                                preprocess_workers=args.preprocess_workers,
+                                                stage_queue_depth=args.stage_queue_depth,
+                                                level_tolerance=args.level_tolerance, overlay_factor=args.ol_factor,
+                                                create_geojson=args.create_geojson, thumbnails=thumbnails)
+                # Kept in the state, the per-slide report lists skipped slides as well
+                return output_temp
+            steps.append(Step('qc/' + slide_name, run_qc, [path_slide, td_outputs[0], qc_model_path(args.MPP_MODEL)],
+                              qc_outputs, qc_params, ['tis_detect/' + slide_name], device=True))
+
+        base_name = slide_base_name(slide_name)
+        overlay_path = os.path.join(output_dir, 'visualization_overlays', base_name + '_visualization.jpg')
+        if 'overlays' in selected:
+            def run_overlay(base_name=base_name, overlay_path=overlay_path, path_slide=path_slide):
+                overlay = create_overlay_visualization(output_dir, base_name, path_slide, thumbnails)
+                if overlay is None:
+                    raise Exception(f"no overlay for {base_name}")
+                os.makedirs(os.path.dirname(overlay_path), exist_ok=True)
+                overlay.save(overlay_path, quality=95)
+            steps.append(Step('overlays/' + slide_name, run_overlay, [td_outputs[3], qc_outputs[0]], [overlay_path],
+                              deps=['tis_detect/' + slide_name, 'qc/' + slide_name]))
+        per_slide_outputs.append((slide_name, td_outputs + qc_outputs, overlay_path))
+
+    def run_script(script, *script_args):
+        process = subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, script), '--output_dir', output_dir]
+                                 + list(script_args), capture_output=True, text=True)
+        print(process.stdout, end='')
+        if process.returncode != 0:
+            raise Exception(process.stderr.strip().splitlines()[-1] if process.stderr.strip() else script)
+
+    # Cohort steps: inputs are the outputs of all slides
+    report_inputs = [path for slide_name, outputs, overlay_path in per_slide_outputs for path in outputs
+                     if os.path.basename(path).endswith(('_MASK.png', '_mask.png', '.jpg'))]
+    slide_deps = [prefix + slide_name for slide_name in slide_names for prefix in ('tis_detect/', 'qc/')]
+    if 'report' in selected:
+        steps.append(Step('report', lambda: run_script('generate_report.py'), report_inputs,
+                          [os.path.join(output_dir, 'report.html')], {'slides': slide_names}, slide_deps))
+    if 'pdf_report' in selected:
+        # The PDF embeds the visualization overlays, so it waits for them
+        steps.append(Step('pdf_report', lambda: run_script('generate_pdf_report.py'),
+                          report_inputs + [overlay_path for _, _, overlay_path in per_slide_outputs],
+                          [os.path.join(output_dir, 'report.pdf')], {'slides': slide_names},
+                          slide_deps + ['overlays/' + slide_name for slide_name in slide_names]))
+    return steps
+
+
+class Models(object):
+    # Models of the device steps, loaded on first use so a run with nothing to do loads none
+    def __init__(self, args):
+        self.args = args
+        self.lock = threading.Lock()
+        self._td = None
+        self._qc = None
+        import torch
+        if torch.cuda.is_available():
+            self.DEVICE = 'cuda'
+        elif torch.backends.mps.is_available():
+            self.DEVICE = 'mps'
+        else:
+            self.DEVICE = 'cpu'
+
+    def td(self):
+        from wsi_pipeline import load_td, td_preprocessing_fn
+        with self.lock:
+            if self._td is None:
+                self._td = load_td(self.DEVICE, self.args.backend, self.args.precision, self.args.model_cache)
+            return self._td, td_preprocessing_fn(), self.DEVICE
+
+    def qc(self):
+        from wsi_pipeline import load_qc
+        with self.lock:
+            if self._qc is None:
+                self._qc = load_qc(self.args.MPP_MODEL, self.DEVICE, self.args.backend, self.args.precision,
+                                   self.args.model_cache)
+            return self._qc, self.DEVICE
+
+
+def write_stats(output_dir, slide_names, state):
+    # Per-slide report of all slides with a QC result, including those skipped in this run
+    from wsi_pipeline import stats_header
+
+    path_result = os.path.join(output_dir, 'report_' + os.path.basename(os.path.normpath(output_dir)) +
+                               '_pipeline_stats_per_slide.txt')
+    results = open(path_result, "w")
+    results.write(stats_header())
+    for slide_name in slide_names:
+        output_temp = state.steps.get('qc/' + slide_name, {}).get('value')
+        if output_temp:
+            results.write(output_temp)
+    results.close()
+    return path_result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output_dir', dest='output_dir', required=True, help='path to output folder', type=str)
+    parser.add_argument('--slide_folder', dest='slide_folder', default=None,
+                        help='path to WSIs (default: <output_dir>/slides_in)', type=str)
+    parser.add_argument('--steps', dest='steps', default=','.join(STEPS),
+                        help='comma separated steps: ' + ', '.join(STEPS), type=str)
+    parser.add_argument('--jobs', dest='jobs', default=4, help='maximum number of steps running at once', type=int)
+    parser.add_argument('--force', dest='force', action='store_true', help='run all steps, also the fresh ones')
+    parser.add_argument('--dry_run', dest='dry_run', action='store_true', help='only list the steps that would run')
+    parser.add_argument('--mpp_model', dest='MPP_MODEL', default=1.5,
+                        help='MPP of the training model, should only be 1.0, 1.5, 2.0', type=float)
+    parser.add_argument('--create_geojson', dest='create_geojson', help='create geojson for QC or not', default="Y",
+                        type=str)
+    parser.add_argument('--ol_factor', dest='ol_factor', default=10,
+                        help='reduction factor of the overlay compared to dimensions of original WSI', type=int)
+    parser.add_argument('--batch_size', dest='batch_size', default=1,
+                        help='number of tissue patches predicted in one forward pass of the model', type=int)
+    parser.add_argument('--reader_workers', dest='reader_workers', default=2,
+                        help='number of threads reading patches ahead of the inference', type=int)
+    parser.add_argument('--prefetch_depth', dest='prefetch_depth', default=16,
+                        help='maximum number of patches read ahead of the inference', type=int)
+    parser.add_argument('--preprocess_workers', dest='preprocess_workers', default=1,
+                        help='number of threads stacking batches and their tissue masks for the inference', type=int)
+    parser.add_argument('--stage_queue_depth', dest='stage_queue_depth', default=4,
+                        help='maximum number of batches waiting between two stages of the patch pipeline', type=int)
+    parser.add_argument('--level_tolerance', dest='level_tolerance', default=0.1,
+                        help='relative tolerance for reading patches from a coarser pyramid level', type=float)
+    parser.add_argument('--backend', dest='backend', default='pytorch', choices=['pytorch', 'onnxruntime'],
+                        help='inference backend of the models', type=str)
+    parser.add_argument('--precision', dest='precision', default='fp32', choices=['fp32', 'int8'],
+                        help='int8 - INT8 quantized models (always runs with onnxruntime)', type=str)
+    parser.add_argument('--model_cache', dest='model_cache', default="Y",
+                        help='cache the loaded models in models/cache or not', type=str)
+    parser.add_argument('--thumbnail_cache', dest='thumbnail_cache', default="Y",
+                        help='share the slide thumbnails between the steps in <output_dir>/thumbnail_cache or not',
+                        type=str)
+    parser.add_argument('--thumbnail_cache_mb', dest='thumbnail_cache_mb', default=2048,
+                        help='size limit of the thumbnail cache in MB', type=float)
+    args = parser.parse_args()
+
+    if any(step not in STEPS for step in args.steps.split(',')):
+        raise Exception(f"steps should be a subset of {', '.join(STEPS)}")
+    if args.precision == 'int8':
+        args.backend = 'onnxruntime'
+    if args.slide_folder is None:
+        args.slide_folder = os.path.join(args.output_dir, 'slides_in')
+
+    slide_names = sorted([f for f in os.listdir(args.slide_folder)
+                          if os.path.isfile(os.path.join(args.slide_folder, f))])
+    state = PipelineState(os.path.join(args.output_dir, STATE_FILE_NAME))
+    steps = build_steps(args, slide_names, Models(args))
+    result = run_dag(steps, state, args.jobs, args.force, args.dry_run)
+
+    counts = {r: list(result.values()).count(r) for r in ['ran', 'skipped', 'failed', 'blocked']}
+    print(f"Steps: {counts['ran']} ran, {counts['skipped']} up to date, {counts['failed']} failed, "
+          f"{counts['blocked']} not run after a failed step")
+    if 'qc' in args.steps.split(',') and not args.dry_run:
+        print("Per-slide report:", write_stats(args.output_dir, slide_names, state))
+    sys.exit(1 if counts['failed'] else 0)
@@ -1,136 +1,163 @@
 # MAIN LOOP TO PROCESS WSI
 import numpy as np
-from PIL import Image
 import segmentation_models_pytorch as smp
 import torch
 from tqdm import tqdm
 import cv2
-import json
+from wsi_vectorize import (CLASS_MAPPING, ARTIFACT_CLASSES, mask_polygons, write_geojson,
+                           write_geoparquet)
+from wsi_annotation_index import feature_boxes, write_index, write_vector_tiles
+from wsi_labels import colorize, label_image, mode_pool
+from wsi_tile_reader import TilePrefetcher
+from wsi_tile_plan import plan_tissue_tiles, tissue_patch
+from wsi_stages import Stage, StagePipeline
 
 #Helper functions
-def to_tensor_x(x, **kwargs):
-    return x.transpose(2, 0, 1).astype('float32')
+def get_normalization(ENCODER_MODEL_1, ENCODER_WEIGHTS, DEVICE):
+    # Preprocessing parameters of the encoder as tensors on the inference device, shaped for (N, 3, H, W) batches
+    params = smp.encoders.get_preprocessing_params(ENCODER_MODEL_1, ENCODER_WEIGHTS)
+    scale = 1 / 255 if params.get('input_range') is not None and max(params['input_range']) == 1 else 1
+    mean = torch.tensor(params.get('mean') or [0, 0, 0], dtype=torch.float32, device=DEVICE).view(1, 3, 1, 1)
+    std = torch.tensor(params.get('std') or [1, 1, 1], dtype=torch.float32, device=DEVICE).view(1, 3, 1, 1)
+    bgr = params.get('input_space') == 'BGR'
+    return scale, mean, std, bgr
 
-def get_preprocessing(image, preprocessing_fn, model_size):
-    if image.size != model_size:
-        image = image.resize(model_size)
-        print('resized')
-    image = np.array(image)
-    x = preprocessing_fn(image)
-    x = to_tensor_x(x)
-    return x
 
-
-def make_1class_map_thr(mask, class_colors):
-    r = np.zeros_like(mask).astype(np.uint8)
-    g = np.zeros_like(mask).astype(np.uint8)
-    b = np.zeros_like(mask).astype(np.uint8)
-    for l in range(1, len(class_colors)+1):
-        idx = mask == l
-        r[idx] = class_colors [l-1][0]
-        g[idx] = class_colors [l-1][1]
-        b[idx] = class_colors [l-1][2]
-
-    rgb = np.stack([r, g, b], axis=2)
-    return rgb
-
-
-def slide_process_single(model, tis_det_map_mpp, slide, patch_n_w_l0, patch_n_h_l0, p_s, m_p_s, colors,
-                         ENCODER_MODEL_1,ENCODER_WEIGHTS, DEVICE, BACK_CLASS, MPP_MODEL_1, mpp, w_l0, h_l0):
+def predict_batch(model, batch, td_batch, norm, BACK_CLASS, DEVICE):
     '''
-    Tissue detection map is generated under MPP = 4, therefore model patch size of (512,512) corresponds to tis_det_map patch
-    size of (128,128).
+    Predict a batch of uint8 RGB patches (H, W, 3), a list or stacked (N, H, W, 3), with one forward pass.
+    Normalization, argmax, tissue masking (td_batch == 1 -> BACK_CLASS) and the per-class pixel histogram are done
+    with torch on the inference device; only the uint8 masks (N, H, W) are copied back.
     '''
-
-    model_size = (m_p_s, m_p_s)
-    preprocessing_fn = smp.encoders.get_preprocessing_fn(ENCODER_MODEL_1, ENCODER_WEIGHTS)
-
-    # Start loop
-    for he in tqdm(range(patch_n_h_l0), total=patch_n_h_l0):
-        h = he * p_s + 1
-        if (he == 0):
-            h = 0
-        # print("Current cycle ", he + 1, " of ", patch_n_h_l0)
-        for wi in range(patch_n_w_l0):
-            w = wi * p_s + 1
-            if (wi == 0):
-                w = 0
-            #he = 12
-            #wi = 15
-            td_patch = tis_det_map_mpp [he*m_p_s:(he+1)*m_p_s,wi*m_p_s:(wi+1)*m_p_s]
-            if td_patch.shape != (512,512):
-                # td_patch padding (incase td_patch does not equal (512,512))
-                original_shape = td_patch.shape
-
-                # Desired shape
-                desired_shape = (512, 512)
-
-                # Calculate padding needed
-                padding = [(0, desired_shape[i] - original_shape[i]) for i in range(2)]
-
-                # Apply padding
-                td_patch_ = np.pad(td_patch, padding, mode='constant')
-            else:
-                td_patch_ = td_patch
-
-            if np.count_nonzero(td_patch == 0) > 50: #here change to check of segmentation map
-                # Generate patch
-                work_patch = slide.read_region((w, h), 0, (p_s, p_s))
-                work_patch = work_patch.convert('RGB')
-
-                # Resize to model patch size
-                work_patch = work_patch.resize((m_p_s, m_p_s), Image.Resampling.LANCZOS)
-
-                image_pre = get_preprocessing(work_patch, preprocessing_fn, model_size)
-                x_tensor = torch.from_numpy(image_pre).float().to(DEVICE).unsqueeze(0)
-                # Inference: ensure no gradients are kept to reduce memory use
-                model.to(DEVICE).float()
-                model.eval()
-                with torch.no_grad():
-                    predictions = model.predict(x_tensor)
-                predictions = (predictions.squeeze().cpu().numpy())
-
-                mask_raw = np.argmax(predictions, axis=0).astype('int8')
-                mask = np.where(td_patch_ == 1, BACK_CLASS, mask_raw)
-
-
-            else:
-                mask = np.full((512,512), BACK_CLASS)
+    scale, mean, std, bgr = norm
+    x_tensor = torch.from_numpy(batch if isinstance(batch, np.ndarray) else np.stack(batch)).to(DEVICE)
+    x_tensor = x_tensor.permute(0, 3, 1, 2).float()
+    if bgr:
+        x_tensor = x_tensor.flip(1)
+    x_tensor = (x_tensor * scale - mean) / std
+    with torch.no_grad():
+        predictions = model.predict(x_tensor)
+    masks = predictions.argmax(dim=1)
+    td_tensor = torch.from_numpy(td_batch if isinstance(td_batch, np.ndarray) else np.stack(td_batch)).to(DEVICE)
+    masks[td_tensor == 1] = BACK_CLASS
+    hist = torch.bincount(masks.flatten(), minlength=max(predictions.shape[1], BACK_CLASS + 1))
+    return masks.to(torch.uint8).cpu().numpy(), hist
 
 
+def make_1class_map_thr(mask, class_colors):
+    # RGB map of the QC labels 1..len(class_colors), 0 (buffer) is black
+    return colorize(mask, class_colors, first_label=1)
 
-            if (wi == 0):
-                temp_image = mask
 
-            else:
-                temp_image = np.concatenate((temp_image, mask), axis=1)
+def slide_process_single(model, tis_det_map, slide, patch_n_w_l0, patch_n_h_l0, p_s, m_p_s, colors,
+                         ENCODER_MODEL_1,ENCODER_WEIGHTS, DEVICE, BACK_CLASS, MPP_MODEL_1, mpp, w_l0, h_l0, batch_size=1,
+                         slide_path=None, reader_workers=0, prefetch_depth=16, read_level=0, p_s_level=None, progress=None,
+                         mask_writer=None, preprocess_workers=1, stage_queue_depth=4):
+    '''
+    Tissue detection map is generated under MPP = 10 (classes: 0 - tissue, 1 - background). The patches to process are
+    planned on this map directly; for every planned patch only its part of the map is sampled to model patch size.
+    Patches with tissue are collected into batches of batch_size and predicted with one forward pass per batch;
+    the resulting masks are written in place into the output canvas at their grid positions.
+    The work runs as a pipeline of stages (see StagePipeline) connected by queues of stage_queue_depth batches:
+    read (patches read and resized by the reader), preprocess (batches stacked with their tissue masks, in
+    preprocess_workers threads), infer (one forward pass per batch on DEVICE) and write (masks placed, pixels per
+    class counted). The busy time of every stage and the slowest one are printed at the end.
+    Normalization and postprocessing run on DEVICE; the number of pixels per class of the mask is returned as well.
+    With reader_workers > 0 patches are read from slide_path by a pool of background threads, up to prefetch_depth
+    patches ahead of the inference.
+    Patches are read at pyramid level read_level, where they have size p_s_level (p_s at level 0).
+    progress(done, total) is called after every predicted batch.
+    mask_writer (see TiledMaskWriter) gets the output canvas and is told which rows are final after every batch.
+    The returned map is a palette image of the mask, mode pooled to 50 px per patch (see wsi_labels).
+    '''
 
-        if (he == 0):
-            end_image = temp_image
+    norm = get_normalization(ENCODER_MODEL_1, ENCODER_WEIGHTS, DEVICE)
 
-        else:
-            end_image = np.concatenate((end_image, temp_image), axis=0)
+    model.to(DEVICE).float()
+    model.eval()
 
     # now get size of padded region (buffer) at Model MPP
     buffer_right_l = int((w_l0 - (patch_n_w_l0 * p_s)) * mpp / MPP_MODEL_1)
     buffer_bottom_l = int((h_l0 - (patch_n_h_l0 * p_s)) * mpp / MPP_MODEL_1)
-    # firstly bottom
-    buffer_bottom = np.full((buffer_bottom_l, end_image.shape[1]), 0)
-    temp_image = np.concatenate((end_image, buffer_bottom), axis=0)
-    # now right side
-    temp_image_he, temp_image_wi = temp_image.shape  # width and height
-    buffer_right = np.full((temp_image_he, buffer_right_l), 0)
-    end_image = np.concatenate((temp_image, buffer_right), axis=1).astype(np.uint8)
-
-    end_image_1class = make_1class_map_thr(end_image, colors)
-    end_image_1class = Image.fromarray(end_image_1class)
-    end_image_1class = end_image_1class.resize((patch_n_w_l0*50, patch_n_h_l0*50), Image.Resampling.LANCZOS)
 
-
-    return end_image_1class, end_image
-
-
-def mask_to_geojson(mask_path, output_path, scale_factor=1.0):
+    # Output canvas allocated once at final size: patch grid is background by default, buffer is 0
+    end_image = np.zeros((patch_n_h_l0 * m_p_s + buffer_bottom_l, patch_n_w_l0 * m_p_s + buffer_right_l),
+                         dtype=np.uint8)
+    end_image[:patch_n_h_l0 * m_p_s, :patch_n_w_l0 * m_p_s] = BACK_CLASS
+    if mask_writer is not None:
+        mask_writer.start(end_image)
+
+    # Pixels per class of the predicted patches
+    class_pixels = np.zeros(BACK_CLASS + 1, dtype=np.int64)
+    done = [0]
+
+    # Select patches with tissue
+    tiles = []
+    for he, wi in plan_tissue_tiles(tis_det_map, w_l0, h_l0, p_s, patch_n_w_l0, patch_n_h_l0).tolist():
+        h = he * p_s + 1 if he > 0 else 0
+        w = wi * p_s + 1 if wi > 0 else 0
+        tiles.append(((he, wi), (w, h)))
+
+    # Patches are read (and resized to model patch size) ahead of the inference
+    reader = TilePrefetcher(slide_path, p_s_level or p_s, m_p_s, workers=reader_workers if slide_path else 0,
+                            queue_depth=prefetch_depth, slide=slide, level=read_level)
+
+    def read_batches():
+        # Patches in batches of batch_size, the last one may be incomplete
+        batch = []
+        for (he, wi), work_patch in reader.iter_tiles(tiles):
+            batch.append(((he, wi), work_patch))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def preprocess(batch):
+        # Grid positions, uint8 patches (N, H, W, 3) and tissue masks (N, H, W) of a batch
+        positions = [position for position, _ in batch]
+        patches = np.stack([np.asarray(work_patch) for _, work_patch in batch])
+        td = np.stack([tissue_patch(tis_det_map, he, wi, w_l0, h_l0, p_s, m_p_s) for he, wi in positions])
+        return positions, patches, td
+
+    def infer(item):
+        positions, patches, td = item
+        masks, hist = predict_batch(model, patches, td, norm, BACK_CLASS, DEVICE)
+        return positions, masks, hist
+
+    def write(item):
+        positions, masks, hist = item
+        for (he_b, wi_b), mask in zip(positions, masks):
+            end_image[he_b * m_p_s:(he_b + 1) * m_p_s, wi_b * m_p_s:(wi_b + 1) * m_p_s] = mask
+        class_pixels[:] += hist.cpu().numpy()[:BACK_CLASS + 1]
+        done[0] += len(positions)
+        if mask_writer is not None:
+            # Patches are predicted row by row: rows above the last predicted patch row are final
+            mask_writer.rows_done(positions[-1][0] * m_p_s)
+        if progress is not None:
+            progress(done[0], len(tiles))
+        return len(positions)
+
+    pipeline = StagePipeline('read', [Stage('preprocess', preprocess, preprocess_workers), Stage('infer', infer),
+                                      Stage('write', write)], queue_depth=stage_queue_depth)
+    with reader, tqdm(total=len(tiles)) as bar:
+        for n_done in pipeline.run(read_batches()):
+            bar.update(n_done)
+    print(pipeline.report())
+
+    # Pixels per class of the whole mask: predicted patches, background patches and the buffer (0)
+    class_pixels[BACK_CLASS] += (patch_n_h_l0 * patch_n_w_l0 - len(tiles)) * m_p_s * m_p_s
+    class_pixels[0] += end_image.size - patch_n_h_l0 * patch_n_w_l0 * m_p_s * m_p_s
+
+    # Map: labels mode pooled to 50 px per patch, colors in the palette
+    end_image_1class = mode_pool(end_image, (patch_n_w_l0 * 50, patch_n_h_l0 * 50), n_labels=len(colors) + 1)
+    end_image_1class = label_image(end_image_1class, colors, first_label=1)
+
+    return end_image_1class, end_image, class_pixels
+
+
+def mask_to_geojson(mask_path, output_path, scale_factor=1.0, mask=None, mask_mpp=None, simplify_um=0, precision=1,
+                    output_format='geojson', workers=0, index=True, tiles_dir=None):
     """
     Convert a semantic segmentation mask to GeoJSON with coordinate scaling
 
@@ -142,82 +169,53 @@ def mask_to_geojson(mask_path, output_path, scale_factor=1.0):
         Path to save the output GeoJSON file
     scale_factor : float, optional, should be: model_mpp / slide_mpp
         Factor to scale coordinates by (default: 1.0)
+    mask : numpy array, optional
+        The mask itself, mask_path is not read then
+    mask_mpp : float, optional
+        MPP of the mask (model MPP), needed for simplify_um
+    simplify_um : float, optional
+        Douglas-Peucker tolerance in microns, 0 - no simplification (default: 0)
+    precision : int, optional
+        Decimals of the coordinates (default: 1)
+    output_format : str, optional
+        'geojson' or 'geoparquet' (WKB geometries, needs pyarrow)
+    workers : int, optional
+        Threads tracing the strips and units of the mask, 0 - in this thread (default: 0)
+    index : bool, optional
+        Write the spatial index <output_path>.idx next to the GeoJSON (default: True)
+    tiles_dir : str, optional
+        Folder for a tiled pyramid of the polygons (see write_vector_tiles), not written by default
 
     Returns:
     --------
-    None
+    Paths of the written files
     """
-    # Define class mapping
-    CLASS_MAPPING = {
-        1: "Normal Tissue",
-        2: "Fold",
-        3: "Darkspot & Foreign Object",
-        4: "PenMarking",
-        5: "Edge & Air Bubble",
-        6: "OOF",  # Out of Focus
-        7: "Background"
-    }
-
     # Read the mask image
-    mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
-
-    # Dictionary to store features for each class
-    features = []
-
-    # Iterate through unique class values (1 to 7)
-    for class_value in range(2, 7):
-        # Create a binary mask for the current class
-        class_mask = (mask == class_value).astype(np.uint8) * 255
-
-        # Find contours
-        contours, _ = cv2.findContours(class_mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-
-        # Convert contours to GeoJSON features
-        for contour in contours:
-            # Flatten contour and reshape
-            contour_points = contour.reshape(-1, 2)
-
-            # Scale coordinates
-            scaled_points = contour_points * scale_factor
-
-            # Skip contours with less than 4 points
-            if len(scaled_points) < 4:
-                # print(f"Skipping contour with {len(scaled_points)} points for class {class_value}")
-                continue
-
-            # Ensure polygon is closed by adding first point at the end if needed
-            polygon_points = scaled_points.tolist()
-            if not np.array_equal(polygon_points[0], polygon_points[-1]):
-                polygon_points.append(polygon_points[0])
-
-            # Create feature for this polygon
-            feature = {
-                "type": "Feature",
-                "properties": {
-                    "class_id": int(class_value),
-                    "classification": CLASS_MAPPING.get(class_value, "Unknown"),
-                    "area": cv2.contourArea(contour) * (scale_factor ** 2)
-                },
-                "geometry": {
-                    "type": "Polygon",
-                    "coordinates": [polygon_points]
-                }
-            }
-
-            features.append(feature)
-
-    # Create GeoJSON structure
-    geojson = {
-        "type": "FeatureCollection",
-        "features": features,
-        "metadata": {
-            "class_mapping": CLASS_MAPPING,
-            "scale_factor": scale_factor
-        }
-    }
-
-    # Write to file
-    with open(output_path, 'w') as f:
-        json.dump(geojson, f, indent=2)
-
-
+    if mask is None:
+        mask = cv2.imread(mask_path, cv2.IMREAD_UNCHANGED)
+
+    simplify_px = 0
+    if simplify_um > 0:
+        if mask_mpp is None:
+            raise Exception("simplify_um needs the MPP of the mask")
+        simplify_px = simplify_um / mask_mpp
+
+    # Artifact classes traced per unit of connected cells (in parallel), holes are kept
+    features = mask_polygons(mask, scale_factor, ARTIFACT_CLASSES, simplify_px, precision, workers=workers)
+
+    metadata = {"class_mapping": CLASS_MAPPING, "scale_factor": scale_factor, "simplify_um": simplify_um,
+                "precision": precision}
+    written = [output_path]
+    if output_format == 'geoparquet':
+        write_geoparquet(features, output_path, metadata)
+    else:
+        offsets, lengths = write_geojson(features, output_path, metadata, precision)
+        if index:
+            write_index(output_path + '.idx', feature_boxes(features), [f['class_id'] for f in features], offsets,
+                        lengths)
+            written.append(output_path + '.idx')
+    if tiles_dir is not None:
+        extent = (mask.shape[1] * scale_factor, mask.shape[0] * scale_factor)
+        written += write_vector_tiles(features, tiles_dir, extent,
+                                      lambda class_id: CLASS_MAPPING.get(class_id, "Unknown"))
+    return written
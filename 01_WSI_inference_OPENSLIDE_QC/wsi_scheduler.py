@@ -0,0 +1,146 @@
+# MULTI-PROCESS SLIDE SCHEDULER: SLIDES LARGEST-FIRST OVER A POOL OF QC WORKERS WITH THEIR OWN THREAD BUDGET / CORES
+import multiprocessing
+import os
+import queue
+import numpy as np
+from PIL import Image
+Image.MAX_IMAGE_PIXELS = 1000000000
+
+# State of a worker process: model, output folders and options (set by init_worker)
+_worker = {}
+
+
+def tissue_pixels(output_dir, slide_name):
+    # Number of tissue pixels (0 - tissue) in the tissue detection mask of a slide, None without mask
+    mask_path = os.path.join(output_dir, 'tis_det_mask', slide_name + '_MASK.png')
+    try:
+        return int(np.count_nonzero(np.array(Image.open(mask_path)) == 0))
+    except (OSError, ValueError):
+        return None
+
+
+def slide_works(slide_names, slide_dir, output_dir):
+    '''
+    Estimated amount of work of every slide, in one unit for all of them: the tissue area in the tissue detection
+    masks (MPP 10 pixels), which is proportional to the number of patches main.py predicts, if every slide has a mask;
+    otherwise the file sizes of all slides (tissue pixels and bytes do not compare).
+    '''
+    works = [tissue_pixels(output_dir, slide_name) for slide_name in slide_names]
+    if None in works:
+        works = [os.path.getsize(os.path.join(slide_dir, slide_name)) for slide_name in slide_names]
+    return dict(zip(slide_names, works))
+
+
+def largest_first(slide_names, slide_dir, output_dir):
+    # Big slides start first, so a big slide does not end up alone at the end of the run
+    works = slide_works(slide_names, slide_dir, output_dir)
+    return sorted(slide_names, key=lambda name: works[name], reverse=True)
+
+
+def available_cores():
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def worker_budgets(workers, threads_per_worker=0):
+    '''
+    Cores and torch thread number of every worker: the available cores are split into workers contiguous sets,
+    threads_per_worker = 0 uses the size of the set. With more workers than cores the workers share cores round-robin.
+    '''
+    cores = available_cores()
+    if workers > len(cores):
+        print(f"Warning: {workers} workers for {len(cores)} cores, workers will share cores")
+        core_sets = [[cores[i % len(cores)]] for i in range(workers)]
+    else:
+        core_sets = [[int(c) for c in core_set] for core_set in np.array_split(np.array(cores), workers)]
+    budgets = []
+    for i, core_set in enumerate(core_sets):
+        threads = threads_per_worker if threads_per_worker > 0 else max(len(core_set), 1)
+        budgets.append((i, core_set, threads))
+    return budgets
+
+
+def init_worker(options, budget_queue):
+    import torch
+    from wsi_pipeline import load_qc, load_td, td_preprocessing_fn, tis_det_dirs, qc_dirs
+
+    try:
+        index, core_set, threads = budget_queue.get(timeout=10)
+    except queue.Empty:
+        # Replacement of a crashed worker: no budget left, share all cores
+        index, core_set, threads = 0, [], max(options['threads_per_worker'], 1)
+    if options['pin_cores'] == "Y" and core_set and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, core_set)
+    torch.set_num_threads(threads)
+
+    # DEVICE - Auto-detect available device, workers are spread over the GPUs
+    if torch.cuda.is_available():
+        DEVICE = 'cuda:' + str(index % torch.cuda.device_count())
+    elif torch.backends.mps.is_available():
+        DEVICE = 'mps'
+    else:
+        DEVICE = 'cpu'
+    print(f"Worker {index} (pid {os.getpid()}): {DEVICE}, {threads} threads",
+          f"on cores {core_set}" if options['pin_cores'] == "Y" and core_set else "")
+
+    _worker['options'] = options
+    _worker['DEVICE'] = DEVICE
+    _worker['model'] = load_qc(options['mpp_model'], DEVICE, options['backend'], options['precision'],
+                               options['model_cache'])
+    _worker['dirs'] = qc_dirs(options['output_dir'], options['create_geojson'])
+    # Tissue detection fused into the QC pass (see fused_slide)
+    if options.get('tis_detect') == "Y":
+        _worker['model_td'] = load_td(DEVICE, options['backend'], options['precision'], options['model_cache'])
+        _worker['preprocessing_fn'] = td_preprocessing_fn()
+        _worker['td_dirs'] = tis_det_dirs(options['output_dir']) if options['save_tis_det'] == "Y" else None
+
+
+def run_slide(slide_name):
+    # QC of one slide in a worker, returns (slide_name, line of the per-slide report or None, error or None)
+    from wsi_pipeline import qc_slide, fused_slide
+
+    options = _worker['options']
+    try:
+        print("")
+        print("Processing:", slide_name)
+        path_slide = os.path.join(options['slide_dir'], slide_name)
+        qc_options = dict(batch_size=options['batch_size'], reader_workers=options['reader_workers'],
+                          prefetch_depth=options['prefetch_depth'], level_tolerance=options['level_tolerance'],
+                          preprocess_workers=options['preprocess_workers'],
+                          stage_queue_depth=options['stage_queue_depth'],
+                          overlay_factor=options['overlay_factor'], create_geojson=options['create_geojson'],
+                          mask_format=options['mask_format'], mask_workers=options['mask_workers'],
+                          geojson_format=options['geojson_format'], simplify_um=options['simplify_um'],
+                          coord_precision=options['coord_precision'], geojson_workers=options['geojson_workers'],
+                          geojson_index=options['geojson_index'], vector_tiles=options['vector_tiles'],
+                          thumbnails=options['thumbnails'])
+        if 'model_td' in _worker:
+            output_temp, outputs, outputs_td = fused_slide(_worker['model_td'], _worker['preprocessing_fn'],
+                                                           _worker['model'], path_slide, slide_name,
+                                                           options['output_dir'], _worker['dirs'],
+                                                           options['mpp_model'], _worker['DEVICE'],
+                                                           tis_det_dirs=_worker['td_dirs'], **qc_options)
+        else:
+            output_temp, outputs = qc_slide(_worker['model'], path_slide, slide_name, options['output_dir'],
+                                            _worker['dirs'], options['mpp_model'], _worker['DEVICE'], **qc_options)
+        return slide_name, output_temp, None
+    except Exception as e:
+        return slide_name, None, str(e)
+
+
+def run_pool(slide_names, options, workers, threads_per_worker=0, pin_cores="N"):
+    '''
+    QC of slide_names with a pool of workers processes (spawned, each loads its own model). The slides are handed
+    out largest-first, one at a time, so faster workers take more slides. options holds the arguments of qc_slide
+    (see main.py). Yields (slide_name, line of the per-slide report or None, error or None) as slides finish.
+    '''
+    ctx = multiprocessing.get_context('spawn')
+    budget_queue = ctx.Queue()
+    for budget in worker_budgets(workers, threads_per_worker):
+        budget_queue.put(budget)
+    options = dict(options, threads_per_worker=threads_per_worker, pin_cores=pin_cores)
+    ordered = largest_first(slide_names, options['slide_dir'], options['output_dir'])
+    with ctx.Pool(workers, initializer=init_worker, initargs=(options, budget_queue)) as pool:
+        for result in pool.imap_unordered(run_slide, ordered, chunksize=1):
+            yield result
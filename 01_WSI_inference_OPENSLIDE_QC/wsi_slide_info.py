@@ -5,22 +5,35 @@ from wsi_stain_norm import standardizer
 import numpy as np
 
 
-def slide_info(slide, m_p_s, mpp_model):
-    # Objective power
-    try:
-        obj_power = slide.properties["openslide.objective-power"]
-    except:
-        obj_power = 99
+def select_read_level(slide, p_s, m_p_s, level_tolerance=0.1):
+    '''
+    Pyramid level to read patches from: the coarsest level whose downsample does not exceed the downsample from
+    level 0 to model resolution (p_s / m_p_s) by more than level_tolerance (relative). The remaining (residual)
+    scaling is done by resizing the patch. Level 0 is used if no other level qualifies (e.g. level_tolerance = -1).
+    Returns the level and the patch size at this level.
+    '''
+    target_downsample = p_s / m_p_s
+    level = 0
+    for i, downsample in enumerate(slide.downsamples):
+        if downsample <= target_downsample * (1 + level_tolerance) and downsample > slide.downsamples[level]:
+            level = i
+    p_s_level = int(round(p_s / slide.downsamples[level]))
+    return level, p_s_level
+
+
+def slide_info(slide, m_p_s, mpp_model, level_tolerance=0.1):
+    # Objective power (99 if unknown)
+    obj_power = slide.objective_power
 
     # Microne per pixel
-    mpp = float(slide.properties["openslide.mpp-x"])
+    mpp = slide.mpp
     p_s = int(mpp_model / mpp * m_p_s)
 
     # Vendor
-    vendor = slide.properties["openslide.vendor"]
+    vendor = slide.vendor
 
     # Extract and save dimensions of level [0]
-    dim_l0 = slide.level_dimensions[0]
+    dim_l0 = slide.levels[0]
     w_l0 = dim_l0[0]
     h_l0 = dim_l0[1]
 
@@ -29,10 +42,10 @@ def slide_info(slide, m_p_s, mpp_model):
     patch_n_h_l0 = int(h_l0 / p_s)
 
     # Number of levels
-    num_level = slide.level_count
+    num_level = len(slide.levels)
 
     # Level downsamples
-    down_levels = slide.level_downsamples
+    down_levels = slide.downsamples
 
     # Output BASIC DATA
     print("")
@@ -50,4 +63,9 @@ def slide_info(slide, m_p_s, mpp_model):
     print("Height - number of patches: ", patch_n_h_l0)
     print("Overall number of patches / slide (without tissue detection): ", patch_n_w_l0 * patch_n_h_l0)
 
-    return p_s, patch_n_w_l0, patch_n_h_l0, mpp, w_l0, h_l0, obj_power
+    # Pyramid level to read patches from
+    read_level, p_s_level = select_read_level(slide, p_s, m_p_s, level_tolerance)
+    print("Read level: ", read_level, "(downsample", down_levels[read_level], ")")
+    print("Model patch size at read level: ", p_s_level, "x", p_s_level)
+
+    return p_s, patch_n_w_l0, patch_n_h_l0, mpp, w_l0, h_l0, obj_power, read_level, p_s_level
@@ -0,0 +1,220 @@
+# SLIDE READERS: ONE INTERFACE TO PIXELS AND METADATA OF OPENSLIDE, TIFFSLIDE AND OME-TIFF SLIDES
+import xml.etree.ElementTree as ET
+import numpy as np
+from PIL import Image
+
+OME_SUFFIXES = ('.ome.tif', '.ome.tiff')
+TIFF_SUFFIXES = ('.tif', '.tiff')
+DEFAULT_OME_MPP = 0.2425  # MPP of OME-TIFF slides without PhysicalSizeX (the value the OME-TIFF scripts always used)
+UNIT_MICRONS = {'pm': 1e-6, 'nm': 1e-3, 'µm': 1, 'um': 1, 'mm': 1e3, 'cm': 1e4, 'm': 1e6}
+
+
+def fit_size(width, height, box):
+    # Size of a width x height image fitted into box = (width, height), aspect ratio kept (as PIL thumbnail)
+    scale = min(box[0] / width, box[1] / height, 1)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+class SlideReader(object):
+    """
+    A slide opened by one of the backends, the pipeline only uses this interface:
+
+    levels       (width, height) of the pyramid levels, level 0 first
+    downsamples  downsample of every level relative to level 0
+    mpp          microns per pixel of level 0
+    vendor, objective_power, path
+
+    get_region(level, x, y, w, h) returns the w x h pixels at level whose top left corner is (x, y) at level 0 as RGB
+    PIL image (as OpenSlide read_region, outside the slide is black). get_thumbnail(size) returns the slide fitted into
+    size, thumbnail(mpp) the slide at mpp (level 0 size reduced by mpp / slide mpp). reopen() opens the slide once
+    more with the same backend, for reading in other threads.
+    """
+    levels = []
+    downsamples = []
+    mpp = None
+    vendor = 'unknown'
+    objective_power = 99
+    path = None
+
+    def get_region(self, level, x, y, w, h):
+        raise NotImplementedError
+
+    def get_thumbnail(self, size):
+        raise NotImplementedError
+
+    def thumbnail_size(self, mpp):
+        # Box of the slide at mpp, the slide MPP rounded to 4 decimals as in the reports
+        w_l0, h_l0 = self.levels[0]
+        reduction_factor = mpp / round(self.mpp, 4)
+        return (w_l0 // reduction_factor, h_l0 // reduction_factor)
+
+    def thumbnail(self, mpp):
+        return self.get_thumbnail(self.thumbnail_size(mpp))
+
+    def reopen(self):
+        return type(self)(self.path, mpp=self._mpp_override)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class OpenSlideReader(SlideReader):
+    # Slides in the formats of OpenSlide; mpp overrides the MPP of the metadata
+    prefix = 'openslide'
+
+    def __init__(self, path, mpp=None):
+        self.path = path
+        self._mpp_override = mpp
+        self.slide = self._open(path)
+        self.levels = list(self.slide.level_dimensions)
+        self.downsamples = list(self.slide.level_downsamples)
+        properties = self.slide.properties
+        if mpp is None:
+            if self.prefix + '.mpp-x' not in properties:
+                raise Exception("no MPP in the metadata of " + path)
+            mpp = properties[self.prefix + '.mpp-x']
+        self.mpp = float(mpp)
+        self.vendor = properties.get(self.prefix + '.vendor', 'unknown')
+        self.objective_power = properties.get(self.prefix + '.objective-power', 99)
+
+    def _open(self, path):
+        from openslide import OpenSlide
+        return OpenSlide(path)
+
+    def get_region(self, level, x, y, w, h):
+        return self.slide.read_region((x, y), level, (w, h)).convert('RGB')
+
+    def get_thumbnail(self, size):
+        return self.slide.get_thumbnail(size)
+
+    def close(self):
+        self.slide.close()
+
+
+class TiffSlideReader(OpenSlideReader):
+    # Same formats through tiffslide (pure Python, tifffile based), used when OpenSlide is not installed
+    prefix = 'tiffslide'
+
+    def _open(self, path):
+        from tiffslide import TiffSlide
+        return TiffSlide(path)
+
+
+class OmeTiffReader(SlideReader):
+    """
+    OME-TIFF slides through tifffile and zarr. The levels are the zarr arrays of the first series, (C, Y, X) or
+    (Y, X, C); regions of (C, Y, X) levels are read through a ChunkTileReader per level (cache_mb MB of decoded
+    chunks, workers decoding threads). MPP and objective power come from the OME-XML, mpp overrides the MPP; without
+    PhysicalSizeX the MPP is DEFAULT_OME_MPP (with a warning).
+    """
+
+    def __init__(self, path, mpp=None, cache_mb=64, workers=0):
+        import tifffile
+        import zarr
+        from wsi_levels import level_size, pyramid_levels
+        self.path = path
+        self._mpp_override = mpp
+        self.cache_mb = cache_mb
+        self.workers = workers
+        self._tif = tifffile.TiffFile(path)
+        self._store = self._tif.series[0].aszarr()
+        self.slide = zarr.open(self._store, mode='r')
+        self.arrays = pyramid_levels(self.slide)
+        self.levels = [level_size(array) for array in self.arrays]
+        self.downsamples = [self.levels[0][0] / width for width, _ in self.levels]
+        self._readers = {}
+        self.vendor = 'ome-tiff'
+        physical_mpp, objective_power = self._ome_metadata(self._tif.ome_metadata)
+        if mpp is None:
+            if physical_mpp is None:
+                print(f"Warning: no PhysicalSizeX in the OME-XML of {path}, MPP {DEFAULT_OME_MPP} assumed")
+                physical_mpp = DEFAULT_OME_MPP
+            mpp = physical_mpp
+        self.mpp = float(mpp)
+        if objective_power is not None:
+            self.objective_power = objective_power
+
+    def reopen(self):
+        return type(self)(self.path, mpp=self._mpp_override, cache_mb=self.cache_mb, workers=self.workers)
+
+    @staticmethod
+    def _ome_metadata(ome_xml):
+        # (MPP, objective power) from the OME-XML, None where missing
+        if not ome_xml:
+            return None, None
+        mpp, objective_power = None, None
+        for element in ET.fromstring(ome_xml).iter():
+            tag = element.tag.rsplit('}', 1)[-1]
+            if tag == 'Pixels' and mpp is None and 'PhysicalSizeX' in element.attrib:
+                unit = element.attrib.get('PhysicalSizeXUnit', 'µm')
+                mpp = float(element.attrib['PhysicalSizeX']) * UNIT_MICRONS.get(unit, 1)
+            elif tag == 'Objective' and objective_power is None and 'NominalMagnification' in element.attrib:
+                objective_power = element.attrib['NominalMagnification']
+        return mpp, objective_power
+
+    def _chunk_reader(self, level):
+        if level not in self._readers:
+            from wsi_chunk_reader import ChunkTileReader
+            self._readers[level] = ChunkTileReader(self.arrays[level], self.cache_mb, self.workers)
+        return self._readers[level]
+
+    def get_region(self, level, x, y, w, h):
+        array = self.arrays[level]
+        x_l, y_l = int(x / self.downsamples[level]), int(y / self.downsamples[level])
+        if array.ndim == 3 and array.shape[0] != 3:
+            region = array[max(y_l, 0):y_l + h, max(x_l, 0):x_l + w, :3]
+        else:
+            region = self._chunk_reader(level).read_region(max(y_l, 0), max(x_l, 0), h - max(-y_l, 0),
+                                                           w - max(-x_l, 0))[:, :, :3]
+        if region.shape[:2] != (h, w):
+            # Outside the slide is black
+            padded = np.zeros((h, w, 3), dtype=np.uint8)
+            padded[max(-y_l, 0):max(-y_l, 0) + region.shape[0], max(-x_l, 0):max(-x_l, 0) + region.shape[1]] = region
+            region = padded
+        return Image.fromarray(np.ascontiguousarray(region))
+
+    def get_thumbnail(self, size):
+        # Area averaged from the smallest level with enough pixels, streamed in strips (see wsi_levels)
+        from wsi_levels import read_downsampled
+        return Image.fromarray(read_downsampled(self.slide, fit_size(*self.levels[0], size)))
+
+    def close(self):
+        for reader in self._readers.values():
+            reader.close()
+        self._readers = {}
+        self._store.close()
+        self._tif.close()
+
+
+def is_ome_tiff(path):
+    # .ome.tif(f) files, and .tif(f) files with OME-XML in their first page
+    if path.lower().endswith(OME_SUFFIXES):
+        return True
+    if not path.lower().endswith(TIFF_SUFFIXES):
+        return False
+    try:
+        import tifffile
+        with tifffile.TiffFile(path) as tif:
+            return tif.is_ome
+    except Exception:
+        return False
+
+
+def open_slide_reader(path, mpp=None):
+    '''
+    SlideReader for the slide at path: OME-TIFF files (see is_ome_tiff) through tifffile, all others through
+    OpenSlide, or tiffslide if OpenSlide is not installed. mpp overrides the MPP of the metadata.
+    '''
+    if is_ome_tiff(path):
+        return OmeTiffReader(path, mpp=mpp)
+    try:
+        import openslide  # noqa: F401
+    except ImportError:
+        return TiffSlideReader(path, mpp=mpp)
+    return OpenSlideReader(path, mpp=mpp)
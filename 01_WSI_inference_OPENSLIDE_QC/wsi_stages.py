@@ -0,0 +1,165 @@
+# STAGED STREAMING PIPELINE: STAGES IN THREADS, CONNECTED BY BOUNDED QUEUES, WITH BUSY TIME PER STAGE
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+POLL_SECONDS = 0.1  # how often blocked threads look whether the pipeline was stopped
+
+
+class _End(object):
+    pass
+
+
+class _Failure(object):
+    def __init__(self, error):
+        self.error = error
+
+
+class _Stopped(Exception):
+    pass
+
+
+class Stage(object):
+    # Step fn(item) -> item of a StagePipeline, run by workers threads (the order of the items is kept)
+
+    def __init__(self, name, fn, workers=1):
+        self.name = name
+        self.fn = fn
+        self.workers = max(workers, 1)
+        self.busy = 0.0
+        self.items = 0
+        self._lock = threading.Lock()
+
+    def timed(self, item):
+        start = time.perf_counter()
+        result = self.fn(item)
+        with self._lock:
+            self.busy += time.perf_counter() - start
+            self.items += 1
+        return result
+
+
+class StagePipeline(object):
+    """
+    Streams the items of a source through a chain of stages. The source and every stage run in their own thread,
+    stages with several workers in a pool of their own; the stages are connected by queues of at most queue_depth
+    items, so a slow stage holds back the ones before it and the number of items in flight stays bounded.
+
+    run(source) yields the results of the last stage in the order of the source and raises the first exception of
+    any stage. Afterwards report() tells the busy time of every stage per worker (for the source: the time spent
+    waiting for its next item) and the slowest stage, the one to scale.
+    """
+
+    def __init__(self, source_name, stages, queue_depth=4):
+        self.source = Stage(source_name, None)
+        self.stages = stages
+        self.queue_depth = max(queue_depth, 1)
+        self.wall = 0.0
+        self._stop = threading.Event()
+
+    def _put(self, q, item):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                q.put(item, timeout=POLL_SECONDS)
+                return
+            except queue.Full:
+                pass
+
+    def _get(self, q):
+        while True:
+            if self._stop.is_set():
+                raise _Stopped()
+            try:
+                return q.get(timeout=POLL_SECONDS)
+            except queue.Empty:
+                pass
+
+    def _feed(self, source, q_out):
+        try:
+            items = iter(source)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(items)
+                except StopIteration:
+                    break
+                self.source.busy += time.perf_counter() - start
+                self.source.items += 1
+                self._put(q_out, item)
+            self._put(q_out, _End())
+        except _Stopped:
+            pass
+        except Exception as e:
+            try:
+                self._put(q_out, _Failure(e))
+            except _Stopped:
+                pass
+
+    def _work(self, stage, q_in, q_out):
+        executor = ThreadPoolExecutor(max_workers=stage.workers) if stage.workers > 1 else None
+        pending = deque()
+        try:
+            while True:
+                item = self._get(q_in)
+                if isinstance(item, (_End, _Failure)):
+                    while pending:
+                        self._put(q_out, pending.popleft().result())
+                    self._put(q_out, item)
+                    return
+                if executor is None:
+                    self._put(q_out, stage.timed(item))
+                    continue
+                pending.append(executor.submit(stage.timed, item))
+                # Results leave in order; at most twice the workers items are in the pool
+                while pending and (pending[0].done() or len(pending) >= 2 * stage.workers):
+                    self._put(q_out, pending.popleft().result())
+        except _Stopped:
+            pass
+        except Exception as e:
+            try:
+                self._put(q_out, _Failure(e))
+            except _Stopped:
+                pass
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True, cancel_futures=True)
+
+    def run(self, source):
+        self._stop.clear()
+        queues = [queue.Queue(maxsize=self.queue_depth) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._feed, args=(source, queues[0]), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            threads.append(threading.Thread(target=self._work, args=(stage, queues[i], queues[i + 1]), daemon=True))
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        try:
+            while True:
+                item = self._get(queues[-1])
+                if isinstance(item, _End):
+                    return
+                if isinstance(item, _Failure):
+                    raise item.error
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+            self.wall = time.perf_counter() - start
+
+    def stats(self):
+        # (name, workers, items, busy seconds per worker) of the source and the stages
+        return [(stage.name, stage.workers, stage.items, stage.busy / stage.workers)
+                for stage in [self.source] + self.stages]
+
+    def report(self):
+        stats = self.stats()
+        slowest = max(stats, key=lambda stat: stat[3])
+        parts = [f"{name} {busy:.1f}s" + (f" ({workers} workers)" if workers > 1 else "")
+                 for name, workers, _, busy in stats]
+        return (f"Stage busy time per worker: {' | '.join(parts)} (wall {self.wall:.1f}s) - slowest stage: "
+                f"{slowest[0]}")
@@ -0,0 +1,207 @@
+# CACHE OF LOW RESOLUTION VIEWS OF THE SLIDES, SHARED BY THE PIPELINE STEPS, KEYED BY SLIDE FINGERPRINT AND MPP
+import hashlib
+import json
+import os
+import threading
+import uuid
+from PIL import Image
+Image.MAX_IMAGE_PIXELS = 1000000000
+
+STANDARD_MPPS = (2.5, 5, 10, 20, 40)  # levels of the pyramid kept per slide
+FINGERPRINT_BYTES = 1 << 20  # bytes read from the start and the end of a slide file for its fingerprint
+DERIVED = '_lanczos'  # name suffix of views downscaled from another view instead of decoded from the slide
+EVICT_TO = 0.9  # an eviction shrinks the cache to this fraction of its maximum size
+
+
+def slide_fingerprint(path_slide):
+    # SHA-256 of size, first and last FINGERPRINT_BYTES of the slide file: same content, same key, wherever it lies
+    size = os.path.getsize(path_slide)
+    sha = hashlib.sha256(str(size).encode())
+    with open(path_slide, 'rb') as f:
+        sha.update(f.read(FINGERPRINT_BYTES))
+        if size > 2 * FINGERPRINT_BYTES:
+            f.seek(size - FINGERPRINT_BYTES)
+            sha.update(f.read(FINGERPRINT_BYTES))
+    return sha.hexdigest()
+
+
+def view_size(meta, mpp):
+    # Box of the view at mpp, as for the tissue detection thumbnail (see tis_det_thumbnail_size)
+    reduction_factor = mpp / meta['mpp']
+    return (meta['width'] // reduction_factor, meta['height'] // reduction_factor)
+
+
+class ThumbnailCache(object):
+    """
+    Low resolution views of slides on disk in cache_dir/<fingerprint>/<mpp>.png, so the steps of the pipeline (and
+    later runs) do not decode the WSI again for the same view.
+
+    view(path_slide, mpp) returns the slide at mpp (RGB, fitted into the level 0 size reduced by mpp / slide MPP, as
+    OpenSlide get_thumbnail does). A view that is not cached is downscaled from the closest finer cached view of the
+    slide (stored as <mpp>_lanczos.png); only without one the slide is decoded, once, and the standard MPPs coarser
+    than the view are derived from it as well. view(..., derive=False) only returns views decoded from the slide,
+    for model inputs that must not depend on what is in the cache. Views are lossless PNGs. The cache is kept under
+    max_mb, the least recently used views are removed first.
+    """
+
+    def __init__(self, cache_dir, max_mb=2048, standard_mpps=STANDARD_MPPS):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb * (1 << 20))
+        self.standard_mpps = standard_mpps
+        # Size of the cache as far as known: measured by the last eviction scan, plus the views stored since
+        self._bytes = None
+        self._lock = threading.Lock()
+
+    def _entry_dir(self, path_slide):
+        return os.path.join(self.cache_dir, slide_fingerprint(path_slide))
+
+    def _cached(self, entry_dir):
+        # mpp -> path of the cached views of a slide: those decoded from the slide and those derived from other views
+        try:
+            names = os.listdir(entry_dir)
+        except OSError:
+            return {}, {}
+        decoded, derived = {}, {}
+        for name in names:
+            if name.endswith(DERIVED + '.png'):
+                derived[float(name[:-len(DERIVED + '.png')])] = os.path.join(entry_dir, name)
+            elif name.endswith('.png'):
+                decoded[float(name[:-4])] = os.path.join(entry_dir, name)
+        return decoded, derived
+
+    def _load(self, path):
+        try:
+            with Image.open(path) as image:
+                image = image.convert('RGB')
+            # Last use for the eviction
+            os.utime(path)
+            return image
+        except OSError:
+            # Evicted in the meantime
+            return None
+
+    def _store(self, entry_dir, mpp, image, derived=False):
+        path = os.path.join(entry_dir, f"{mpp:.4f}" + (DERIVED if derived else '') + '.png')
+        # The entry folder may have been removed by an eviction since the metadata was written
+        os.makedirs(entry_dir, exist_ok=True)
+        tmp_path = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        image.save(tmp_path, format='PNG', compress_level=1)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size
+
+    def _meta(self, entry_dir, slide=None):
+        meta_path = os.path.join(entry_dir, 'meta.json')
+        try:
+            with open(meta_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            if slide is None:
+                return None
+        w_l0, h_l0 = slide.levels[0]
+        meta = {'width': w_l0, 'height': h_l0, 'mpp': round(slide.mpp, 4)}
+        os.makedirs(entry_dir, exist_ok=True)
+        tmp_path = meta_path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, meta_path)
+        return meta
+
+    def view(self, path_slide, mpp, slide=None, decode=True, derive=True):
+        '''
+        View of the slide at mpp. An already open slide (see SlideReader) is used for decoding (and not closed).
+        With decode False None is returned when the view cannot be made without decoding the slide. With derive False
+        only a view decoded from the slide is returned (from the cache or decoded now), never one downscaled from
+        another view.
+        '''
+        mpp = round(float(mpp), 4)
+        entry_dir = self._entry_dir(path_slide)
+        decoded, derived = self._cached(entry_dir)
+        for views in ([decoded, derived] if derive else [decoded]):
+            if mpp in views:
+                image = self._load(views[mpp])
+                if image is not None:
+                    return image
+
+        meta = self._meta(entry_dir)
+        finer = {m: path for views in (derived, decoded) for m, path in views.items() if m < mpp}
+        if derive and meta is not None and finer:
+            source = self._load(finer[max(finer)])
+            if source is not None:
+                image = source.copy()
+                image.thumbnail(view_size(meta, mpp), Image.Resampling.LANCZOS)
+                self._store(entry_dir, mpp, image, derived=True)
+                self.evict_if_full()
+                return image
+        if not decode:
+            return None
+
+        close_slide = slide is None
+        if close_slide:
+            from wsi_slide_reader import open_slide_reader
+            slide = open_slide_reader(path_slide)
+        try:
+            meta = self._meta(entry_dir, slide)
+            image = slide.get_thumbnail(view_size(meta, mpp))
+        finally:
+            if close_slide:
+                slide.close()
+        self._store(entry_dir, mpp, image)
+        # Coarser standard levels from the decoded view, each from the previous one
+        level = image
+        for standard_mpp in sorted(self.standard_mpps):
+            if standard_mpp > mpp and standard_mpp not in decoded and standard_mpp not in derived:
+                level = level.copy()
+                level.thumbnail(view_size(meta, standard_mpp), Image.Resampling.LANCZOS)
+                self._store(entry_dir, standard_mpp, level, derived=True)
+        self.evict_if_full()
+        return image
+
+    def views(self, path_slide, mpps, slide=None):
+        # Views at several mpps, finest first, so the slide is decoded at most once
+        images = {}
+        for mpp in sorted(set(mpps)):
+            images[mpp] = self.view(path_slide, mpp, slide)
+        return [images[mpp] for mpp in mpps]
+
+    def evict_if_full(self):
+        # Scans the cache only when it is (as far as known) over max_bytes, not after every stored view
+        with self._lock:
+            full = self._bytes is None or self._bytes > self.max_bytes
+        if full:
+            self.evict()
+
+    def evict(self):
+        # Removes the least recently used views until the cache fits into EVICT_TO of max_bytes
+        files = []
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                if name.endswith('.png'):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in files)
+        if total > self.max_bytes:
+            for _, size, path in sorted(files):
+                if total <= EVICT_TO * self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total -= size
+                # Slide without views: remove its folder
+                entry_dir = os.path.dirname(path)
+                if not any(self._cached(entry_dir)):
+                    try:
+                        os.remove(os.path.join(entry_dir, 'meta.json'))
+                        os.rmdir(entry_dir)
+                    except OSError:
+                        pass
+        with self._lock:
+            self._bytes = total
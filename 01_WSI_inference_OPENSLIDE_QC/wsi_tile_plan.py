@@ -0,0 +1,61 @@
+# PLANNING OF PATCHES TO PROCESS FROM THE TISSUE DETECTION MAP
+import numpy as np
+
+# Former on-fly check: more than 50 tissue pixels in a (512, 512) model patch
+MIN_TISSUE_FRACTION = 50 / (512 * 512)
+
+
+def tissue_fraction_grid(tis_det_map, w_l0, h_l0, p_s, patch_n_w, patch_n_h):
+    '''
+    Fraction of tissue pixels (class 0) of the tissue detection map (MPP = 10) under every patch of the grid.
+    Patch (he, wi) covers [he * p_s, (he + 1) * p_s) x [wi * p_s, (wi + 1) * p_s) at level 0.
+    All patches are reduced at once with a summed area table of the map.
+    '''
+    map_h, map_w = tis_det_map.shape[:2]
+    tissue = (tis_det_map == 0)
+    sat = np.zeros((map_h + 1, map_w + 1), dtype=np.int64)
+    sat[1:, 1:] = tissue.cumsum(axis=0).cumsum(axis=1)
+
+    # Patch borders in map pixels
+    scale_h = map_h / h_l0
+    scale_w = map_w / w_l0
+    ys = np.clip(np.round(np.arange(patch_n_h + 1) * p_s * scale_h).astype(np.int64), 0, map_h)
+    xs = np.clip(np.round(np.arange(patch_n_w + 1) * p_s * scale_w).astype(np.int64), 0, map_w)
+
+    tissue_px = (sat[ys[1:, None], xs[None, 1:]] - sat[ys[:-1, None], xs[None, 1:]]
+                 - sat[ys[1:, None], xs[None, :-1]] + sat[ys[:-1, None], xs[None, :-1]])
+    patch_px = (p_s * scale_h) * (p_s * scale_w)
+    return tissue_px / patch_px
+
+
+def plan_tissue_tiles(tis_det_map, w_l0, h_l0, p_s, patch_n_w, patch_n_h, min_tissue_fraction=MIN_TISSUE_FRACTION):
+    '''
+    Grid coordinates (he, wi) of the patches with tissue as an (N, 2) array.
+    Rows are visited top to bottom, alternating direction, so consecutive patches are neighbours on the slide.
+    Without a tissue detection map (None) all patches are returned.
+    '''
+    if tis_det_map is None:
+        selected = np.ones((patch_n_h, patch_n_w), dtype=bool)
+    else:
+        selected = tissue_fraction_grid(tis_det_map, w_l0, h_l0, p_s, patch_n_w, patch_n_h) > min_tissue_fraction
+    he, wi = np.nonzero(selected)
+    order = np.lexsort((np.where(he % 2 == 1, -wi, wi), he))
+    return np.stack([he[order], wi[order]], axis=1)
+
+
+def tissue_patch(tis_det_map, he, wi, w_l0, h_l0, p_s, m_p_s):
+    '''
+    Tissue detection map under patch (he, wi), sampled (nearest neighbour) to model patch size (m_p_s, m_p_s).
+    Pixels beyond the map are 0 (tissue), without a map the whole patch is tissue.
+    '''
+    td_patch = np.zeros((m_p_s, m_p_s), dtype=np.uint8)
+    if tis_det_map is None:
+        return td_patch
+    map_h, map_w = tis_det_map.shape[:2]
+    step = p_s / m_p_s
+    ys = np.floor((he * p_s + (np.arange(m_p_s) + 0.5) * step) * map_h / h_l0).astype(np.int64)
+    xs = np.floor((wi * p_s + (np.arange(m_p_s) + 0.5) * step) * map_w / w_l0).astype(np.int64)
+    in_y = ys < map_h
+    in_x = xs < map_w
+    td_patch[np.ix_(in_y, in_x)] = tis_det_map[np.ix_(ys[in_y], xs[in_x])]
+    return td_patch
@@ -0,0 +1,93 @@
+# PREFETCHING TILE READER FOR SLIDES (SEE SlideReader)
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from wsi_slide_reader import open_slide_reader
+from PIL import Image
+
+
+def read_patch(slide, w, h, level, p_s, m_p_s):
+    # Read patch of size p_s at the given level, convert to RGB and resize (residual) to model patch size
+    work_patch = slide.get_region(level, w, h, p_s, p_s)
+    if p_s != m_p_s:
+        work_patch = work_patch.resize((m_p_s, m_p_s), Image.Resampling.LANCZOS)
+    return work_patch
+
+
+class TilePrefetcher(object):
+    """
+    Decodes and resizes upcoming patches of a slide in background threads while the caller runs inference.
+
+    Every worker thread opens its own handle of the slide (the slide passed in reopened, or opened from slide_path
+    with open_slide_reader). At most queue_depth patches are being decoded or
+    waiting to be consumed at any time, so memory stays bounded. With workers=0 patches are read in the
+    calling thread from the handle given as slide (or opened from slide_path).
+    Patches are read at pyramid level level with size p_s (at that level).
+    """
+
+    def __init__(self, slide_path, p_s, m_p_s, workers=2, queue_depth=16, slide=None, level=0):
+        self.slide_path = slide_path
+        self.level = level
+        self.p_s = p_s
+        self.m_p_s = m_p_s
+        self.workers = workers
+        self.queue_depth = max(queue_depth, 1)
+        self.slide = slide
+        self._local = threading.local()
+        self._handles = []
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+
+    def _worker_slide(self):
+        # One slide handle per worker thread
+        slide = getattr(self._local, 'slide', None)
+        if slide is None:
+            slide = self.slide.reopen() if self.slide is not None else open_slide_reader(self.slide_path)
+            self._local.slide = slide
+            with self._lock:
+                self._handles.append(slide)
+        return slide
+
+    def _read(self, w, h):
+        return read_patch(self._worker_slide(), w, h, self.level, self.p_s, self.m_p_s)
+
+    def iter_tiles(self, tiles):
+        """
+        Yield (key, patch) for every (key, (w, h)) in tiles, in the given order.
+        (w, h) is the top left corner of the patch at level 0.
+        """
+        if self._executor is None:
+            if self.slide is None:
+                self.slide = open_slide_reader(self.slide_path)
+                self._handles.append(self.slide)
+            for key, (w, h) in tiles:
+                yield key, read_patch(self.slide, w, h, self.level, self.p_s, self.m_p_s)
+            return
+
+        tiles = iter(tiles)
+        pending = deque()
+
+        def submit_next():
+            for key, (w, h) in tiles:
+                pending.append((key, self._executor.submit(self._read, w, h)))
+                return
+
+        for _ in range(self.queue_depth):
+            submit_next()
+        while pending:
+            key, future = pending.popleft()
+            submit_next()
+            yield key, future.result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        for slide in self._handles:
+            slide.close()
+        self._handles = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
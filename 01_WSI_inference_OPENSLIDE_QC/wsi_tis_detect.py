@@ -1,12 +1,9 @@
-from openslide import OpenSlide
-import cv2
 import os
-import numpy as np
 import torch
 import argparse
-from PIL import Image
-import segmentation_models_pytorch as smp
-from wsi_tis_detect_helper_fx import get_preprocessing, make_class_map
+from wsi_job_queue import JobQueue
+from wsi_pipeline import load_td, td_preprocessing_fn, tis_det_dirs, detect_tissue_slide
+from wsi_thumbnail_cache import ThumbnailCache
 
 
 # DEVICE - Auto-detect available device
@@ -17,152 +14,76 @@ elif torch.backends.mps.is_available():
 else:
     DEVICE = 'cpu'
 
-# MODEL TISSUE DETECTION:
-# Get the script directory and construct absolute path to models
-SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
-MODEL_TD_DIR = os.path.join(SCRIPT_DIR, 'models', 'td')
-MODEL_TD_NAME = 'Tissue_Detection_MPP10.pth'
-MPP_MODEL_TD = 10
-M_P_S_MODEL_TD = 512
-ENCODER_MODEL_TD = 'timm-efficientnet-b0'
-ENCODER_MODEL_TD_WEIGHTS = 'imagenet'
-
-# OVERLAY PARAMETERS (TRANSPARENCY)
-OVER_IMAGE = 0.7    # % original image
-OVER_MASK = 0.3     # % segmentation mask
-
-# COLORS for MASK
-colors = [[50, 50, 250],    # BLUE: TISSUE
-          [128, 128, 128]]  # GRAY: BACKGROUND
-
 parser = argparse.ArgumentParser()
 parser.add_argument('--slide_folder', dest='slide_folder', help='path to WSIs', type=str)
 parser.add_argument('--output_dir', dest='output_dir', help='path to output folder', type=str)
+parser.add_argument('--backend', dest='backend', default='pytorch', choices=['pytorch', 'onnxruntime'],
+                    help='inference backend of the tissue detection model (onnxruntime - exported ONNX graph, '
+                         'see export_onnx.py)', type=str)
+parser.add_argument('--precision', dest='precision', default='fp32', choices=['fp32', 'int8'],
+                    help='int8 - INT8 quantized model made by quantize_onnx.py (always runs with onnxruntime)',
+                    type=str)
+parser.add_argument('--model_cache', dest='model_cache', default="Y",
+                    help='cache the loaded model in models/cache for fast loading on later starts or not', type=str)
+parser.add_argument('--thumbnail_cache', dest='thumbnail_cache', default="Y",
+                    help='keep the slide thumbnails in <output_dir>/thumbnail_cache for the other steps and runs or not',
+                    type=str)
+parser.add_argument('--thumbnail_cache_mb', dest='thumbnail_cache_mb', default=2048,
+                    help='size limit of the thumbnail cache in MB, least recently used thumbnails are removed first',
+                    type=float)
+parser.add_argument('--queue_dir', dest='queue_dir', default=None,
+                    help='shared work queue folder, slides are claimed from it (see wsi_job_queue.py)', type=str)
+parser.add_argument('--lease_timeout', dest='lease_timeout', default=600,
+                    help='seconds without heartbeat after which a claimed slide is handed out again (--queue_dir)',
+                    type=int)
 args = parser.parse_args()
 
 SLIDE_DIR = args.slide_folder
 OUTPUT_DIR = args.output_dir
+BACKEND = args.backend
+PRECISION = args.precision
+MODEL_CACHE = args.model_cache
+QUEUE_DIR = args.queue_dir
+LEASE_TIMEOUT = args.lease_timeout
+THUMBNAILS = ThumbnailCache(os.path.join(OUTPUT_DIR, 'thumbnail_cache'), args.thumbnail_cache_mb) \
+    if args.thumbnail_cache == "Y" else None
+if PRECISION == 'int8':
+    BACKEND = 'onnxruntime'
 
 # Create output dirs
-tis_det_dir_mask = os.path.join(OUTPUT_DIR, 'tis_det_mask/')
-tis_det_dir_over = os.path.join(OUTPUT_DIR, 'tis_det_overlay/')
-tis_det_dir_thumb = os.path.join(OUTPUT_DIR, 'tis_det_thumbnail/')
-tis_det_dir_mask_col = os.path.join(OUTPUT_DIR, 'tis_det_mask_col/')
-
-try:
-    os.makedirs(tis_det_dir_mask)
-    os.makedirs(tis_det_dir_over)
-    os.makedirs(tis_det_dir_thumb)
-    os.makedirs(tis_det_dir_mask_col)
-except:
-    print('The folders are already there ..')
+dirs = tis_det_dirs(OUTPUT_DIR)
 
 # Get slide names
 slide_names = sorted([f for f in os.listdir(SLIDE_DIR) if os.path.isfile(os.path.join(SLIDE_DIR, f))])
 
-preprocessing_fn = smp.encoders.get_preprocessing_fn(ENCODER_MODEL_TD, ENCODER_MODEL_TD_WEIGHTS)
-
-model = smp.UnetPlusPlus(
-    encoder_name=ENCODER_MODEL_TD,
-    encoder_weights=ENCODER_MODEL_TD_WEIGHTS,
-    classes=2,
-    activation=None,
-)
-
-model.load_state_dict(torch.load(os.path.join(MODEL_TD_DIR, MODEL_TD_NAME), map_location='cpu'))
-model.to(DEVICE)
-model.eval()
-
-# Start analysis loop
-for slide_name in slide_names:
-    print("")
-    print("Working with: ", slide_name)
-    try:
-        path_slide = os.path.join(SLIDE_DIR, slide_name)
-        slide = OpenSlide(path_slide)
-
-        w_l0, h_l0 = slide.level_dimensions[0]
-        mpp = round(float(slide.properties["openslide.mpp-x"]), 4)
-        reduction_factor = MPP_MODEL_TD / mpp
-
-        image_or = slide.get_thumbnail((w_l0 // reduction_factor, h_l0 // reduction_factor))
-        image_or.save(tis_det_dir_thumb + slide_name + ".jpg", quality = 80)
-
-        '''
-        As tissue detector was trained on jpeg compressed images - we have to reproduce this step.
-        Otherwise it functions suboptimal.
-        '''
-
-        image = np.array(image_or)
-        encode_param = [int(cv2.IMWRITE_JPEG_QUALITY), 80]
-        result, image = cv2.imencode('.jpg', image, encode_param)
-        image = cv2.imdecode(image, 1)
-        image = Image.fromarray(image)
-
-        width, height = image.size
-
-        wi_n = width // M_P_S_MODEL_TD
-        he_n = height // M_P_S_MODEL_TD
-
-        overhang_wi = width - wi_n * M_P_S_MODEL_TD
-        overhang_he = height - he_n * M_P_S_MODEL_TD
-
-        print('Overhang (< 1 patch) for width and height: ', overhang_wi, ',', overhang_he)
-
-        p_s = M_P_S_MODEL_TD
-
-        for h in range(he_n + 1):
-            for w in range(wi_n + 1):
-                if w != wi_n and h != he_n:
-                    image_work = image.crop((w * p_s, h * p_s, (w + 1) * p_s, (h + 1) * p_s))
-                elif w == wi_n and h != he_n:
-                    image_work = image.crop((width - p_s, h * p_s, width, (h + 1) * p_s))
-                elif w != wi_n and h == he_n:
-                    image_work = image.crop((w * p_s, height - p_s, (w + 1) * p_s, height))
-                else:
-                    image_work = image.crop((width - p_s, height - p_s, width, height))
-
-                image_pre = get_preprocessing(image_work, preprocessing_fn)
-                x_tensor = torch.from_numpy(image_pre).to(DEVICE).unsqueeze(0)
-                predictions = model.predict(x_tensor)
-                predictions = (predictions.squeeze().cpu().numpy())
-
-                mask = np.argmax(predictions, axis=0).astype('int8')
-
-                class_mask = make_class_map(mask, colors)
-
-                if w == 0:
-                    temp_image = mask
-                    temp_image_class_map = class_mask
-                elif w == wi_n:
-                    mask = mask[:, p_s - overhang_wi:p_s]
-                    temp_image = np.concatenate((temp_image, mask), axis=1)
-                    class_mask = class_mask[:, p_s - overhang_wi:p_s, :]
-                    temp_image_class_map = np.concatenate((temp_image_class_map, class_mask), axis=1)
-                else:
-                    temp_image = np.concatenate((temp_image, mask), axis=1)
-                    temp_image_class_map = np.concatenate((temp_image_class_map, class_mask), axis=1)
-            if h == 0:
-                end_image = temp_image
-                end_image_class_map = temp_image_class_map
-            elif h == he_n:
-                temp_image = temp_image [p_s - overhang_he:p_s,]
-                end_image = np.concatenate((end_image, temp_image), axis=0)
-                temp_image_class_map = temp_image_class_map [p_s - overhang_he:p_s, :, :]
-                end_image_class_map = np.concatenate((end_image_class_map, temp_image_class_map), axis=0)
-            else:
-                end_image = np.concatenate((end_image, temp_image), axis=0)
-                end_image_class_map = np.concatenate((end_image_class_map, temp_image_class_map), axis=0)
-
-        Image.fromarray(end_image).save(os.path.join(tis_det_dir_mask, slide_name + '_MASK.png'))
-        Image.fromarray(end_image_class_map).save(os.path.join(tis_det_dir_mask_col, slide_name + '_MASK_COL.png'))
-        overlay = cv2.addWeighted(np.array(image), OVER_IMAGE, end_image_class_map, OVER_MASK, 0)
-        overlay = Image.fromarray(overlay)
-        overlay.save(os.path.join(tis_det_dir_over, slide_name + '_OVERLAY.jpg'))
-    except:
-        print("Exception with", slide_name)
-
-
-
-
-
+preprocessing_fn = td_preprocessing_fn()
+
+model = load_td(DEVICE, BACKEND, PRECISION, MODEL_CACHE)
+
+if QUEUE_DIR:
+    # Slides are claimed from the shared queue until it is drained
+    job_queue = JobQueue(QUEUE_DIR, 'tis_detect', LEASE_TIMEOUT)
+    print("Queued:", job_queue.add(slide_names, SLIDE_DIR))
+    while True:
+        lease = job_queue.claim()
+        if lease is None:
+            break
+        print("")
+        print("Working with: ", lease.slide_name)
+        try:
+            detect_tissue_slide(model, preprocessing_fn, lease.job['slide_path'], lease.slide_name, dirs, DEVICE,
+                                thumbnails=THUMBNAILS)
+            lease.done()
+        except Exception as e:
+            print("Exception with", lease.slide_name)
+            lease.failed(str(e))
+else:
+    # Start analysis loop
+    for slide_name in slide_names:
+        print("")
+        print("Working with: ", slide_name)
+        try:
+            path_slide = os.path.join(SLIDE_DIR, slide_name)
+            detect_tissue_slide(model, preprocessing_fn, path_slide, slide_name, dirs, DEVICE, thumbnails=THUMBNAILS)
+        except:
+            print("Exception with", slide_name)
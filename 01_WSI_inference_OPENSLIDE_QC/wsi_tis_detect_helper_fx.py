@@ -1,4 +1,5 @@
 import numpy as np
+from wsi_labels import colorize
 
 def to_tensor_x(x, **kwargs):
     return x.transpose(2, 0, 1).astype('float32')
@@ -10,14 +11,5 @@ def get_preprocessing(image,preprocessing_fn):
     return x
 
 def make_class_map (mask, class_colors):
-    r = np.zeros_like(mask).astype(np.uint8)
-    g = np.zeros_like(mask).astype(np.uint8)
-    b = np.zeros_like(mask).astype(np.uint8)
-    for l in range(0, len(class_colors)):
-        idx = mask == l
-        r[idx] = class_colors [l][0]
-        g[idx] = class_colors [l][1]
-        b[idx] = class_colors [l][2]
-
-    rgb = np.stack([r, g, b], axis=2)
-    return rgb
\ No newline at end of file
+    # RGB image of the labels 0..len(class_colors) - 1, one table lookup
+    return colorize(mask, class_colors)
@@ -0,0 +1,232 @@
+# VECTORIZATION OF THE QC MASK: ARTIFACT POLYGONS (WITH HOLES) AND THEIR GEOJSON / GEOPARQUET OUTPUT
+import json
+import struct
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+
+CLASS_MAPPING = {
+    1: "Normal Tissue",
+    2: "Fold",
+    3: "Darkspot & Foreign Object",
+    4: "PenMarking",
+    5: "Edge & Air Bubble",
+    6: "OOF",  # Out of Focus
+    7: "Background"
+}
+ARTIFACT_CLASSES = [2, 3, 4, 5, 6]
+BLOCK = 64  # block size (px) of the coarse artifact grid the units of work are found on
+STRIP = 16 * BLOCK  # rows of the mask per strip when the grid is computed
+ROW_GROUP_SIZE = 2048  # polygons per row group of the GeoParquet output
+
+
+def strip_cells(mask, y0, y1, classes, block):
+    # Occupancy of the block x block cells of rows [y0, y1) of the mask, one grid per class
+    strip = mask[y0:y1]
+    height, width = strip.shape
+    rows = -(-height // block)
+    cols = -(-width // block)
+    cells = np.zeros((len(classes), rows, cols), dtype=np.uint8)
+    if not cv2.countNonZero(cv2.inRange(strip, min(classes), max(classes))):
+        return cells
+    # Padded with 0 (no artifact) to whole cells
+    strip = np.pad(strip, ((0, rows * block - height), (0, cols * block - width)))
+    for i, class_value in enumerate(classes):
+        class_strip = (strip == class_value).view(np.uint8)
+        cells[i] = class_strip.reshape(rows, block, cols * block).max(axis=1).reshape(rows, cols, block).max(axis=2)
+    return cells
+
+
+def artifact_units(mask, classes=ARTIFACT_CLASSES, block=BLOCK, executor=None):
+    '''
+    Units of work of the vectorization: per class, the 8-connected groups of block x block cells that hold pixels of
+    the class. Every connected area of a class lies in exactly one unit, so the units can be traced independently
+    and together give the same polygons as tracing the whole mask. The cells are computed per strip of STRIP rows
+    (in parallel with executor). Returns the cell labels per class and (class index, label, y0, y1, x0, x1) of every
+    unit in mask pixels.
+    '''
+    height, width = mask.shape
+    bounds = [(y0, min(y0 + STRIP, height)) for y0 in range(0, height, STRIP)]
+    if executor is None:
+        strips = [strip_cells(mask, y0, y1, classes, block) for y0, y1 in bounds]
+    else:
+        strips = list(executor.map(lambda b: strip_cells(mask, b[0], b[1], classes, block), bounds))
+    cells = np.concatenate(strips, axis=1)
+
+    labels = []
+    units = []
+    for i in range(len(classes)):
+        n_labels, class_labels, stats, _ = cv2.connectedComponentsWithStats(cells[i], connectivity=8)
+        labels.append(class_labels)
+        for label in range(1, n_labels):
+            left, top, w, h = stats[label, :4]
+            units.append((i, label, top * block, min((top + h) * block, height), left * block,
+                          min((left + w) * block, width)))
+    return labels, units
+
+
+def unit_polygons(mask, labels, unit, classes=ARTIFACT_CLASSES, block=BLOCK, simplify_px=0):
+    '''
+    Polygons of one unit (see artifact_units) as [outer ring, hole rings...], area in mask pixels. Pixels of the class
+    that belong to other units in the bounding box are masked out.
+    '''
+    i, label, y0, y1, x0, x1 = unit
+    own_cells = labels[i][y0 // block:(y1 + block - 1) // block, x0 // block:(x1 + block - 1) // block] == label
+    own = np.repeat(np.repeat(own_cells, block, axis=0), block, axis=1)[:y1 - y0, :x1 - x0]
+    class_mask = ((mask[y0:y1, x0:x1] == classes[i]) & own).view(np.uint8)
+
+    polygons = []
+    # Outer borders and holes (two level hierarchy)
+    contours, hierarchy = cv2.findContours(class_mask, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE,
+                                           offset=(int(x0), int(y0)))
+    if hierarchy is None:
+        return polygons
+    hierarchy = hierarchy[0]
+    for j, contour in enumerate(contours):
+        if hierarchy[j][3] != -1:
+            continue
+        if simplify_px > 0:
+            contour = cv2.approxPolyDP(contour, simplify_px, True)
+        # Skip contours with less than 4 points
+        if len(contour) < 4:
+            continue
+        rings = [contour.reshape(-1, 2)]
+        area = cv2.contourArea(contour)
+        child = hierarchy[j][2]
+        while child != -1:
+            hole = contours[child]
+            if simplify_px > 0:
+                hole = cv2.approxPolyDP(hole, simplify_px, True)
+            if len(hole) >= 3:
+                rings.append(hole.reshape(-1, 2))
+                area -= cv2.contourArea(hole)
+            child = hierarchy[child][0]
+        polygons.append((rings, area))
+    return polygons
+
+
+def mask_polygons(mask, scale_factor=1.0, classes=ARTIFACT_CLASSES, simplify_px=0, precision=1, block=BLOCK,
+                  workers=0):
+    '''
+    Artifact polygons of the whole mask as features {'class_id', 'rings', 'area'}, grouped by class. Rings are
+    closed float arrays (n, 2) scaled by scale_factor and rounded to precision decimals, area is in scaled units.
+    simplify_px > 0 simplifies the rings (Douglas-Peucker) with this tolerance in mask pixels.
+    With workers > 0 the strips and units are processed by a pool of threads (OpenCV and numpy release the GIL);
+    the result does not depend on workers.
+    '''
+    executor = ThreadPoolExecutor(max_workers=workers) if workers > 0 else None
+    try:
+        labels, units = artifact_units(mask, classes, block, executor)
+        # Biggest units first, so a big unit does not end up alone at the end
+        order = sorted(range(len(units)), key=lambda k: (units[k][3] - units[k][2]) * (units[k][5] - units[k][4]),
+                       reverse=True)
+
+        def trace(k):
+            return unit_polygons(mask, labels, units[k], classes, block, simplify_px)
+
+        results = [None] * len(units)
+        traced = executor.map(trace, order) if executor is not None else map(trace, order)
+        for k, polygons in zip(order, traced):
+            results[k] = polygons
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    # Units are in class order, features are the same as from a single thread
+    features = []
+    for unit, polygons in zip(units, results):
+        for rings, area in polygons:
+            scaled = []
+            for ring in rings:
+                ring = np.round(ring * scale_factor, precision)
+                # Ensure polygon is closed by adding first point at the end
+                scaled.append(np.concatenate([ring, ring[:1]]))
+            features.append({'class_id': classes[unit[0]], 'rings': scaled, 'area': area * scale_factor ** 2})
+    return features
+
+
+def write_geojson(features, output_path, metadata=None, precision=1):
+    '''
+    Compact GeoJSON (no indentation), written feature by feature. Returns the byte offset and length of every
+    feature in the file (for the spatial index, see wsi_annotation_index).
+    '''
+    offsets = []
+    lengths = []
+    with open(output_path, 'wb') as f:
+        position = f.write(b'{"type":"FeatureCollection","features":[')
+        for i, feature in enumerate(features):
+            coordinates = [ring.astype(np.int64).tolist() if precision <= 0 else ring.tolist()
+                           for ring in feature['rings']]
+            if i:
+                position += f.write(b',')
+            encoded = json.dumps({
+                "type": "Feature",
+                "properties": {
+                    "class_id": int(feature['class_id']),
+                    "classification": CLASS_MAPPING.get(feature['class_id'], "Unknown"),
+                    "area": round(float(feature['area']), 2)
+                },
+                "geometry": {"type": "Polygon", "coordinates": coordinates}
+            }, separators=(',', ':')).encode()
+            offsets.append(position)
+            lengths.append(len(encoded))
+            position += f.write(encoded)
+        f.write(b'],"metadata":' + json.dumps(metadata or {}, separators=(',', ':')).encode() + b'}')
+    return offsets, lengths
+
+
+def polygon_wkb(rings):
+    # Well-known binary of a polygon (little endian)
+    parts = [struct.pack('<BII', 1, 3, len(rings))]
+    for ring in rings:
+        parts.append(struct.pack('<I', len(ring)))
+        parts.append(np.ascontiguousarray(ring, dtype='<f8').tobytes())
+    return b''.join(parts)
+
+
+def wkb_polygon(wkb):
+    # Rings of a polygon in well-known binary (see polygon_wkb)
+    byte_order = '<' if wkb[0] == 1 else '>'
+    n_rings = struct.unpack(byte_order + 'I', wkb[5:9])[0]
+    position = 9
+    rings = []
+    for _ in range(n_rings):
+        n_points = struct.unpack(byte_order + 'I', wkb[position:position + 4])[0]
+        position += 4
+        rings.append(np.frombuffer(wkb, dtype=byte_order + 'f8', count=2 * n_points, offset=position).reshape(-1, 2))
+        position += 16 * n_points
+    return rings
+
+
+def write_geoparquet(features, output_path, metadata=None):
+    '''
+    GeoParquet (WKB geometry column, pixel coordinates without CRS) with class, area and bounding box columns.
+    The rows are in Hilbert order of their boxes, so the statistics of the row groups work as a spatial index.
+    Needs pyarrow.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from wsi_annotation_index import feature_boxes, hilbert_order
+
+    bounds = feature_boxes(features)
+    order = hilbert_order(bounds)
+    features = [features[k] for k in order]
+    bounds = bounds[order]
+    table = pa.table({
+        'class_id': pa.array([int(f['class_id']) for f in features], pa.int8()),
+        'classification': pa.array([CLASS_MAPPING.get(f['class_id'], "Unknown") for f in features], pa.string()),
+        'area': pa.array([float(f['area']) for f in features], pa.float64()),
+        'xmin': pa.array(bounds[:, 0], pa.float64()),
+        'ymin': pa.array(bounds[:, 1], pa.float64()),
+        'xmax': pa.array(bounds[:, 2], pa.float64()),
+        'ymax': pa.array(bounds[:, 3], pa.float64()),
+        'geometry': pa.array([polygon_wkb(f['rings']) for f in features], pa.binary()),
+    })
+    column = {'encoding': 'WKB', 'geometry_types': ['Polygon'], 'crs': None}
+    if len(features):
+        column['bbox'] = [float(bounds[:, 0].min()), float(bounds[:, 1].min()), float(bounds[:, 2].max()),
+                          float(bounds[:, 3].max())]
+    geo = {'version': '1.0.0', 'primary_column': 'geometry', 'columns': {'geometry': column}}
+    table = table.replace_schema_metadata({b'geo': json.dumps(geo).encode(),
+                                           b'grandqc': json.dumps(metadata or {}).encode()})
+    pq.write_table(table, output_path, compression='zstd', row_group_size=ROW_GROUP_SIZE)
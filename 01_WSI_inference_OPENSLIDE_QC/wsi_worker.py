@@ -0,0 +1,434 @@
+"""
+Persistent GrandQC worker: keeps the tissue detection and QC models loaded and processes slide jobs submitted over a
+local HTTP port, so interactive single-slide runs do not pay interpreter start-up and model loading every time.
+
+    python wsi_worker.py serve [--port 8765] [--mpp_model 1.5] [--backend ...] [--batch_size ...]
+    python wsi_worker.py submit --slide_path SLIDE --output_dir OUT [--steps tis_detect,qc] [--wait]
+    python wsi_worker.py status [JOB_ID]
+    python wsi_worker.py shutdown
+
+HTTP API (JSON):
+    GET  /health        models loaded, number of queued jobs
+    POST /jobs          {"slide_path", "output_dir", "steps", "mpp_model", "create_geojson"} -> {"job_id"}
+    GET  /jobs          all jobs
+    GET  /jobs/<id>     state (queued, running, done, failed), current step, progress, output paths, error
+    POST /shutdown      stop the worker after the running job, queued jobs are not started
+Every request needs the header "Authorization: Bearer <token>" with the token the worker writes to --token_file at
+start (readable by its user only), POST bodies need "Content-Type: application/json"; web pages the user visits cannot
+send either. output_dir has to be inside --output_root of the worker.
+Jobs run one after the other in submission order; output folders and file names are the same as for
+wsi_tis_detect.py and main.py, the per-slide QC line goes to <output_dir>/report_<output_dir name>_worker_stats_per_slide.txt.
+"""
+import argparse
+import hmac
+import json
+import os
+import secrets
+import sys
+import threading
+import time
+import timeit
+import uuid
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Queue
+
+STEPS = ['tis_detect', 'qc']
+DEFAULT_PORT = 8765
+
+
+def default_token_file(port):
+    return os.path.join(os.path.expanduser('~'), '.grandqc', f'worker_{port}.token')
+
+
+def write_token(token_file):
+    # New random token, only the user running the worker can read it
+    os.makedirs(os.path.dirname(os.path.abspath(token_file)), mode=0o700, exist_ok=True)
+    token = secrets.token_hex(32)
+    fd = os.open(token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        f.write(token)
+    return token
+
+
+def read_token(token_file):
+    try:
+        with open(token_file) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        raise SystemExit(f"No worker token in {token_file}, is the worker running?")
+
+
+def output_dir_in_root(output_dir, output_root):
+    # Absolute output folder, if it is inside output_root (symbolic links resolved)
+    output_dir = os.path.realpath(output_dir)
+    output_root = os.path.realpath(output_root)
+    if os.path.commonpath([output_dir, output_root]) != output_root:
+        raise ValueError(f"output_dir has to be inside {output_root}")
+    return output_dir
+
+
+class GrandQCWorker(object):
+    """
+    Runs slide jobs with resident models in a single background thread; jobs are kept in memory with their state.
+    QC models of other MPPs are loaded on first use and stay loaded. Outputs are only written inside output_root.
+    """
+
+    def __init__(self, DEVICE, mpp_model=1.5, backend='pytorch', precision='fp32', model_cache="Y", batch_size=1,
+                 reader_workers=2, prefetch_depth=16, level_tolerance=0.1, overlay_factor=10, output_root='.'):
+        from wsi_pipeline import load_td, load_qc, td_preprocessing_fn
+
+        self.DEVICE = DEVICE
+        self.output_root = os.path.abspath(output_root)
+        self.backend = backend
+        self.precision = precision
+        self.model_cache = model_cache
+        self.batch_size = batch_size
+        self.reader_workers = reader_workers
+        self.prefetch_depth = prefetch_depth
+        self.level_tolerance = level_tolerance
+        self.overlay_factor = overlay_factor
+        self.default_mpp_model = mpp_model
+
+        start = timeit.default_timer()
+        self.model_td = load_td(DEVICE, backend, precision, model_cache)
+        self.preprocessing_fn = td_preprocessing_fn()
+        self.models_qc = {mpp_model: load_qc(mpp_model, DEVICE, backend, precision, model_cache)}
+        print("Models loaded in", round(timeit.default_timer() - start, 2), "s")
+
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.queue = Queue()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, request):
+        # Validate and queue a job, returns its id
+        if self.stopping.is_set():
+            raise ValueError("the worker is shutting down")
+        from wsi_pipeline import MODEL_QC_NAMES
+
+        slide_path = request.get('slide_path')
+        output_dir = request.get('output_dir')
+        if not slide_path or not os.path.isfile(slide_path):
+            raise ValueError(f"slide not found: {slide_path}")
+        if not output_dir:
+            raise ValueError("output_dir is required")
+        output_dir = output_dir_in_root(output_dir, self.output_root)
+        steps = request.get('steps', STEPS)
+        if isinstance(steps, str):
+            steps = steps.split(',')
+        if not steps or any(step not in STEPS for step in steps):
+            raise ValueError(f"steps should be a subset of {STEPS}")
+        mpp_model = float(request.get('mpp_model', self.default_mpp_model))
+        if mpp_model not in MODEL_QC_NAMES:
+            raise ValueError("mpp of the model can only be 1.0, 1.5, 2.0")
+
+        job = {'job_id': uuid.uuid4().hex[:12], 'slide_path': os.path.abspath(slide_path),
+               'output_dir': output_dir, 'steps': steps, 'mpp_model': mpp_model,
+               'create_geojson': request.get('create_geojson', "Y"), 'state': 'queued', 'step': None,
+               'progress': None, 'outputs': {}, 'error': None, 'submitted': time.time(), 'started': None,
+               'finished': None}
+        with self.lock:
+            self.jobs[job['job_id']] = job
+        self.queue.put(job['job_id'])
+        return job['job_id']
+
+    def job(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def all_jobs(self):
+        with self.lock:
+            return json.loads(json.dumps(list(self.jobs.values())))
+
+    def health(self):
+        return {'ok': True, 'device': str(self.DEVICE), 'backend': self.backend, 'precision': self.precision,
+                'qc_models_mpp': sorted(self.models_qc), 'queued': self.queue.qsize()}
+
+    def _update(self, job_id, **fields):
+        with self.lock:
+            self.jobs[job_id].update(fields)
+
+    def _run(self):
+        while True:
+            job_id = self.queue.get()
+            # After a shutdown request queued jobs are not started anymore
+            if job_id is None or self.stopping.is_set():
+                return
+            self._update(job_id, state='running', started=time.time())
+            try:
+                self._process(self.job(job_id))
+                self._update(job_id, state='done', step=None, finished=time.time())
+            except Exception as e:
+                self._update(job_id, state='failed', error=f"{type(e).__name__}: {e}", finished=time.time())
+
+    def _process(self, job):
+        from wsi_pipeline import (load_qc, tis_det_dirs, detect_tissue_slide, qc_dirs, qc_slide, fused_slide,
+                                  stats_header)
+        from wsi_thumbnail_cache import ThumbnailCache
+
+        job_id = job['job_id']
+        slide_name = os.path.basename(job['slide_path'])
+        output_dir = job['output_dir']
+        os.makedirs(output_dir, exist_ok=True)
+        thumbnails = ThumbnailCache(os.path.join(output_dir, 'thumbnail_cache'))
+
+        def progress_step(step):
+            def progress(done, total):
+                self._update(job_id, step=step, progress={'done': done, 'total': total})
+            return progress
+
+        if job['steps'] == ['tis_detect']:
+            self._update(job_id, step='tis_detect', progress=None)
+            outputs = detect_tissue_slide(self.model_td, self.preprocessing_fn, job['slide_path'], slide_name,
+                                          tis_det_dirs(output_dir), self.DEVICE, progress=progress_step('tis_detect'),
+                                          thumbnails=thumbnails)
+            self._update(job_id, outputs={'tis_detect': outputs})
+
+        if 'qc' in job['steps']:
+            mpp_model = job['mpp_model']
+            if mpp_model not in self.models_qc:
+                self.models_qc[mpp_model] = load_qc(mpp_model, self.DEVICE, self.backend, self.precision,
+                                                    self.model_cache)
+            qc_options = dict(batch_size=self.batch_size, reader_workers=self.reader_workers,
+                              prefetch_depth=self.prefetch_depth, level_tolerance=self.level_tolerance,
+                              overlay_factor=self.overlay_factor, create_geojson=job['create_geojson'],
+                              progress=progress_step('qc'), thumbnails=thumbnails)
+            if 'tis_detect' in job['steps']:
+                # Both steps in one pass over the open slide (see fused_slide)
+                self._update(job_id, step='tis_detect', progress=None)
+                output_temp, outputs, outputs_td = fused_slide(self.model_td, self.preprocessing_fn,
+                                                               self.models_qc[mpp_model], job['slide_path'],
+                                                               slide_name, output_dir,
+                                                               qc_dirs(output_dir, job['create_geojson']), mpp_model,
+                                                               self.DEVICE, tis_det_dirs=tis_det_dirs(output_dir),
+                                                               progress_td=progress_step('tis_detect'), **qc_options)
+                self._update(job_id, outputs={'tis_detect': outputs_td})
+            else:
+                self._update(job_id, step='qc', progress=None)
+                output_temp, outputs = qc_slide(self.models_qc[mpp_model], job['slide_path'], slide_name, output_dir,
+                                                qc_dirs(output_dir, job['create_geojson']), mpp_model, self.DEVICE,
+                                                **qc_options)
+            path_result = os.path.join(output_dir, 'report_' + os.path.basename(output_dir) +
+                                       '_worker_stats_per_slide.txt')
+            new_file = not os.path.exists(path_result)
+            results = open(path_result, "a+")
+            if new_file:
+                results.write(stats_header())
+            results.write(output_temp)
+            results.close()
+            outputs['stats'] = path_result
+            with self.lock:
+                self.jobs[job_id]['outputs']['qc'] = outputs
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.put(None)
+
+
+def make_handler(worker, server_stop, token):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code, data):
+            body = json.dumps(data).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _authorized(self):
+            # Token of the worker in every request, JSON bodies only: a plain HTML form cannot send either
+            auth = self.headers.get('Authorization', '')
+            if not hmac.compare_digest(auth.encode(), ('Bearer ' + token).encode()):
+                self._send(401, {'error': 'missing or wrong token'})
+                return False
+            if self.command == 'POST' and self.headers.get_content_type() != 'application/json':
+                self._send(415, {'error': 'Content-Type has to be application/json'})
+                return False
+            return True
+
+        def do_GET(self):
+            if not self._authorized():
+                return
+            if self.path == '/health':
+                self._send(200, worker.health())
+            elif self.path == '/jobs':
+                self._send(200, worker.all_jobs())
+            elif self.path.startswith('/jobs/'):
+                job = worker.job(self.path[len('/jobs/'):])
+                if job is None:
+                    self._send(404, {'error': 'unknown job'})
+                else:
+                    self._send(200, job)
+            else:
+                self._send(404, {'error': 'unknown path'})
+
+        def do_POST(self):
+            if not self._authorized():
+                return
+            if self.path == '/jobs':
+                try:
+                    length = int(self.headers.get('Content-Length', 0))
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                    self._send(202, {'job_id': worker.submit(request)})
+                except (ValueError, TypeError) as e:
+                    self._send(400, {'error': str(e)})
+            elif self.path == '/shutdown':
+                self._send(200, {'ok': True})
+                server_stop()
+            else:
+                self._send(404, {'error': 'unknown path'})
+
+        def log_message(self, format, *args):
+            # Status polling would flood the log
+            pass
+
+    return Handler
+
+
+def serve(args):
+    import torch
+
+    if torch.cuda.is_available():
+        DEVICE = 'cuda'
+    elif torch.backends.mps.is_available():
+        DEVICE = 'mps'
+    else:
+        DEVICE = 'cpu'
+    worker = GrandQCWorker(DEVICE, args.MPP_MODEL, args.backend, args.precision, args.model_cache, args.batch_size,
+                           args.reader_workers, args.prefetch_depth, args.level_tolerance, args.ol_factor,
+                           args.output_root)
+    server = ThreadingHTTPServer((args.host, args.port), None)
+    token = write_token(args.token_file)
+
+    def server_stop():
+        worker.stop()
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    server.RequestHandlerClass = make_handler(worker, server_stop, token)
+    print(f"GrandQC worker listening on http://{args.host}:{args.port}, token in {args.token_file}, "
+          f"outputs inside {worker.output_root}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        worker.stop()
+    server.server_close()
+    # Let the running job finish
+    worker.thread.join()
+
+
+# =============================================================================
+# CLIENT
+# =============================================================================
+def request(url, token, data=None):
+    body = json.dumps(data).encode() if data is not None else None
+    req = urllib.request.Request(url, data=body, headers={'Content-Type': 'application/json',
+                                                          'Authorization': 'Bearer ' + token},
+                                 method='POST' if data is not None else 'GET')
+    try:
+        with urllib.request.urlopen(req) as response:
+            return json.loads(response.read())
+    except urllib.error.HTTPError as e:
+        raise SystemExit(f"Error {e.code}: {json.loads(e.read()).get('error')}")
+    except urllib.error.URLError as e:
+        raise SystemExit(f"GrandQC worker not reachable at {url}: {e.reason}")
+
+
+def submit(args, url, token):
+    # Paths relative to the folder of the client, not of the worker
+    job_id = request(url + '/jobs', token, {'slide_path': os.path.abspath(args.slide_path),
+                                            'output_dir': os.path.abspath(args.output_dir), 'steps': args.steps,
+                                            'mpp_model': args.MPP_MODEL,
+                                            'create_geojson': args.create_geojson})['job_id']
+    if not args.wait:
+        print(job_id)
+        return 0
+    last = None
+    while True:
+        job = request(url + '/jobs/' + job_id, token)
+        progress = job['progress'] or {}
+        line = f"{job_id} {job['state']} {job['step'] or ''} {progress.get('done', '')}/{progress.get('total', '')}"
+        if line != last:
+            print(line, flush=True)
+            last = line
+        if job['state'] in ('done', 'failed'):
+            break
+        time.sleep(args.poll)
+    print(json.dumps(job, indent=2))
+    return 0 if job['state'] == 'done' else 1
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', dest='host', default='127.0.0.1', help='address of the worker', type=str)
+    parser.add_argument('--port', dest='port', default=DEFAULT_PORT, help='port of the worker', type=int)
+    parser.add_argument('--token_file', dest='token_file', default=None,
+                        help='file with the access token, written by serve (default: ~/.grandqc/worker_<port>.token)',
+                        type=str)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_serve = commands.add_parser('serve', help='start the worker')
+    parser_serve.add_argument('--mpp_model', dest='MPP_MODEL', default=1.5,
+                              help='MPP of the QC model loaded at start, should only be 1.0, 1.5, 2.0', type=float)
+    parser_serve.add_argument('--ol_factor', dest='ol_factor', default=10,
+                              help='reduction factor of the overlay compared to dimensions of original WSI', type=int)
+    parser_serve.add_argument('--batch_size', dest='batch_size', default=1,
+                              help='number of tissue patches predicted in one forward pass of the model', type=int)
+    parser_serve.add_argument('--reader_workers', dest='reader_workers', default=2,
+                              help='number of threads reading patches ahead of the inference', type=int)
+    parser_serve.add_argument('--prefetch_depth', dest='prefetch_depth', default=16,
+                              help='maximum number of patches read ahead of the inference', type=int)
+    parser_serve.add_argument('--level_tolerance', dest='level_tolerance', default=0.1,
+                              help='relative tolerance for reading patches from a coarser pyramid level', type=float)
+    parser_serve.add_argument('--backend', dest='backend', default='pytorch', choices=['pytorch', 'onnxruntime'],
+                              help='inference backend of the models', type=str)
+    parser_serve.add_argument('--precision', dest='precision', default='fp32', choices=['fp32', 'int8'],
+                              help='int8 - INT8 quantized models made by quantize_onnx.py', type=str)
+    parser_serve.add_argument('--model_cache', dest='model_cache', default="Y",
+                              help='use the model cache in models/cache or not', type=str)
+    parser_serve.add_argument('--output_root', dest='output_root', default='.',
+                              help='jobs can only write into folders inside this one (default: current folder)',
+                              type=str)
+
+    parser_submit = commands.add_parser('submit', help='submit a slide job')
+    parser_submit.add_argument('--slide_path', dest='slide_path', required=True, help='path to WSI', type=str)
+    parser_submit.add_argument('--output_dir', dest='output_dir', required=True, help='path to output folder',
+                               type=str)
+    parser_submit.add_argument('--steps', dest='steps', default=','.join(STEPS),
+                               help='comma separated steps: tis_detect, qc', type=str)
+    parser_submit.add_argument('--mpp_model', dest='MPP_MODEL', default=1.5,
+                               help='MPP of the QC model, should only be 1.0, 1.5, 2.0', type=float)
+    parser_submit.add_argument('--create_geojson', dest='create_geojson', default="Y",
+                               help='create geojson for QC or not', type=str)
+    parser_submit.add_argument('--wait', dest='wait', action='store_true',
+                               help='wait for the job, print progress and the output paths')
+    parser_submit.add_argument('--poll', dest='poll', default=1.0, help='seconds between status requests',
+                               type=float)
+
+    parser_status = commands.add_parser('status', help='state of one or all jobs')
+    parser_status.add_argument('job_id', nargs='?', default=None, help='job id (all jobs if not given)')
+
+    commands.add_parser('health', help='check if the worker is running')
+    commands.add_parser('shutdown', help='stop the worker after the running job')
+
+    args = parser.parse_args()
+    url = f"http://{args.host}:{args.port}"
+    if args.token_file is None:
+        args.token_file = default_token_file(args.port)
+
+    if args.command == 'serve':
+        serve(args)
+    else:
+        token = read_token(args.token_file)
+        if args.command == 'submit':
+            sys.exit(submit(args, url, token))
+        elif args.command == 'status':
+            print(json.dumps(request(url + '/jobs' + ('/' + args.job_id if args.job_id else ''), token), indent=2))
+        elif args.command == 'health':
+            print(json.dumps(request(url + '/health', token), indent=2))
+        elif args.command == 'shutdown':
+            print(json.dumps(request(url + '/shutdown', token, {})))
@@ -1,9 +0,0 @@
-colors_QC7 = [
-    [128,128,128],     #ART_NORM: white
-    [255,99,71],     #ART_FOLD: orange
-    [0,255,0],   #ART_DARKSPOT: green
-    [255,0,0],   #ART_PEN: red
-    [255,0,255],   #ART_EDGE: pink
-    [75,0,130],      # FOCUS: violet
-    [255,255,255]   #BACK
-]
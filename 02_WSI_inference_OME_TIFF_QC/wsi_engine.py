@@ -0,0 +1,26 @@
+# THE SCRIPTS OF THIS FOLDER RUN THE PIPELINE OF 01_WSI_inference_OPENSLIDE_QC, ONE ENGINE FOR ALL SLIDE FORMATS
+import os
+import runpy
+import sys
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+ENGINE_DIR = os.path.join(os.path.dirname(SCRIPT_DIR), '01_WSI_inference_OPENSLIDE_QC')
+MODEL_DIR = os.path.join(SCRIPT_DIR, 'models')
+
+
+def has_checkpoints(model_dir):
+    return any(name.endswith('.pth') for _, _, names in os.walk(model_dir) for name in names)
+
+
+def run_engine(script, run_name):
+    '''
+    Runs script of the engine (main.py, wsi_tis_detect.py) with the command line of this process; the engine reads
+    OME-TIFF slides through wsi_slide_reader.OmeTiffReader. Checkpoints in the models folder of this folder are used
+    if there are any (GRANDQC_MODEL_DIR, see wsi_pipeline), otherwise the ones of the engine.
+    run_name is the __name__ of the calling script, so processes spawned by the engine do not run it again.
+    '''
+    if 'GRANDQC_MODEL_DIR' not in os.environ and has_checkpoints(MODEL_DIR):
+        os.environ['GRANDQC_MODEL_DIR'] = MODEL_DIR
+    sys.path.insert(0, ENGINE_DIR)
+    sys.argv[0] = os.path.join(ENGINE_DIR, script)
+    runpy.run_path(sys.argv[0], run_name=run_name)